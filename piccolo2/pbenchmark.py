@@ -0,0 +1,971 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for the piccolo server.
+
+The acquisition benchmark boots the complete server stack (dispatcher, piccolo
+instrument, worker and output threads and data directory) with simulated
+shutters, spectrometers and auxiliary instruments and drives record batches
+through it. The write benchmark measures the latency and throughput of
+publishing files in a directory using the different fsync policies. The
+simplify benchmark compares the spectra simplification with the previous
+implementation and verifies it against the reference implementation. The
+encoding benchmark measures the size and speed of the pixel transfer
+encodings. The results are written as JSON so that they can be compared
+between commits.
+
+The check command runs behaviour checks of the batch counters, the spool,
+the pixel encodings and the columnar archive on a scratch directory. It
+exits with status 1 if any check fails.
+"""
+
+import server as piccolo
+from server import PiccoloSimplify
+from server import PiccoloEncoding
+from server.PiccoloPostProcess import PiccoloSimplifyStage
+from server.PiccoloCounter import PiccoloCounter
+from server.PiccoloSpool import PiccoloSpool, PiccoloFlusher
+import argparse
+import datetime
+import json
+import os, os.path
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import numpy
+import psutil
+
+class SimulatedSpectrometer(object):
+    """stand-in for a piccolo2.hardware spectrometer producing synthetic spectra"""
+
+    def __init__(self,serialNumber,nPixels=1024,saturationLevel=200000):
+        """
+        :param serialNumber: the serial number of the simulated spectrometer
+        :param nPixels: the number of pixels of a spectrum
+        :param saturationLevel: the saturation level of the detector"""
+        self.serialNumber = serialNumber
+        self._nPixels = nPixels
+        self._saturation = saturationLevel
+        self._integrationTime = 100.
+        self._wcc = [350.,0.8,-2.e-5,1.e-9]
+        x = numpy.linspace(-1.,1.,nPixels)
+        self._shape = 0.05+numpy.exp(-x*x/0.2)
+
+    def setIntegrationTime(self,milliseconds):
+        self._integrationTime = float(milliseconds)
+
+    def getMetadata(self):
+        return {'SerialNumber': self.serialNumber,
+                'IntegrationTime': self._integrationTime,
+                'SaturationLevel': self._saturation,
+                'WavelengthCalibrationCoefficients': self._wcc}
+
+    def requestSpectrum(self):
+        time.sleep(self._integrationTime/1000.)
+
+    def readSpectrum(self):
+        signal = self._shape*min(self._integrationTime,1000.)*50.
+        return numpy.minimum(numpy.random.poisson(signal),self._saturation).tolist()
+
+class SimulatedGPS(piccolo.PiccoloAuxHandlerThread):
+    """simulated GPS moving along a straight line"""
+
+    def __init__(self,lat=55.92,lon=-3.17):
+        self._lat = lat
+        self._lon = lon
+        self._start = time.time()
+        piccolo.PiccoloAuxHandlerThread.__init__(self)
+
+    def run(self):
+        while True:
+            time.sleep(1)
+
+    def getRecord(self):
+        dt = time.time()-self._start
+        return {'lat': self._lat+1e-5*dt,
+                'lon': self._lon+2e-5*dt,
+                'time': datetime.datetime.utcnow().isoformat(),
+                'speed': 2.,
+                'alt': 100.}
+
+def latencyStats(latencies):
+    """summarise a list of latencies in seconds"""
+    if len(latencies) == 0:
+        return {'count': 0}
+    d = numpy.array(latencies)
+    return {'count': len(d),
+            'mean': float(d.mean()),
+            'p50': float(numpy.percentile(d,50)),
+            'p95': float(numpy.percentile(d,95)),
+            'max': float(d.max())}
+
+def directorySize(path):
+    """total size in bytes of all files below path"""
+    size = 0
+    for root,dirs,files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root,f))
+    return size
+
+def gitCommit():
+    """get the commit of the source tree if it is a git checkout"""
+    try:
+        cmdPipe = subprocess.Popen(['git','rev-parse','HEAD'],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        if cmdPipe.wait()==0:
+            return cmdPipe.stdout.read().strip()
+    except OSError:
+        pass
+    return None
+
+class Poller(threading.Thread):
+    """client repeatedly polling the piccolo server while it records"""
+
+    def __init__(self,controller,outDir):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._controller = controller
+        self._outDir = outDir
+        self._stop = threading.Event()
+        self.latencies = []
+
+    def stop(self):
+        self._stop.set()
+        self.join()
+
+    def run(self):
+        while not self._stop.isSet():
+            for cmd,kwds in [('status',{}),('getSpectraList',{'outDir':self._outDir})]:
+                t0 = time.time()
+                self._controller.invoke(cmd,component='piccolo',keywords=kwds)
+                self.latencies.append(time.time()-t0)
+
+class BenchmarkStack(object):
+    """the piccolo server stack with simulated instruments"""
+
+    def __init__(self,datadir,nSpectrometers=1,nPixels=1024,nPollers=0,spooldir=None,fsync='batch',
+                 compression='none',archive=False):
+        """
+        :param datadir: the data directory, should be on tmpfs
+        :param nSpectrometers: the number of simulated spectrometers
+        :param nPixels: the number of pixels of each simulated spectrometer
+        :param nPollers: the number of concurrently polling clients
+        :param spooldir: spool batches in spooldir before copying them to datadir
+        :param fsync: the fsync policy used for the data directory
+        :param compression: the compression of the spectra files
+        :param archive: also write the columnar archive of each batch"""
+
+        self.datadir = piccolo.PiccoloDataDir(datadir)
+        self.dispatcher = piccolo.PiccoloDispatcher(daemon=True)
+
+        shutters = {}
+        for c in ['upwelling','downwelling']:
+            shutters[c] = piccolo.PiccoloShutter(c)
+            self.dispatcher.registerComponent(shutters[c])
+        self.spectrometers = {}
+        for i in range(nSpectrometers):
+            sname = 'S_SIM{0:05d}'.format(i)
+            self.spectrometers[sname] = piccolo.PiccoloSpectrometer(sname,spectrometer=SimulatedSpectrometer(sname[2:],nPixels=nPixels))
+            self.dispatcher.registerComponent(self.spectrometers[sname])
+        aux = {'GPS': piccolo.PiccoloAuxInstrument('GPS',SimulatedGPS())}
+
+        self.piccolo = piccolo.Piccolo('piccolo',self.datadir,shutters,self.spectrometers,aux,clobber=False,split=True,
+                                     spooldir=spooldir,fsync=fsync,compression=compression,
+                                     archive=archive)
+        self.dispatcher.registerComponent(self.piccolo)
+
+        self.controller = piccolo.PiccoloController()
+        self.dispatcher.registerController(self.controller)
+        self.pollControllers = []
+        for i in range(nPollers):
+            c = piccolo.PiccoloController()
+            self.dispatcher.registerController(c)
+            self.pollControllers.append(c)
+
+        self.dispatcher.start()
+
+    def shutdown(self):
+        """stop the components and the dispatcher and wait for their threads
+        to finish"""
+        self.controller.stop()
+        self.dispatcher.join()
+
+    def invoke(self,command,**kwds):
+        status,result = self.controller.invoke(command,component='piccolo',keywords=kwds)
+        if status != 'ok':
+            raise RuntimeError, '{}: {}'.format(command,result)
+        return result
+
+    def run(self,nCycles,delay=0.,integrationTime=10.,timeout=None):
+        """record a batch and wait until all spectra are written
+
+        :param nCycles: the number of cycles to record
+        :param delay: delay between cycles in seconds
+        :param integrationTime: integration time in milliseconds
+        :param timeout: give up after timeout seconds
+        :return: dictionary containing the results"""
+
+        outDir = 'benchmark_{0}_{1}_{2}'.format(len(self.spectrometers),nCycles,delay)
+        for shutter in ['upwelling','downwelling']:
+            for s in self.spectrometers:
+                self.invoke('setIntegrationTime',shutter=shutter,spectrometer=s,milliseconds=integrationTime)
+        if timeout is None:
+            timeout = 60.+10.*nCycles*(delay+4*integrationTime/1000.+1.)
+
+        piccolo.Trace.clear()
+        pollers = [Poller(c,outDir) for c in self.pollControllers]
+        for p in pollers:
+            p.start()
+
+        t0 = time.time()
+        result = self.invoke('record',outDir=outDir,nCycles=nCycles,delay=delay)
+        if result != 'ok':
+            raise RuntimeError, 'record: {}'.format(result)
+        while piccolo.Trace.summary().get('write',{}).get('count',0) < nCycles:
+            if time.time()-t0 > timeout:
+                raise RuntimeError, 'batch did not finish within {} seconds'.format(timeout)
+            time.sleep(0.05)
+        # wait for the spool to be flushed
+        while self.invoke('outputStatus').get('spool',{}).get('pending',0) > 0:
+            if time.time()-t0 > timeout:
+                raise RuntimeError, 'spool was not flushed within {} seconds'.format(timeout)
+            time.sleep(0.05)
+        wall = time.time()-t0
+
+        latencies = []
+        for p in pollers:
+            p.stop()
+            latencies += p.latencies
+
+        phases = piccolo.Trace.summary()
+        nBytes = directorySize(self.datadir.join(outDir))
+        writeTime = phases['write']['total']
+        return {'nSpectrometers': len(self.spectrometers),
+                'nCycles': nCycles,
+                'delay': delay,
+                'integrationTime': integrationTime,
+                'wall_time': wall,
+                'cycles_per_second': nCycles/wall,
+                'phases': phases,
+                'bytes_written': nBytes,
+                'write_throughput': nBytes/writeTime if writeTime>0 else None,
+                'rpc_latency': latencyStats(latencies),
+                'trace_events': len(piccolo.Trace.events()),
+                'rss': psutil.Process(os.getpid()).memory_info().rss,
+                'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024}
+
+def intList(s):
+    return [int(v) for v in s.split(',')]
+
+def floatList(s):
+    return [float(v) for v in s.split(',')]
+
+def compare(base,new):
+    """print the relative change of the main metric for runs common to both
+    reports"""
+    keys = new['keys']
+    metric = new['metric']
+    runKey = lambda run: tuple(run.get(k) for k in keys)
+    baseRuns = dict((runKey(r),r) for r in base['runs'])
+    for r in new['runs']:
+        k = runKey(r)
+        if k not in baseRuns:
+            continue
+        b = baseRuns[k][metric]
+        print >> sys.stderr, '{0}: {1} {2:.3f} -> {3:.3f} ({4:+.1f}%)'.format(
+            ' '.join('{}={}'.format(n,v) for n,v in zip(keys,k)),
+            metric,b,r[metric],100.*(r[metric]-b)/b)
+
+def acquisitionBenchmark(args):
+    datadir = args.data_dir
+    piccolo.Trace.maxEvents = args.trace_events
+    if datadir is None:
+        datadir = os.path.join('/dev/shm','piccolo2_benchmark_{}'.format(os.getpid()))
+
+    runs = []
+    try:
+        for nSpectrometers in args.spectrometers:
+            spooldir = None
+            if args.spool is not None:
+                spooldir = os.path.join(args.spool,'spool_{}'.format(nSpectrometers))
+            stack = BenchmarkStack(datadir,nSpectrometers=nSpectrometers,nPixels=args.pixels,nPollers=args.pollers,
+                                   spooldir=spooldir,fsync=args.fsync,compression=args.compression,
+                                   archive=args.archive)
+            try:
+                for nCycles in args.cycles:
+                    for delay in args.delays:
+                        runs.append(stack.run(nCycles,delay=delay,integrationTime=args.integration_time))
+                        if args.trace is not None:
+                            with open(args.trace,'w') as out:
+                                json.dump(piccolo.Trace.chromeTrace(),out)
+            finally:
+                stack.shutdown()
+    finally:
+        if not args.keep:
+            shutil.rmtree(datadir,ignore_errors=True)
+
+    return {'benchmark': 'acquisition',
+            'keys': ['nSpectrometers','nCycles','delay'],
+            'metric': 'cycles_per_second',
+            'settings': {'pixels': args.pixels,
+                         'pollers': args.pollers,
+                         'integrationTime': args.integration_time,
+                         'spool': args.spool,
+                         'fsync': args.fsync,
+                         'compression': args.compression,
+                         'archive': args.archive,
+                         'datadir': datadir},
+            'runs': runs}
+
+def writeRun(outDir,policy,nBatches,nFiles,fileSize,interval):
+    """publish nBatches batches of nFiles files of fileSize bytes in outDir
+
+    :return: dictionary containing the results"""
+    os.makedirs(outDir)
+    sync = piccolo.PiccoloFileSync(policy=policy,interval=interval)
+    data = os.urandom(fileSize)
+    latencies = []
+
+    t0 = time.time()
+    for b in range(nBatches):
+        tb = time.time()
+        published = []
+        for f in range(nFiles):
+            fname = os.path.join(outDir,'write_bat{0:04d}_{1:04d}.pico'.format(b,f))
+            tmp = piccolo.tmpName(fname)
+            with open(tmp,'wb') as out:
+                out.write(data)
+            published.append((tmp,fname))
+        sync.publish(published,callback=lambda error,tb=tb: latencies.append(time.time()-tb))
+    sync.flush()
+    wall = time.time()-t0
+
+    nBytes = nBatches*nFiles*fileSize
+    return {'policy': policy,
+            'nFiles': nFiles,
+            'fileSize': fileSize,
+            'nBatches': nBatches,
+            'wall_time': wall,
+            'batches_per_second': nBatches/wall,
+            'write_throughput': nBytes/wall,
+            'latency': latencyStats(latencies)}
+
+def writeBenchmark(args):
+    datadir = args.data_dir
+    if datadir is None:
+        datadir = os.path.join(os.getcwd(),'piccolo2_benchmark_{}'.format(os.getpid()))
+
+    runs = []
+    try:
+        for policy in args.policies:
+            for nFiles in args.files:
+                outDir = os.path.join(datadir,'write_{0}_{1}'.format(policy,nFiles))
+                runs.append(writeRun(outDir,policy,args.batches,nFiles,args.size,args.interval))
+    finally:
+        if not args.keep:
+            shutil.rmtree(datadir,ignore_errors=True)
+
+    return {'benchmark': 'write',
+            'keys': ['policy','nFiles'],
+            'metric': 'batches_per_second',
+            'settings': {'batches': args.batches,
+                         'size': args.size,
+                         'interval': args.interval,
+                         'datadir': datadir},
+            'runs': runs}
+
+def simplifyReference(xs,ys, tolerance=0.1, highestQuality=True):
+    """pure python port of simplify.py used to verify PiccoloSimplify.simplify
+
+    the Douglas-Peucker pass gives the same points as simplify. The radial
+    distance pass measures the distance from the previous kept point rather
+    than along the line so the prefiltered results differ slightly.
+
+    :return: the indices of the kept points"""
+    points = zip(map(float,xs),map(float,ys))
+    sqtolerance = tolerance * tolerance
+    n = len(points)
+    if n < 3:
+        return range(n)
+
+    def getSquareDistance(p1,p2):
+        dx = p1[0] - p2[0]
+        dy = p1[1] - p2[1]
+        return dx*dx + dy*dy
+
+    def getSquareSegmentDistance(p,p1,p2):
+        x,y = p1
+        dx = p2[0] - x
+        dy = p2[1] - y
+        if dx != 0 or dy != 0:
+            t = ((p[0] - x)*dx + (p[1] - y)*dy)/(dx*dx + dy*dy)
+            if t > 1:
+                x,y = p2
+            elif t > 0:
+                x += dx*t
+                y += dy*t
+        dx = p[0] - x
+        dy = p[1] - y
+        return dx*dx + dy*dy
+
+    indices = range(n)
+    if not highestQuality:
+        prev = 0
+        indices = [0]
+        for i in range(1,n):
+            if getSquareDistance(points[i],points[prev]) > sqtolerance:
+                indices.append(i)
+                prev = i
+        if prev != n-1:
+            indices.append(n-1)
+
+    markers = [False]*len(indices)
+    markers[0] = markers[-1] = True
+    stack = [(0,len(indices)-1)]
+    while stack:
+        first,last = stack.pop()
+        max_sqdist = 0
+        index = None
+        for i in range(first+1,last):
+            sqdist = getSquareSegmentDistance(points[indices[i]],points[indices[first]],points[indices[last]])
+            if sqdist > max_sqdist:
+                index = i
+                max_sqdist = sqdist
+        if max_sqdist > sqtolerance:
+            markers[index] = True
+            stack.append((first,index))
+            stack.append((index,last))
+
+    return [indices[i] for i in range(len(indices)) if markers[i]]
+
+class PreviousSimplifier(object):
+    """the stack based Douglas-Peucker simplifier used by piccolo before it
+    was vectorised, kept as the baseline of the simplify benchmark"""
+
+    def __init__(self,xs,ys,tolerance):
+        self.xs = xs
+        self.ys = ys
+        self.tolerance = tolerance
+
+        self.length = xs.size
+        self.markers = numpy.zeros(self.length,dtype='bool')
+        self.markers[[0,-1]] = 1
+
+        self.ts = numpy.empty(self.length)
+        self.final_xs = numpy.empty(self.length)
+        self.final_ys = numpy.empty(self.length)
+
+    def getSquareSegmentDistances(self,first,last):
+        inner = slice(first,last)
+        x = self.xs[first]
+        y = self.ys[first]
+
+        dx = self.xs[last] - x
+        dy = self.ys[last] - y
+
+        if dx != 0 or dy != 0:
+            final_xs = self.final_xs[inner]
+            final_ys = self.final_ys[inner]
+            final_xs[:] = x
+            final_ys[:] = y
+
+            inner_ts = (((self.xs[inner] - x) * dx
+                + (self.ys[inner] -y) * dy) / (dx*dx + dy*dy))
+
+            large_ts = inner_ts>1
+            small_ts = inner_ts>0 & ~large_ts
+
+            final_xs[small_ts] += dx*inner_ts[small_ts]
+            final_ys[small_ts] += dy*inner_ts[small_ts]
+
+            final_xs[large_ts] = self.xs[last]
+            final_ys[large_ts] = self.ys[last]
+
+        dx = self.xs[inner] - final_xs
+        dy = self.ys[inner] - final_ys
+
+        return dx * dx + dy * dy
+
+    def simplifyDouglasPeucker(self):
+        first = 0
+        last = self.length - 1
+
+        first_stack = numpy.empty(self.length,dtype='uint32')
+        first_i = -1
+        last_stack = numpy.empty(self.length,dtype='uint32')
+        last_i = -1
+
+        while last is not None:
+            sqdists = self.getSquareSegmentDistances(first,last)
+            max_idx = numpy.argmax(sqdists)
+            max_sqdist = sqdists[max_idx]
+            max_idx += first
+
+            if max_sqdist > self.tolerance:
+                self.markers[max_idx] = 1
+
+                first_stack[first_i+1:first_i+3] = first,max_idx
+                last_stack[last_i+1:last_i+3] = max_idx,last
+                first_i +=2
+                last_i += 2
+
+            if first_i < 0:
+                first = None
+            else:
+                first = first_stack[first_i]
+                first_i -=1
+
+            if last_i < 0:
+                last = None
+            else:
+                last = last_stack[last_i]
+                last_i -=1
+
+        return self.xs[self.markers],self.ys[self.markers]
+
+def previousSimplifySpectra(data,threshold):
+    """simplify the spectra contained in data the way Piccolo.simplifySpectra
+    did before the simplification was vectorised and moved to the post
+    processing stage"""
+    jdata = json.loads(data)
+    piccoloData = {'SequenceNumber': jdata['SequenceNumber'],
+                   'Spectra': jdata['Spectra']}
+    for s in piccoloData['Spectra']:
+        wcc = s['Metadata']['WavelengthCalibrationCoefficients']
+        s['Pixels'] = numpy.asarray(s['Pixels'],dtype=numpy.float32)
+        wavelengths = numpy.poly1d(wcc[::-1])(numpy.arange(s['Pixels'].size))
+        simple_px,simple_wv = PreviousSimplifier(s['Pixels'],wavelengths,threshold*threshold).simplifyDouglasPeucker()
+        simple_px = numpy.round(simple_px,2).tolist()
+        s['Metadata']['Wavelengths'] = numpy.round(simple_wv,3).tolist()
+        del s['Metadata']['WavelengthCalibrationCoefficients']
+        s['Pixels'] = numpy.round(simple_px,2).tolist()
+    return piccoloData
+
+def simplifyRun(nPoints,tolerance,nSpectra,integrationTimes):
+    """simplify nSpectra synthetic spectra of nPoints points for each
+    integration time, compare the spectra files simplification with the
+    previous implementation and check the results, one spectrum at a time
+    and all spectra at once, against the reference implementation
+
+    :return: dictionary containing the results"""
+    spectrometer = SimulatedSpectrometer('SIMPLIFY',nPixels=nPoints)
+    wavelengths = numpy.poly1d(spectrometer.getMetadata()['WavelengthCalibrationCoefficients'][::-1])(numpy.arange(nPoints))
+    spectra = []
+    for integrationTime in integrationTimes:
+        spectrometer.setIntegrationTime(integrationTime)
+        for i in range(nSpectra):
+            spectra.append(numpy.asarray(spectrometer.readSpectrum(),dtype=numpy.float32))
+
+    def timeit(simplify,**kwds):
+        t0 = time.time()
+        results = [simplify(pixels,wavelengths,tolerance,**kwds) for pixels in spectra]
+        return time.time()-t0,results
+
+    wall,simplified = timeit(PiccoloSimplify.simplify)
+    prefilterWall,prefiltered = timeit(PiccoloSimplify.simplify,highestQuality=False)
+    referenceWall,reference = timeit(simplifyReference)
+    # the spectra files are simplified all spectra at once
+    batched = PiccoloSimplify.simplifyMany([(pixels,wavelengths) for pixels in spectra],tolerance)
+    batchedPrefiltered = PiccoloSimplify.simplifyMany([(pixels,wavelengths) for pixels in spectra],tolerance,highestQuality=False)
+
+    # the whole code path of simplifying a spectra file, from parsing the
+    # file to the rounded spectra
+    meta = dict(spectrometer.getMetadata(),Dark=False,Direction='Upwelling')
+    data = json.dumps({'SequenceNumber': 0,
+                       'Spectra': [{'Metadata': meta,'Pixels': pixels.astype(int).tolist()} for pixels in spectra]})
+    stage = PiccoloSimplifyStage({'threshold': tolerance})
+    t0 = time.time()
+    stage.simplify(data)
+    fileWall = time.time()-t0
+    t0 = time.time()
+    previousSimplifySpectra(data,tolerance)
+    previousWall = time.time()-t0
+
+    mismatches = 0
+    for pixels,(px,wv),(bpx,bwv),(ppx,pwv),(bppx,bpwv),keep in zip(spectra,simplified,batched,prefiltered,batchedPrefiltered,reference):
+        if not (numpy.array_equal(px,pixels[keep]) and numpy.array_equal(wv,wavelengths[keep])
+                and numpy.array_equal(bpx,px) and numpy.array_equal(bwv,wv)
+                and numpy.array_equal(bppx,ppx) and numpy.array_equal(bpwv,pwv)):
+            mismatches += 1
+
+    nSpectra = len(spectra)
+    return {'nPoints': nPoints,
+            'tolerance': tolerance,
+            'nSpectra': nSpectra,
+            'points_kept': numpy.mean([len(px) for px,wv in simplified]),
+            'points_kept_prefilter': numpy.mean([len(px) for px,wv in prefiltered]),
+            'wall_time': wall,
+            'prefilter_wall_time': prefilterWall,
+            'reference_wall_time': referenceWall,
+            'file_wall_time': fileWall,
+            'previous_wall_time': previousWall,
+            'spectra_per_second': nSpectra/wall,
+            'speedup': previousWall/fileWall,
+            'mismatches': mismatches}
+
+def simplifyBenchmark(args):
+    runs = []
+    for nPoints in args.points:
+        for tolerance in args.tolerances:
+            runs.append(simplifyRun(nPoints,tolerance,args.spectra,args.integration_times))
+
+    return {'benchmark': 'simplify',
+            'keys': ['nPoints','tolerance'],
+            'metric': 'spectra_per_second',
+            'settings': {'spectra': args.spectra,
+                         'integrationTimes': args.integration_times},
+            'runs': runs}
+
+def encodingRun(nPoints,encoding,nSpectra,integrationTimes):
+    """encode and decode nSpectra synthetic spectra of nPoints points for
+    each integration time and compare the size with the JSON pixels
+
+    :return: dictionary containing the results"""
+    spectrometer = SimulatedSpectrometer('ENCODING',nPixels=nPoints)
+    spectra = []
+    for integrationTime in integrationTimes:
+        spectrometer.setIntegrationTime(integrationTime)
+        for i in range(nSpectra):
+            spectra.append(spectrometer.readSpectrum())
+
+    t0 = time.time()
+    encoded = [PiccoloEncoding.encodePixels(pixels,encoding) for pixels in spectra]
+    encodeWall = time.time()-t0
+    t0 = time.time()
+    decoded = [PiccoloEncoding.decodePixels(data) for data in encoded]
+    decodeWall = time.time()-t0
+
+    mismatches = 0
+    for pixels,values in zip(spectra,decoded):
+        if not numpy.array_equal(pixels,values):
+            mismatches += 1
+
+    nSpectra = len(spectra)
+    jsonBytes = sum(len(json.dumps(pixels)) for pixels in spectra)
+    encodedBytes = sum(len(data) for data in encoded)
+    return {'nPoints': nPoints,
+            'encoding': encoding,
+            'nSpectra': nSpectra,
+            'json_bytes': jsonBytes/float(nSpectra),
+            'encoded_bytes': encodedBytes/float(nSpectra),
+            'ratio': jsonBytes/float(encodedBytes),
+            'encode_wall_time': encodeWall,
+            'decode_wall_time': decodeWall,
+            'spectra_per_second': nSpectra/encodeWall,
+            'decoded_spectra_per_second': nSpectra/decodeWall,
+            'mismatches': mismatches}
+
+def encodingBenchmark(args):
+    runs = []
+    for nPoints in args.points:
+        for encoding in args.encodings:
+            runs.append(encodingRun(nPoints,encoding,args.spectra,args.integration_times))
+
+    return {'benchmark': 'encoding',
+            'keys': ['nPoints','encoding'],
+            'metric': 'spectra_per_second',
+            'settings': {'spectra': args.spectra,
+                         'integrationTimes': args.integration_times},
+            'runs': runs}
+
+def expect(condition,message):
+    """fail a check unless condition holds"""
+    if not condition:
+        raise AssertionError, message
+
+def checkCounter(tmpdir):
+    """batch counters are recovered from the _batNNNN_ file names when the
+    state file is missing, out of date or corrupt"""
+    run = os.path.join(tmpdir,'run')
+    os.makedirs(run)
+    for name in ['untitled_bat0006_0000.pico','untitled_bat0007_0000.pico',
+                 'untitled_bat0007_0001.pico.gz','untitled_bat0007_0001.light.pico']:
+        open(os.path.join(run,name),'w').close()
+    state = os.path.join(run,PiccoloCounter.STATE)
+
+    # each data directory starts with empty caches like a restarted server
+    n = piccolo.PiccoloDataDir(tmpdir).allocateCounter('run')
+    expect(n == 8,'counter without state file is {}, expected 8'.format(n))
+    datadir = piccolo.PiccoloDataDir(tmpdir)
+    n = [datadir.getNextCounter('run'),datadir.allocateCounter('run'),datadir.allocateCounter('run')]
+    expect(n == [9,9,10],'counters from state file are {}, expected [9, 9, 10]'.format(n))
+
+    with open(state,'w') as out:
+        json.dump({'next':3},out)
+    n = piccolo.PiccoloDataDir(tmpdir).allocateCounter('run')
+    expect(n == 8,'counter with out of date state file is {}, expected 8'.format(n))
+
+    with open(state,'w') as out:
+        out.write('{"ne')
+    n = piccolo.PiccoloDataDir(tmpdir).allocateCounter('run')
+    expect(n == 8,'counter with corrupt state file is {}, expected 8'.format(n))
+
+def checkSpool(tmpdir):
+    """committed batches survive a restart, incomplete ones and torn journal
+    records are dropped and copies failing the CRC check are not published"""
+    spooldir = os.path.join(tmpdir,'spool')
+    data = os.path.join(tmpdir,'data')
+    os.makedirs(data)
+    contents = {}
+
+    def batch(spool,n,commit=True):
+        bid,bdir = spool.newBatch()
+        fname = os.path.join('run','untitled_bat{0:04d}_0000.pico'.format(n))
+        contents[fname] = json.dumps({'batch':n,'pixels':range(1000)})
+        os.makedirs(os.path.join(bdir,'run'))
+        with open(os.path.join(bdir,fname),'w') as out:
+            out.write(contents[fname])
+        if commit:
+            spool.commit(bid)
+        return bid
+
+    spool = PiccoloSpool(spooldir)
+    first = batch(spool,0)
+    incomplete = batch(spool,1,commit=False)
+    second = batch(spool,2)
+    # a crash while appending to the journal leaves a partial record
+    with open(os.path.join(spooldir,PiccoloSpool.JOURNAL),'a') as journal:
+        journal.write('{"op": "done", "ba')
+
+    spool = PiccoloSpool(spooldir)
+    pending = [spool.next(0),spool.next(0),spool.next(0)]
+    expect([b[0] if b is not None else None for b in pending] == [first,second,None],
+           'recovered batches are {}, expected {}'.format(pending,[first,second]))
+    expect(not os.path.exists(spool.batchDir(incomplete)),'uncommitted batch was not removed')
+
+    # corrupt the spooled copy of the first batch without changing its size
+    fname,size,crc = pending[0][1][0]
+    with open(os.path.join(spool.batchDir(first),fname),'r+') as f:
+        f.write('X')
+    flusher = PiccoloFlusher('check',piccolo.PiccoloDataDir(data),spool)
+    try:
+        flusher.flush(*pending[0])
+    except IOError:
+        pass
+    else:
+        raise AssertionError, 'corrupt copy was published'
+    spool.release(first)
+    expect(os.listdir(data) == ['run'] and os.listdir(os.path.join(data,'run')) == [],
+           'corrupt copy left files {}'.format(os.listdir(os.path.join(data,'run'))))
+
+    flusher.flush(*pending[1])
+    fname = pending[1][1][0][0]
+    with open(os.path.join(data,fname),'r') as inf:
+        expect(inf.read() == contents[fname],'flushed copy of {} differs'.format(fname))
+    status = PiccoloSpool(spooldir).status()
+    expect(status['pending'] == 1,'{} batches pending after restart, expected 1'.format(status['pending']))
+
+def checkEncoding(tmpdir):
+    """all pixel encodings round trip and bad input is rejected"""
+    rng = numpy.random.RandomState(0)
+    spectra = [numpy.zeros(0,dtype=numpy.int64),
+               numpy.array([0]),
+               numpy.array([0,2**32-1,0,2**32-1]),
+               numpy.array([-5,3,-(2**40),2**40]),
+               numpy.cumsum(rng.randint(-500,500,2048)),
+               rng.randint(0,200000,1044).astype(numpy.float64)]
+    for encoding in PiccoloEncoding.ENCODINGS:
+        for pixels in spectra:
+            decoded = PiccoloEncoding.decodePixels(PiccoloEncoding.encodePixels(pixels,encoding))
+            expect(numpy.array_equal(decoded,pixels),'{} does not round trip {} pixels'.format(encoding,len(pixels)))
+        spectrum = {'Metadata': {'SerialNumber': 'CHECK'},'Pixels': spectra[4].tolist()}
+        encoded = json.loads(json.dumps(PiccoloEncoding.encodeSpectrum(spectrum,encoding)))
+        expect(PiccoloEncoding.decodeSpectrum(encoded) == spectrum,'{} does not round trip a spectrum'.format(encoding))
+
+    for pixels in [numpy.array([1.5]),numpy.array([numpy.nan]),numpy.zeros((2,2),dtype=int)]:
+        try:
+            PiccoloEncoding.encodePixels(pixels)
+        except ValueError:
+            continue
+        raise AssertionError, 'encoded {}'.format(pixels.tolist())
+    for encoding in ['delta','linear+deflate']:
+        data = PiccoloEncoding.encodePixels(spectra[4],encoding)
+        try:
+            PiccoloEncoding.decodePixels(data[:len(data)//2])
+        except ValueError:
+            continue
+        raise AssertionError, 'decoded truncated {} data'.format(encoding)
+
+def checkArchive(tmpdir):
+    """the pixels, table and metadata rows of the archive stay aligned when a
+    crash loses the last metadata line"""
+    path = os.path.join(tmpdir,'untitled_bat0000.pcol')
+    directions = ['Upwelling','Downwelling']
+
+    def cycle(seqNr):
+        return [({'SerialNumber':'CHECK','Direction':d,'Dark':False,'IntegrationTime':10.,'Batch':0,
+                  'Datetime':'2016-06-01T12:00:{0:02d}'.format(seqNr),'Cycle':seqNr},
+                 numpy.arange(16)+100*seqNr+i) for i,d in enumerate(directions)]
+
+    writer = piccolo.PiccoloArchiveWriter()
+    for seqNr in range(3):
+        writer.append(path,seqNr,cycle(seqNr))
+    writer.close()
+
+    # lose the metadata line of the last cycle of the upwelling array, the
+    # pixels and the table rows made it to disk
+    jsonl = os.path.join(path,'CHECK_Upwelling.jsonl')
+    with open(jsonl,'r') as inf:
+        lines = inf.readlines()
+    with open(jsonl,'w') as out:
+        out.writelines(lines[:-1])
+        out.write(lines[-1][:10])
+
+    writer = piccolo.PiccoloArchiveWriter()
+    writer.append(path,3,cycle(3))
+    writer.close()
+
+    archive = piccolo.PiccoloArchive(path)
+    for i,d in enumerate(directions):
+        name = 'CHECK_{}'.format(d)
+        expected = [0,1,3] if d == 'Upwelling' else [0,1,2,3]
+        table = archive.table(name)
+        pixels = archive.pixels(name)
+        metadata = archive.metadata(name)
+        expect(archive.rows(name) == len(expected),'{} has {} rows, expected {}'.format(name,archive.rows(name),len(expected)))
+        expect(table['SequenceNumber'].tolist() == expected,'{} table rows are {}'.format(name,table['SequenceNumber'].tolist()))
+        expect([m['Cycle'] for m in metadata] == expected,'{} metadata rows are {}'.format(name,[m['Cycle'] for m in metadata]))
+        expect(pixels[:,0].tolist() == [100*s+i for s in expected],'{} pixel rows are {}'.format(name,pixels[:,0].tolist()))
+
+CHECKS = [('counter',checkCounter),
+          ('spool',checkSpool),
+          ('encoding',checkEncoding),
+          ('archive',checkArchive)]
+
+def checkBehaviour(args):
+    tmpdir = args.data_dir
+    if tmpdir is None:
+        tmpdir = os.path.join('/dev/shm','piccolo2_check_{}'.format(os.getpid()))
+    runs = []
+    try:
+        for name,check in CHECKS:
+            if args.checks is not None and name not in args.checks:
+                continue
+            checkdir = os.path.join(tmpdir,name)
+            os.makedirs(checkdir)
+            error = None
+            t0 = time.time()
+            try:
+                check(checkdir)
+            except Exception, e:
+                error = '{}: {}'.format(type(e).__name__,e)
+                print >> sys.stderr, 'check {} failed: {}'.format(name,error)
+            runs.append({'check': name,
+                         'passed': error is None,
+                         'error': error,
+                         'wall_time': time.time()-t0})
+    finally:
+        if not args.keep:
+            shutil.rmtree(tmpdir,ignore_errors=True)
+
+    return {'benchmark': 'check',
+            'keys': ['check'],
+            'metric': 'wall_time',
+            'failures': len([r for r in runs if not r['passed']]),
+            'runs': runs}
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the piccolo server")
+    parser.add_argument('-o','--output',metavar='JSON',help="write results to JSON, default stdout")
+    parser.add_argument('-c','--compare',metavar='JSON',help="compare results with an earlier report")
+    parser.add_argument('-d', '--debug', action='store_true',default=False,help="enable debugging output")
+    parser.add_argument('-l', '--log-file',metavar="FILE",help="send piccolo log to FILE, default stderr")
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    acquisition = subparsers.add_parser('acquisition',help="end-to-end acquisition throughput")
+    acquisition.add_argument('--data-dir',metavar='DIR',help="data directory, default a new directory on /dev/shm")
+    acquisition.add_argument('--keep',action='store_true',default=False,help="keep the data directory")
+    acquisition.add_argument('--cycles',type=intList,default=[1,5,20],metavar='N,N,..',help="number of cycles per batch, default 1,5,20")
+    acquisition.add_argument('--delays',type=floatList,default=[0.],metavar='S,S,..',help="delays between cycles in seconds, default 0")
+    acquisition.add_argument('--spectrometers',type=intList,default=[1,2],metavar='N,N,..',help="number of simulated spectrometers, default 1,2")
+    acquisition.add_argument('--pixels',type=int,default=1024,help="number of pixels per spectrum, default 1024")
+    acquisition.add_argument('--integration-time',type=float,default=10.,metavar='MS',help="integration time in milliseconds, default 10")
+    acquisition.add_argument('--pollers',type=int,default=2,help="number of clients polling the server, default 2")
+    acquisition.add_argument('--spool',metavar='DIR',help="spool batches in DIR before copying them to the data directory")
+    acquisition.add_argument('--fsync',choices=piccolo.PiccoloFileSync.POLICIES,default='batch',help="fsync policy, default batch")
+    acquisition.add_argument('--compression',choices=['none','gzip','zstd'],default='none',help="compression of the spectra files, default none")
+    acquisition.add_argument('--archive',action='store_true',default=False,help="also write the columnar archive of each batch")
+    acquisition.add_argument('--trace',metavar='JSON',help="write Chrome trace of the last batch to JSON")
+    acquisition.add_argument('--trace-events',type=int,default=200000,metavar='N',help="size of the trace buffer, default 200000")
+    acquisition.set_defaults(func=acquisitionBenchmark)
+
+    write = subparsers.add_parser('write',help="latency and throughput of the fsync policies")
+    write.add_argument('--data-dir',metavar='DIR',help="directory to write to, should be on the data device, default a new directory in the current directory")
+    write.add_argument('--keep',action='store_true',default=False,help="keep the files")
+    write.add_argument('--policies',type=lambda s: s.split(','),default=piccolo.PiccoloFileSync.POLICIES,metavar='P,P,..',help="fsync policies, default file,batch,group")
+    write.add_argument('--files',type=intList,default=[1,2,8],metavar='N,N,..',help="number of files per batch, default 1,2,8")
+    write.add_argument('--batches',type=int,default=100,help="number of batches, default 100")
+    write.add_argument('--size',type=int,default=65536,help="size of each file in bytes, default 65536")
+    write.add_argument('--interval',type=float,default=100.,metavar='MS',help="group commit interval in milliseconds, default 100")
+    write.set_defaults(func=writeBenchmark)
+
+    simplify = subparsers.add_parser('simplify',help="speed of the spectra simplification compared to the previous implementation")
+    simplify.add_argument('--points',type=intList,default=[1024,2048,4096],metavar='N,N,..',help="number of points per spectrum, default 1024,2048,4096")
+    simplify.add_argument('--tolerances',type=floatList,default=[2.,10.],metavar='T,T,..',help="simplification thresholds, default 2,10")
+    simplify.add_argument('--spectra',type=int,default=20,help="number of spectra per integration time, default 20")
+    simplify.add_argument('--integration-times',type=floatList,default=[10.,100.,1000.],metavar='MS,MS,..',help="integration times of the simulated spectra in milliseconds, default 10,100,1000")
+    simplify.set_defaults(func=simplifyBenchmark)
+
+    encoding = subparsers.add_parser('encoding',help="size and speed of the pixel transfer encodings")
+    encoding.add_argument('--points',type=intList,default=[1024,2048,4096],metavar='N,N,..',help="number of points per spectrum, default 1024,2048,4096")
+    encoding.add_argument('--encodings',type=lambda s: s.split(','),default=PiccoloEncoding.ENCODINGS,metavar='E,E,..',help="pixel encodings, default all")
+    encoding.add_argument('--spectra',type=int,default=20,help="number of spectra per integration time, default 20")
+    encoding.add_argument('--integration-times',type=floatList,default=[10.,100.,1000.],metavar='MS,MS,..',help="integration times of the simulated spectra in milliseconds, default 10,100,1000")
+    encoding.set_defaults(func=encodingBenchmark)
+
+    check = subparsers.add_parser('check',help="behaviour checks of the counters, spool, encodings and archive")
+    check.add_argument('--data-dir',metavar='DIR',help="scratch directory, must not exist, default a new directory on /dev/shm")
+    check.add_argument('--keep',action='store_true',default=False,help="keep the scratch directory")
+    check.add_argument('--checks',type=lambda s: s.split(','),metavar='C,C,..',help="checks to run, default all of "+','.join(n for n,c in CHECKS))
+    check.set_defaults(func=checkBehaviour)
+
+    args = parser.parse_args()
+
+    piccolo.piccoloLogging(logfile=args.log_file,debug=args.debug)
+    piccolo.StatusLED.start()
+
+    report = args.func(args)
+    report.update({'timestamp': datetime.datetime.now().isoformat(),
+                   'commit': gitCommit(),
+                   'hostname': socket.gethostname(),
+                   'python': platform.python_version()})
+
+    if args.output is None:
+        json.dump(report,sys.stdout,indent=1,sort_keys=True)
+        print
+    else:
+        with open(args.output,'w') as out:
+            json.dump(report,out,indent=1,sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare,'r') as base:
+            compare(json.load(base),report)
+
+    piccolo.StatusLED.stop()
+
+    if report.get('failures',0) > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
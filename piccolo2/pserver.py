@@ -130,10 +130,20 @@ def piccolo_server(serverCfg):
     pc = piccolo.Piccolo('piccolo',pData,shutters,spectrometers,aux,
                          clobber=piccoloCfg.cfg['output']['clobber'],
                          split=piccoloCfg.cfg['output']['split'],
+                         queueSize=piccoloCfg.cfg['output']['queueSize'],
+                         queuePolicy=piccoloCfg.cfg['output']['queuePolicy'],
+                         spooldir=serverCfg.cfg['datadir']['spool'],
+                         fsync=piccoloCfg.cfg['output']['fsync'],
+                         groupCommitInterval=piccoloCfg.cfg['output']['groupCommitInterval'],
+                         compression=piccoloCfg.cfg['output']['compression'],
+                         compressionLevel=piccoloCfg.cfg['output']['compressionLevel'],
+                         archive=piccoloCfg.cfg['output']['archive'],
+                         archiveDtype=piccoloCfg.cfg['output']['archiveDtype'],
+                         cacheSize=serverCfg.cfg['jsonrpc']['cacheSize']*1024*1024,
                          cfg = piccoloCfg.cfg )
     pd.registerComponent(pc)
 
-    pJSONController = piccolo.PiccoloControllerCherryPy()
+    pJSONController = piccolo.PiccoloControllerCherryPy(datadir=pData)
     pd.registerController(pJSONController)
 
     pXBEEController = None
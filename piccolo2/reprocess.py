@@ -0,0 +1,548 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Reprocess the spectra files of a data directory offline.
+
+The tasks use the same code as the server:
+
+ * simplify: write the simplified spectra sidecar files
+ * process: write the derived product files
+ * quicklook: record the quicklook statistics of the files
+ * catalogue: add the spectra to the catalogue
+ * csv: export the spectra of each file and spectrometer to CSV
+ * netcdf: export the spectra of each file to netCDF, needs the netCDF4
+   module
+
+The files are grouped by batch and distributed over a pool of worker
+processes file by file. Only the process task runs on the files of a batch
+in order in a single worker since the derived products of a cycle may use
+the dark spectra of earlier cycles. The workers parse the files and return
+the catalogue rows and quicklook statistics which the main process writes.
+Completed batches are recorded in a journal in the data directory so that an
+interrupted run continues where it stopped. The server should not be
+writing to the data directory at the same time.
+"""
+
+from server.piccoloLogging import piccoloLogging
+from server.PiccoloConfig import PiccoloConfig
+from server.PiccoloDataDir import PiccoloDataDir
+from server.PiccoloPostProcess import PiccoloSimplifyStage
+from server.PiccoloProcessing import PiccoloProcessingStage, BATCHFILE
+from server.PiccoloCatalogue import PiccoloCatalogue, catalogueRows
+from server.PiccoloQuicklook import spectraStatistics
+from server.PiccoloPicoParser import PiccoloPicoParser
+from server.PiccoloFileAccess import PiccoloFileAccess
+from server.PiccoloCompression import splitCompression
+from server.PiccoloFileSync import tmpName
+from server.PiccoloWavelengths import WavelengthGrids
+import argparse
+import csv
+import fnmatch
+import json
+import logging
+import multiprocessing
+import numpy
+import os, os.path
+import signal
+import sys
+import time
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+TASKS = ['simplify','process','quicklook','catalogue','csv','netcdf']
+DEFAULT_TASKS = ['simplify','process','quicklook','catalogue']
+
+def findBatches(top,pattern='*.pico*'):
+    """find the spectra files in directory tree top and group them by batch
+
+    :return: list of batches, each a list of the absolute paths of its files
+             in the order they were recorded"""
+    batches = {}
+    for root,dirs,fnames in os.walk(top):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for f in fnames:
+            if f.startswith('.') or not fnmatch.fnmatch(f,pattern):
+                continue
+            m = BATCHFILE.match(splitCompression(f)[0])
+            if m is None:
+                key,order = (root,f),(0,f)
+            else:
+                # dark files sort before the light files of the same cycle
+                key,order = (root,m.group(1)),(int(m.group(2)),f)
+            batches.setdefault(key,[]).append((order,os.path.join(root,f)))
+    return [[fname for order,fname in sorted(batches[key])] for key in sorted(batches)]
+
+def fileState(fname):
+    """:return: the modification time and size of file fname"""
+    st = os.stat(fname)
+    return [st.st_mtime,st.st_size]
+
+class PiccoloReprocessJournal(object):
+    """record of the batches that have been reprocessed"""
+
+    JOURNAL = '.piccolo_reprocess'
+
+    def __init__(self,datadir,tasks):
+        """
+        :param datadir: the data directory
+        :param tasks: the tasks of the run, batches reprocessed with
+                      different tasks are done again"""
+        self._log = logging.getLogger('piccolo.reprocess')
+        self._datadir = datadir
+        self._name = os.path.join(datadir,self.JOURNAL)
+        self._tasks = sorted(tasks)
+        self._done = {}
+        if os.path.exists(self._name):
+            with open(self._name,'r') as records:
+                for line in records:
+                    try:
+                        record = json.loads(line)
+                        if record['Tasks'] == self._tasks:
+                            self._done[record['Batch']] = record['Files']
+                    except (ValueError,KeyError,TypeError):
+                        # incomplete line written during a crash
+                        self.log.warning('ignoring corrupt record in {}'.format(self._name))
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    def _files(self,batch):
+        return dict((os.path.relpath(f,self._datadir),fileState(f)) for f in batch)
+
+    def done(self,batch):
+        """check whether batch was reprocessed and its files have not
+        changed since"""
+        files = self._done.get(os.path.relpath(batch[0],self._datadir))
+        if files is None:
+            return False
+        try:
+            return files == self._files(batch)
+        except OSError:
+            return False
+
+    def record(self,batch):
+        """record that batch was reprocessed"""
+        with open(self._name,'a') as records:
+            records.write(json.dumps({'Tasks': self._tasks,
+                                      'Batch': os.path.relpath(batch[0],self._datadir),
+                                      'Files': self._files(batch)})+'\n')
+
+    def clear(self):
+        """forget all batches"""
+        self._done = {}
+        if os.path.exists(self._name):
+            os.remove(self._name)
+
+def exportName(fname,datadir,exportDir):
+    """the name of the exported spectra of file fname without suffix"""
+    name = os.path.relpath(splitCompression(fname)[0],datadir)
+    if name.endswith('.pico'):
+        name = name[:-len('.pico')]
+    return os.path.join(exportDir,name)
+
+def spectrumName(meta):
+    """the name of a spectrum within an exported file"""
+    name = meta.get('Direction','')
+    if meta.get('Dark'):
+        name += ' dark'
+    return name
+
+def bySpectrometer(spectra):
+    """group spectra by the serial number of their spectrometer
+
+    :return: sorted list of tuples of the serial number and the spectra"""
+    groups = {}
+    for meta,pixels in spectra:
+        groups.setdefault(meta.get('SerialNumber'),[]).append((meta,pixels))
+    return sorted(groups.items())
+
+def exportCSV(spectra,name):
+    """write the spectra of each spectrometer to CSV file name.SERIAL.csv
+
+    the columns are the pixel, the wavelength and the counts of each
+    spectrum"""
+    for serialNumber,group in bySpectrometer(spectra):
+        nPixels = len(group[0][1])
+        if any(len(pixels) != nPixels for meta,pixels in group):
+            raise ValueError, 'spectra of {} differ in length'.format(serialNumber)
+        wavelengths = WavelengthGrids.grid(group[0][0]['WavelengthCalibrationCoefficients'],nPixels)
+        fname = '{0}.{1}.csv'.format(name,serialNumber)
+        tmp = tmpName(fname)
+        with open(tmp,'wb') as out:
+            writer = csv.writer(out)
+            writer.writerow(['Pixel','Wavelength']+[spectrumName(meta) for meta,pixels in group])
+            columns = [numpy.asarray(pixels).tolist() for meta,pixels in group]
+            for i,w in enumerate(numpy.round(wavelengths,3).tolist()):
+                writer.writerow([i,w]+[c[i] for c in columns])
+        os.rename(tmp,fname)
+
+def exportNetCDF(spectra,seqNr,name):
+    """write the spectra to netCDF file name.nc
+
+    the file has a group for each spectrometer holding the wavelengths and a
+    pixels array with one row per spectrum"""
+    if netCDF4 is None:
+        raise RuntimeError, 'netCDF export needs the netCDF4 module'
+    fname = name+'.nc'
+    tmp = tmpName(fname)
+    ds = netCDF4.Dataset(tmp,'w',format='NETCDF4')
+    try:
+        if seqNr is not None:
+            ds.SequenceNumber = seqNr
+        for serialNumber,group in bySpectrometer(spectra):
+            pixels = numpy.array([p for meta,p in group])
+            g = ds.createGroup(str(serialNumber))
+            g.createDimension('spectrum',len(group))
+            g.createDimension('pixel',pixels.shape[1])
+            v = g.createVariable('wavelength','f8',('pixel',))
+            v.units = 'nm'
+            v[:] = WavelengthGrids.grid(group[0][0]['WavelengthCalibrationCoefficients'],pixels.shape[1])
+            v = g.createVariable('pixels','u4' if pixels.dtype.kind in 'iu' else 'f8',('spectrum','pixel'),zlib=True)
+            v.units = 'counts'
+            v[:] = pixels
+            v = g.createVariable('integration_time','f8',('spectrum',))
+            v.units = 'ms'
+            v[:] = numpy.array([meta.get('IntegrationTime',numpy.nan) for meta,p in group],dtype=numpy.float64)
+            v = g.createVariable('dark','u1',('spectrum',))
+            v[:] = numpy.array([bool(meta.get('Dark')) for meta,p in group],dtype=numpy.uint8)
+            for var,values in [('direction',[meta.get('Direction','') for meta,p in group]),
+                               ('metadata',[json.dumps(meta) for meta,p in group])]:
+                v = g.createVariable(var,str,('spectrum',))
+                for i,value in enumerate(values):
+                    v[i] = value
+    finally:
+        ds.close()
+    os.rename(tmp,fname)
+
+def reprocessJobs(batches,tasks):
+    """split the work on batches into jobs
+
+    the process task is a single job for each batch, the other tasks are a
+    job for each file
+
+    :return: list of tuples of the index of the batch, the task or None for
+             the other tasks and the files of the job"""
+    jobs = []
+    fileTasks = [t for t in tasks if t != 'process']
+    for i,batch in enumerate(batches):
+        if 'process' in tasks:
+            jobs.append((i,'process',batch))
+        if fileTasks:
+            jobs += [(i,None,[fname]) for fname in batch]
+    return jobs
+
+class PiccoloReprocessor(object):
+    """run the tasks on the files of a batch, used by the worker processes"""
+
+    def __init__(self,datadir,tasks,cfg={},exportDir=None):
+        """
+        :param datadir: the data directory
+        :param tasks: the tasks to run
+        :param cfg: the piccolo configuration
+        :param exportDir: the directory the exported files are written to"""
+        self._log = logging.getLogger('piccolo.reprocess')
+        self._datadir = datadir
+        self._tasks = tasks
+        self._exportDir = exportDir
+        self._access = PiccoloFileAccess(maxMappings=1)
+        self._simplifier = None
+        if 'simplify' in tasks:
+            self._simplifier = PiccoloSimplifyStage(cfg.get('SimplifySpectra',{}))
+        self._processing = None
+        if 'process' in tasks:
+            processingCfg = cfg.get('Processing',{})
+            calibration = processingCfg.get('calibration','')
+            if calibration and not os.path.isabs(calibration):
+                calibration = os.path.join(datadir,calibration)
+            self._processing = PiccoloProcessingStage(processingCfg,calibration=calibration)
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    def _read(self,fname):
+        """:return: the sequence number and the list of the metadata and
+                    pixels of the spectra in file fname"""
+        with self._access.mapped(fname) as data:
+            parser = PiccoloPicoParser(data)
+            spectra = [(s.metadata,s.pixels) for s in parser]
+        return parser.fields.get('SequenceNumber'),spectra
+
+    def _runner(self,fname,result):
+        """get a function running a task on file fname that logs and counts
+        errors in result"""
+        def run(task,*args):
+            try:
+                return task(*args)
+            except Exception, e:
+                self.log.error('reprocessing {}: {}'.format(fname,e))
+                result['Errors'] += 1
+        return run
+
+    def process(self,batch):
+        """compute the derived products of the files of batch in order
+
+        :return: list of dictionaries containing the name of each file and
+                 the number of errors"""
+        results = []
+        for fname in batch:
+            result = {'File': fname, 'Errors': 0}
+            self._runner(fname,result)(self._processing,fname)
+            results.append(result)
+        return results
+
+    def reprocess(self,fname):
+        """run the tasks other than process on file fname
+
+        :return: dictionary containing the name of the file, the quicklook
+                 statistics and catalogue rows if requested and the number of
+                 errors"""
+        result = {'File': fname, 'Errors': 0}
+        run = self._runner(fname,result)
+
+        if self._simplifier is not None:
+            run(self._simplifier,fname)
+        if 'catalogue' in self._tasks:
+            result['Catalogue'] = run(catalogueRows,fname,os.path.relpath(fname,self._datadir),self._access)
+        if any(t in self._tasks for t in ['quicklook','csv','netcdf']):
+            read = run(self._read,fname)
+            if read is not None:
+                seqNr,spectra = read
+                if 'quicklook' in self._tasks:
+                    result['Quicklook'] = run(spectraStatistics,spectra)
+                name = exportName(fname,self._datadir,self._exportDir)
+                if not os.path.isdir(os.path.dirname(name)):
+                    run(os.makedirs,os.path.dirname(name))
+                if 'csv' in self._tasks:
+                    run(exportCSV,spectra,name)
+                if 'netcdf' in self._tasks:
+                    run(exportNetCDF,spectra,seqNr,name)
+        return result
+
+    def __call__(self,job):
+        """run a job made by reprocessJobs
+
+        :return: tuple of the index of the batch and the results of the files
+                 of the job"""
+        i,task,files = job
+        if task == 'process':
+            return i,self.process(files)
+        return i,[self.reprocess(fname) for fname in files]
+
+# the reprocessor of a worker process
+_reprocessor = None
+
+def _initWorker(*args):
+    global _reprocessor
+    # the main process handles interrupts and terminates the pool
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+    _reprocessor = PiccoloReprocessor(*args)
+
+def _reprocessJob(job):
+    return _reprocessor(job)
+
+def _interruptible(results):
+    """iterate over the results of a pool waiting with a timeout so that
+    interrupts are delivered to the main process"""
+    while True:
+        try:
+            yield results.next(1.)
+        except multiprocessing.TimeoutError:
+            continue
+        except StopIteration:
+            return
+
+class Progress(object):
+    """report the progress of a run"""
+
+    def __init__(self,nBatches,nFiles,out=sys.stderr):
+        """
+        :param nBatches: the number of batches to be reprocessed
+        :param nFiles: the number of files to be reprocessed
+        :param out: the stream the progress is written to, None to only
+                    count the batches"""
+        self._nBatches = nBatches
+        self._nFiles = nFiles
+        self._out = out
+        self._tty = out is not None and out.isatty()
+        self._start = time.time()
+        self._last = 0.
+        self.batches = 0
+        self.files = 0
+        self.errors = 0
+
+    def update(self,nFiles,nErrors):
+        """count a batch of nFiles files that had nErrors errors"""
+        self.batches += 1
+        self.files += nFiles
+        self.errors += nErrors
+        if self._out is None:
+            return
+        now = time.time()
+        # report at most once a second, or every 10 seconds when the output
+        # is not a terminal
+        if now-self._last < (1. if self._tty else 10.) and self.batches < self._nBatches:
+            return
+        self._last = now
+        rate = self.files/max(now-self._start,1e-6)
+        eta = (self._nFiles-self.files)/rate if rate > 0 else 0.
+        msg = '{0}/{1} batches, {2}/{3} files, {4} errors, {5:.1f} files/s, {6:.0f}s left'.format(
+            self.batches,self._nBatches,self.files,self._nFiles,self.errors,rate,eta)
+        if self._tty:
+            self._out.write('\r'+msg+('\n' if self.batches == self._nBatches else ''))
+        else:
+            self._out.write(msg+'\n')
+        self._out.flush()
+
+def reprocess(datadir,tasks,cfg={},path='',nProcesses=1,exportDir=None,restart=False,progress=True):
+    """reprocess the spectra files in directory tree path of datadir
+
+    :param datadir: the absolute path of the data directory
+    :param tasks: the tasks to run
+    :param cfg: the piccolo configuration
+    :param path: the directory relative to the data directory
+    :param nProcesses: the number of worker processes
+    :param exportDir: the directory the exported files are written to
+    :param restart: reprocess all batches rather than continuing an
+                    interrupted run
+    :param progress: report the progress on stderr
+    :return: dictionary containing the number of batches, files and errors"""
+    log = logging.getLogger('piccolo.reprocess')
+    top = os.path.join(datadir,path)
+    journal = PiccoloReprocessJournal(datadir,tasks)
+    if restart:
+        journal.clear()
+    batches = findBatches(top)
+    todo = [b for b in batches if not journal.done(b)]
+    log.info('reprocessing {} of {} batches in {}'.format(len(todo),len(batches),top))
+
+    jobs = reprocessJobs(todo,tasks)
+    args = (datadir,tasks,cfg,exportDir)
+    # the workers are forked before the catalogue and the data directory are
+    # opened so that they do not inherit the database connection or the
+    # mount watcher thread
+    if nProcesses > 1:
+        pool = multiprocessing.Pool(nProcesses,initializer=_initWorker,initargs=args)
+        results = _interruptible(pool.imap_unordered(_reprocessJob,jobs))
+    else:
+        pool = None
+        reprocessor = PiccoloReprocessor(*args)
+        results = (reprocessor(job) for job in jobs)
+
+    try:
+        dd = PiccoloDataDir(datadir)
+        catalogue = PiccoloCatalogue(dd) if 'catalogue' in tasks else None
+        counter = Progress(len(todo),sum(len(b) for b in todo),out=sys.stderr if progress else None)
+        # the number of outstanding jobs, the number of errors and the
+        # catalogue rows of each batch
+        remaining = {}
+        for i,task,files in jobs:
+            remaining[i] = remaining.get(i,0)+1
+        errors = dict((i,0) for i in remaining)
+        entries = dict((i,[]) for i in remaining)
+
+        for i,files in results:
+            for f in files:
+                errors[i] += f['Errors']
+                if f.get('Catalogue') is not None:
+                    entries[i].append((f['File'],f['Catalogue']))
+                if f.get('Quicklook') is not None:
+                    dd.addQuicklook(f['File'],f['Quicklook'])
+            remaining[i] -= 1
+            if remaining[i] > 0:
+                continue
+            batch = todo[i]
+            if catalogue is not None and entries[i]:
+                try:
+                    catalogue.add(entries[i])
+                except Exception, e:
+                    log.error('cataloguing {}: {}'.format(batch[0],e))
+                    errors[i] += 1
+            if errors[i] == 0:
+                journal.record(batch)
+            counter.update(len(batch),errors[i])
+            del entries[i]
+    except KeyboardInterrupt:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return {'batches': counter.batches,
+            'files': counter.files,
+            'errors': counter.errors,
+            'skipped': len(batches)-len(todo)}
+
+def main():
+    parser = argparse.ArgumentParser(description="reprocess the spectra files of a piccolo data directory")
+    parser.add_argument('datadir',metavar='DIR',help="the data directory")
+    parser.add_argument('-p','--path',default='',help="only reprocess the files in PATH relative to the data directory")
+    parser.add_argument('-t','--tasks',type=lambda s: s.split(','),default=DEFAULT_TASKS,metavar='T,T,..',
+                        help="tasks to run, any of {}, default {}".format(','.join(TASKS),','.join(DEFAULT_TASKS)))
+    parser.add_argument('-j','--jobs',type=int,default=multiprocessing.cpu_count(),help="number of worker processes, default the number of cores")
+    parser.add_argument('-c','--config',metavar='CFG',help="piccolo configuration, default piccolo.config in the data directory if it exists")
+    parser.add_argument('-e','--export-dir',metavar='DIR',help="directory the exported files are written to, default export in the data directory")
+    parser.add_argument('-r','--restart',action='store_true',default=False,help="reprocess all files rather than continuing an interrupted run")
+    parser.add_argument('-q','--quiet',action='store_true',default=False,help="do not report the progress")
+    parser.add_argument('-d', '--debug', action='store_true',default=False,help="enable debugging output")
+    parser.add_argument('-l', '--log-file',metavar="FILE",help="send piccolo log to FILE, default stderr")
+    args = parser.parse_args()
+
+    for t in args.tasks:
+        if t not in TASKS:
+            parser.error('unknown task {}'.format(t))
+    if 'netcdf' in args.tasks and netCDF4 is None:
+        parser.error('the netcdf task needs the netCDF4 module')
+    if args.jobs < 1:
+        parser.error('need at least one job')
+
+    piccoloLogging(logfile=args.log_file,debug=args.debug)
+    log = logging.getLogger('piccolo.reprocess')
+
+    # the data directory is opened by reprocess once the workers are forked
+    datadir = os.path.abspath(args.datadir)
+    piccoloCfg = PiccoloConfig()
+    config = args.config
+    if config is None and os.path.isfile(os.path.join(datadir,'piccolo.config')):
+        config = os.path.join(datadir,'piccolo.config')
+    if config is not None:
+        piccoloCfg.readCfg(config)
+    exportDir = args.export_dir
+    if exportDir is None:
+        exportDir = os.path.join(datadir,'export')
+
+    try:
+        result = reprocess(datadir,args.tasks,cfg=piccoloCfg.cfg.dict(),path=args.path,nProcesses=args.jobs,
+                           exportDir=os.path.abspath(exportDir),restart=args.restart,progress=not args.quiet)
+    except KeyboardInterrupt:
+        print >> sys.stderr, '\ninterrupted, run again to continue'
+        sys.exit(1)
+    log.info('reprocessed {batches} batches, {files} files, {errors} errors, {skipped} batches already done'.format(**result))
+    if result['errors'] > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -27,8 +27,21 @@ from PiccoloDataDir import PiccoloDataDir
 from PiccoloWorkerThread import PiccoloWorkerThread
 from PiccoloSpectrometer import PiccoloSpectraList
 from PiccoloMessages import PiccoloMessages
+from PiccoloOutputQueue import PiccoloOutputQueue
+from PiccoloSpool import PiccoloSpool, PiccoloFlusher
+from PiccoloFileSync import PiccoloFileSync
+from PiccoloTrace import Trace
+from PiccoloLRUCache import PiccoloLRUCache
+from PiccoloWavelengths import WavelengthGrids
+from PiccoloPostProcess import PiccoloPostProcess, PiccoloSimplifyStage
+from PiccoloPicoParser import PiccoloPicoParser
+from PiccoloProcessing import PiccoloProcessingStage
+from PiccoloCatalogue import PiccoloCatalogue
+from PiccoloCompression import COMPRESSIONS, compressionAvailable, compressFile, splitCompression
+from PiccoloQuicklook import spectraStatistics, fileStatistics
+from PiccoloArchive import PiccoloArchiveWriter, archiveName
+from PiccoloEncoding import encodeSpectrum, parseEncoding
 from piccolo2.PiccoloStatus import PiccoloStatus
-import PiccoloSimplify
 import socket
 import psutil
 import subprocess
@@ -38,7 +51,8 @@ from Queue import Queue, Empty
 import time
 import logging
 import os.path, json
-import numpy
+import shutil
+
 class PiccoloThread(PiccoloWorkerThread):
     """worker thread handling a number of shutters and spectrometers"""
 
@@ -63,7 +77,11 @@ class PiccoloThread(PiccoloWorkerThread):
 
     def _getCommands(self,block=True):
         try:
-            cmd = self.tasks.get(block=block)
+            if block:
+                with Trace.span('queue wait'):
+                    cmd = self.tasks.get(block=block)
+            else:
+                cmd = self.tasks.get(block=block)
         except Empty:
             return
 
@@ -118,16 +136,15 @@ class PiccoloThread(PiccoloWorkerThread):
                 return cmd
 
     def getCounter(self,key):
+        counter = self._datadir.allocateCounter(key)
         if key not in self._outCounter:
-            self._outCounter[key] = self._datadir.getNextCounter(key)
-            if self._outCounter[key] > 0:
-                self.log.warn('spectra index set to %d'%self._outCounter[key])
+            if counter > 0:
+                self.log.warn('spectra index set to %d'%counter)
                 self._file_incremented.set()
             else:
                 self._file_incremented.clear()
-        else:
-            self._outCounter[key] += 1
-        return self._outCounter[key]
+        self._outCounter[key] = counter
+        return counter
 
     def autoIntegrate(self):
         # close all shutters
@@ -160,6 +177,7 @@ class PiccoloThread(PiccoloWorkerThread):
         else:
             direction = 'downwelling'
         self.log.info("Record {0} {1} spectra".format(darkStr,direction))
+        Trace.begin('record',args={'dark':dark,'direction':direction})
 
         # open/close shutters as required
         for shutter in self._shutters:
@@ -177,15 +195,17 @@ class PiccoloThread(PiccoloWorkerThread):
             spectra.append(self._spectrometers[s].getSpectrum())
 
         self._shutters[direction].closeShutter()
+        Trace.end('record')
         return spectra
 
     def makeAuxMeasurements(self,instruments=None):
         """Collect one recording from each auxiliary instrument
         """
         measurements = {}
-        for key in self._aux:
-            if instruments is None or key in instruments:
-                measurements[key] = self._aux[key].getRecord()
+        with Trace.span('aux'):
+            for key in self._aux:
+                if instruments is None or key in instruments:
+                    measurements[key] = self._aux[key].getRecord()
 
         return measurements
 
@@ -218,6 +238,7 @@ class PiccoloThread(PiccoloWorkerThread):
             # start recording
             self.log.info("start recording {}".format(nCycles))
             self.busy.acquire() # Lock the Piccolo thread, to prevent recording whilst already recording.
+            Trace.begin('batch',args={'outDir':outDir,'nCycles':nCycles})
 
             n = 0 # n is the sequence number. The first sequence is 0, the last is nCycles-1.
             # Work out the output filename.
@@ -232,7 +253,8 @@ class PiccoloThread(PiccoloWorkerThread):
                     break
                 if n>1 and delay>0:
                     self.log.info('waiting for {} seconds'.format(delay))
-                    time.sleep(delay)
+                    with Trace.span('delay'):
+                        time.sleep(delay)
                     # check for abort/shutdown
                     cmd = self._getCommands(block=False)
                     if cmd=='abort':
@@ -281,12 +303,35 @@ class PiccoloThread(PiccoloWorkerThread):
                 self.results.put(spectra)
                 self.log.info('finished acquisition {0}/{1}'.format(n,nCycles))
 
+            Trace.end('batch')
             self.busy.release()
 
 class PiccoloOutput(threading.Thread):
     """piccolo writer thread"""
 
-    def __init__(self,name,datadir,spectra,clobber=True,daemon=True,split=True):
+    # hidden directory in the data directory where files are written before
+    # they are renamed
+    STAGING = '.staging'
+
+    def __init__(self,name,datadir,spectra,clobber=True,daemon=True,split=True,spool=None,sync=None,
+                 compression=None,compressionLevel=6,archive=None):
+        """
+        :param name: name of the thread
+        :param datadir: the data directory
+        :type datadir: PiccoloDataDir
+        :param spectra: queue of spectra to be written
+        :param clobber: overwrite existing files when set to True
+        :param split: split files into dark and light spectra when set to True
+        :param spool: write spectra to spool instead of the data directory
+        :type spool: PiccoloSpool
+        :param sync: publishes files written to the data directory, defaults
+                     to the batch fsync policy
+        :type sync: PiccoloFileSync
+        :param compression: compress the files with gzip or zstd
+        :param compressionLevel: the compression level
+        :param archive: also append the spectra written to the data directory
+                        to the columnar archive of their batch
+        :type archive: PiccoloArchiveWriter"""
         assert isinstance(spectra,Queue)
 
         threading.Thread.__init__(self)
@@ -300,23 +345,144 @@ class PiccoloOutput(threading.Thread):
         self._datadir = datadir
         self._clobber = clobber
         self._split = split
+        self._spool = spool
+        if sync is None:
+            sync = PiccoloFileSync()
+        self._sync = sync
+        self._compression = compression
+        self._compressionLevel = compressionLevel
+        self._archive = archive
+        self._nStaged = 0
 
     @property
     def log(self):
         return self._log
 
+    def _compress(self,directory):
+        """compress the files written to directory
+
+        the files are compressed in chunks, the uncompressed files are removed
+        before they are flushed to disk"""
+        if self._compression is None:
+            return
+        suffix = COMPRESSIONS[self._compression]
+        for root,dirs,fnames in os.walk(directory):
+            for f in fnames:
+                fname = os.path.join(root,f)
+                with Trace.span('compress',args={'file':fname}):
+                    compressFile(fname,fname+suffix,method=self._compression,level=self._compressionLevel)
+                os.remove(fname)
+
+    def _cleanStaging(self):
+        """remove files left in the staging area by an unclean shutdown"""
+        try:
+            staging = os.path.join(self._datadir.datadir,self.STAGING)
+        except RuntimeError:
+            return
+        if os.path.isdir(staging):
+            self.log.warning('removing incomplete files from {}'.format(staging))
+            shutil.rmtree(staging,ignore_errors=True)
+
+    def _writeDirect(self,spectra,stats):
+        """write spectra to the staging area of the data directory and
+        atomically move the files into place once they are on disk
+
+        :param stats: the quicklook statistics of the spectra"""
+        datadir = self._datadir.datadir
+        stage = os.path.join(datadir,self.STAGING,'{0}_{1:06d}'.format(self.name,self._nStaged))
+        self._nStaged += 1
+        self.log.info('writing {} to {}'.format(spectra.outName,datadir))
+        try:
+            spectra.write(prefix=stage,clobber=True,split=self._split)
+            self._compress(stage)
+            published = []
+            for root,dirs,fnames in os.walk(stage):
+                for f in fnames:
+                    tmp = os.path.join(root,f)
+                    final = os.path.join(datadir,os.path.relpath(tmp,stage))
+                    if os.path.exists(final) and not self._clobber:
+                        self.log.error('not overwriting {}'.format(final))
+                        continue
+                    d = os.path.dirname(final)
+                    if not os.path.isdir(d):
+                        os.makedirs(d)
+                    published.append((tmp,final))
+            self._sync.publish(published,
+                               callback=lambda error: self._published(spectra,stage,published,stats,error))
+        except:
+            shutil.rmtree(stage,ignore_errors=True)
+            raise
+
+    def _published(self,spectra,stage,published,stats,error):
+        """called once the files in the staging directory have been published"""
+        if error is not None:
+            self.log.error('writing {}: {}'.format(spectra.outName,error))
+            self._datadir.invalidate()
+        else:
+            for tmp,final in published:
+                self._datadir.addQuicklook(final,fileStatistics(final,stats))
+                self._datadir.fileWritten(final)
+            self._appendArchive(spectra)
+        shutil.rmtree(stage,ignore_errors=True)
+
+    def _appendArchive(self,spectra):
+        """append the spectra to the archive of their batch"""
+        if self._archive is None:
+            return
+        name = archiveName(spectra.outName)
+        if name is None:
+            return
+        try:
+            with Trace.span('archive',args={'name':name[0]}):
+                self._archive.append(self._datadir.join(name[0]),name[1],
+                                     [(s,s.pixels) for s in spectra])
+        except (IOError,OSError), e:
+            self.log.error('archiving {}: {}'.format(spectra.outName,e))
+            self._archive.close()
+
+    def write(self,spectra):
+        """write a list of spectra to the data directory or the spool
+
+        :param spectra: the spectra to be written
+        :type spectra: PiccoloSpectraList"""
+        Trace.begin('write',args={'name':spectra.outName})
+        if self._spool is None:
+            # the statistics of spooled spectra are computed from the files
+            # once they are requested
+            with Trace.span('quicklook'):
+                stats = spectraStatistics([(s,s.pixels) for s in spectra])
+            try:
+                self._writeDirect(spectra,stats)
+            except (IOError,OSError,RuntimeError,ValueError), e:
+                self.log.error('writing {}: {}'.format(spectra.outName,e))
+                self._datadir.invalidate()
+        else:
+            bid,bdir = self._spool.newBatch()
+            self.log.info('spooling {} to {}'.format(spectra.outName,bdir))
+            try:
+                spectra.write(prefix=bdir,clobber=True,split=self._split)
+                self._compress(bdir)
+                self._spool.commit(bid)
+            except (IOError,OSError,RuntimeError,ValueError), e:
+                self.log.error('spooling {}: {}'.format(spectra.outName,e))
+                self._spool.abandon(bid)
+        Trace.end('write')
+
     def run(self):
+        if self._spool is None:
+            self._cleanStaging()
         while True:
             spectra = self._spectraQ.get()
             if spectra == None:
                 self.log.info('shutting down')
+                self._sync.flush()
+                if self._archive is not None:
+                    self._archive.close()
+                self._spectraQ.task_done()
                 return
 
-            self.log.info('writing {} to {}'.format(spectra.outName,self._datadir.datadir))
-            try:
-                spectra.write(prefix=self._datadir.datadir,clobber=self._clobber,split=self._split)
-            except RuntimeError, e:
-                self.log.error('writing {} to {}: {}'.format(spectra.outName,self._datadir.datadir,e))
+            self.write(spectra)
+            self._spectraQ.task_done()
 
 
 class Piccolo(PiccoloInstrument):
@@ -324,7 +490,10 @@ class Piccolo(PiccoloInstrument):
 
     the piccolo server itself is treated as an instrument"""
 
-    def __init__(self,name,datadir,shutters,spectrometers,auxiliaries,clobber=True,split=True,cfg={}):
+    def __init__(self,name,datadir,shutters,spectrometers,auxiliaries,clobber=True,split=True,
+                 queueSize=10,queuePolicy='block',spooldir=None,fsync='batch',
+                 groupCommitInterval=100,cacheSize=32*1024*1024,compression='none',compressionLevel=6,
+                 archive=False,archiveDtype='uint32',cfg={}):
         """
         :param name: name of the component
         :param datadir: data directory
@@ -334,13 +503,44 @@ class Piccolo(PiccoloInstrument):
         :param spectrometers: dictionary of attached spectrometers
         :type spectrometers: dict(PiccoloSpectrometer)
         :param clobber: overwrite exciting files when set to True
-        :param split: split files into dark and light spectra when set to True"""
+        :param split: split files into dark and light spectra when set to True
+        :param queueSize: maximum number of batches waiting to be written
+        :param queuePolicy: block, spill or drop batches when the output queue is full
+        :param spooldir: local directory used for spooling batches before
+                         they are copied to the data directory
+        :param fsync: when files written to the data directory are flushed
+                      to disk, one of file, batch or group
+        :param groupCommitInterval: interval in milliseconds between group
+                                    commits when fsync is group
+        :param cacheSize: maximum size in bytes of the cache of parsed
+                          spectra files
+        :param compression: compress spectra files using none, gzip or zstd
+        :param compressionLevel: the compression level
+        :param archive: also write the spectra of each batch to a binary
+                        columnar archive
+        :param archiveDtype: the type of the pixels in the archive, uint32
+                             or float32"""
 
         assert isinstance(datadir,PiccoloDataDir)
         PiccoloInstrument.__init__(self,name)
         self._datadir = datadir
 
-        self._spectraCache = (None,None)
+        # parsed spectra files, entries are invalidated when a file is
+        # written again
+        self._spectraCache = PiccoloLRUCache(maxBytes=cacheSize)
+        self._datadir.addWriteListener(self._spectraCache.invalidate)
+
+        self._simplifier = PiccoloSimplifyStage(cfg.get('SimplifySpectra',{}))
+        processingCfg = cfg.get('Processing',{})
+        # the calibration directory is resolved when it is used as the data
+        # directory may not be mounted yet
+        self._processing = PiccoloProcessingStage(processingCfg,resolve=self._datadir.join,
+                                                  written=self._datadir.fileWritten)
+
+        if cfg.get('Catalogue',{}).get('enabled',False):
+            self._catalogue = PiccoloCatalogue(self._datadir)
+        else:
+            self._catalogue = None
 
         self._spectrometers = spectrometers.keys()
         self._spectrometers.sort()
@@ -367,16 +567,66 @@ class Piccolo(PiccoloInstrument):
         self._busy = threading.Lock()
         self._paused = threading.Lock()
         self._tQ = Queue()
-        self._rQ = Queue()
+        spilldir = None
+        if queuePolicy == 'spill':
+            if spooldir is None:
+                self.log.warning('no spool directory configured, blocking when output queue is full')
+                queuePolicy = 'block'
+            else:
+                spilldir = os.path.join(spooldir,'spill')
+        self._rQ = PiccoloOutputQueue(maxsize=queueSize,policy=queuePolicy,spooldir=spilldir)
+        self._dropped = 0
+        self._mountLost = self._datadir.mountLost
         self._aQ = Queue()
         self._file_incremented = threading.Event()
         self._worker = PiccoloThread(name,self._datadir,shutters,spectrometers,auxiliaries,self._busy,self._paused,self._tQ,self._rQ, self._aQ,self._file_incremented)
         self._worker.start()
 
         # handling the output thread
-        self._output = PiccoloOutput(name,self._datadir,self._rQ,clobber=clobber,split=split)
+        self._sync = PiccoloFileSync(policy=fsync,interval=groupCommitInterval)
+        if spooldir is None:
+            self._spool = None
+        else:
+            self._spool = PiccoloSpool(spooldir)
+            self._flusher = PiccoloFlusher(name,self._datadir,self._spool,clobber=clobber,sync=self._sync)
+            self._flusher.start()
+        if compression == 'none':
+            compression = None
+        elif not compressionAvailable(compression):
+            self.log.warning('{} compression is not available, using gzip'.format(compression))
+            compression = 'gzip'
+        if compression == 'gzip' and not 1 <= compressionLevel <= 9:
+            # the configuration allows the zstd levels
+            compressionLevel = min(max(compressionLevel,1),9)
+            self.log.warning('gzip compression levels are 1-9, using {}'.format(compressionLevel))
+        archiveWriter = None
+        if archive:
+            if self._spool is None:
+                archiveWriter = PiccoloArchiveWriter(dtype=archiveDtype)
+            else:
+                self.log.warning('the columnar archive is not written when spooling')
+        self._output = PiccoloOutput(name,self._datadir,self._rQ,clobber=clobber,split=split,
+                                     spool=self._spool,sync=self._sync,
+                                     compression=compression,compressionLevel=compressionLevel,
+                                     archive=archiveWriter)
         self._output.start()
 
+        # precompute simplified spectra and derived products and catalogue
+        # the spectra in the background
+        stages = []
+        if cfg.get('SimplifySpectra',{}).get('precompute',False):
+            stages.append(self._simplifier)
+        if processingCfg.get('precompute',False):
+            stages.append(self._processing)
+        if self._catalogue is not None:
+            stages.append(self._catalogue)
+        if len(stages) > 0:
+            self._postProcess = PiccoloPostProcess(name,stages)
+            self._datadir.addWriteListener(self._postProcess.add)
+            self._postProcess.start()
+        else:
+            self._postProcess = None
+
     def getListenerID(self):
         """get a listener ID for use with messages"""
         return self._messages.newListener()
@@ -525,6 +775,24 @@ class Piccolo(PiccoloInstrument):
     def pause(self):
         self._tQ.put('pause')
 
+    def stop(self):
+        """stop the worker, output, flusher, group commit and post processing
+        threads and wait for them to finish"""
+        self._tQ.put(None)
+        self._worker.join()
+        self._rQ.put(None)
+        self._output.join()
+        if self._spool is not None:
+            self._flusher.stop()
+            self._flusher.join()
+        self._sync.stop()
+        if self._sync.policy == 'group':
+            self._sync.join()
+        if self._postProcess is not None:
+            self._postProcess.stop()
+            self._postProcess.join()
+        return PiccoloInstrument.stop(self)
+
     def status(self,listener=None):
         """return status of shutter
 
@@ -542,6 +810,16 @@ class Piccolo(PiccoloInstrument):
             self._messages.warning("avoided overwriting existing file by incrementing file number")
             self._file_incremented.clear()
 
+        dropped = self._rQ.dropped
+        if dropped > self._dropped:
+            self._messages.error("output queue full, dropped %d batches"%(dropped-self._dropped))
+            self._dropped = dropped
+
+        mountLost = self._datadir.mountLost
+        if mountLost > self._mountLost:
+            self._messages.error("data directory is no longer available")
+            self._mountLost = mountLost
+
         try:
             self._status.new_message = self._messages.status(listener)
         except:
@@ -571,7 +849,31 @@ class Piccolo(PiccoloInstrument):
             info['datadir'] = self._datadir.datadir
         else:
             info['datadir'] = 'not mounted'
+        info['output'] = self.outputStatus()
+        info['fileAccess'] = self._datadir.fileAccessStatus()
+        info['spectraCache'] = self._spectraCache.status()
+        info['wavelengthGrids'] = WavelengthGrids.status()
+        if self._processing.resampler is not None:
+            info['resampler'] = self._processing.resampler.status()
+        if self._postProcess is not None:
+            info['postProcess'] = self._postProcess.status()
         return info
+
+    def outputStatus(self):
+        """get the state of the output queue
+
+        :returns: dictionary containing the policy, the queue depth, the
+                  number of spilled and dropped batches and the age in
+                  seconds of the oldest batch not yet written and the state
+                  of the spool
+        :rtype: dict"""
+        status = self._rQ.status()
+        if self._spool is not None:
+            status['spool'] = self._spool.status()
+            status['spool']['error'] = self._flusher.error
+            if status['oldest'] is None or status['spool']['oldest'] > status['oldest']:
+                status['oldest'] = status['spool']['oldest']
+        return status
     
     def setSpectrometerEnabledStatus(self,spectrometer=None,enabled=False):
         """Enable or disable a spectrometer for recording
@@ -582,56 +884,248 @@ class Piccolo(PiccoloInstrument):
     def getSpectraList(self,outDir='spectra',haveNFiles=0):
         return self._datadir.getFileList(outDir,haveNFiles=haveNFiles)
 
-    def getSpectra(self,fname='',chunk=None,simplify=False):
-        data = self._datadir.getFileData(fname)
+    def getSpectraChanges(self,outDir='spectra',since=0,limit=None):
+        """get the spectra files written to outDir since the last call
+
+        :param outDir: the output directory
+        :param since: the sequence number returned by the previous call, 0
+                      to get all files
+        :param limit: return at most limit files
+        :return: dictionary containing the list of files and the sequence
+                 number to pass to the next call"""
+        files,nxt = self._datadir.getChanges(outDir,since=since,limit=limit)
+        return {'files': files, 'next': nxt}
+
+    def getQuicklook(self,outDir='spectra',since=0,limit=None):
+        """get the quicklook statistics of the spectra files written to
+        outDir since the last call
+
+        the peak and mean counts, the number of saturated pixels, the
+        integration time, direction, dark flag and time of each spectrum
+        are available without reading the spectra files
+
+        :param outDir: the output directory
+        :param since: the sequence number returned by the previous call, 0
+                      to get all files
+        :param limit: return at most limit files
+        :return: dictionary containing the list of files with the statistics
+                 of their spectra and the sequence number to pass to the next
+                 call"""
+        files,nxt = self._datadir.getQuicklook(outDir,since=since,limit=limit)
+        return {'files': files, 'next': nxt}
+
+    def querySpectra(self,outDir=None,serialNumber=None,direction=None,dark=None,start=None,end=None,
+                     minSaturation=None,since=0,limit=100):
+        """find spectra in the catalogue
+
+        :param outDir: only spectra in this output directory
+        :param serialNumber: only spectra of this spectrometer
+        :param direction: only Upwelling or Downwelling spectra
+        :param dark: only dark or light spectra
+        :param start: only spectra recorded at or after this ISO time
+        :param end: only spectra recorded before this ISO time
+        :param minSaturation: only spectra whose peak reaches this fraction
+                              of the saturation level
+        :param since: the sequence number returned by the previous call, 0
+                      to start from the beginning
+        :param limit: return at most limit spectra
+        :return: dictionary containing the list of spectra and the sequence
+                 number to pass to the next call. The File and Chunk of a
+                 spectrum can be passed to getSpectra"""
+        if self._catalogue is None:
+            raise RuntimeError, 'the catalogue is disabled'
+        spectra,nxt = self._catalogue.query(outDir=outDir,serialNumber=serialNumber,direction=direction,
+                                            dark=dark,start=start,end=end,minSaturation=minSaturation,
+                                            since=since,limit=limit)
+        return {'spectra': spectra, 'next': nxt}
+
+    def querySpectraRegion(self,south,west,north,east,since=0,limit=1000):
+        """find the spectra recorded within a bounding box
+
+        :param south: the southern latitude of the box
+        :param west: the western longitude of the box
+        :param north: the northern latitude of the box
+        :param east: the eastern longitude of the box
+        :param since: the sequence number returned by the previous call, 0
+                      to start from the beginning
+        :param limit: return at most limit spectra
+        :return: dictionary containing the list of references to the spectra
+                 and the sequence number to pass to the next call"""
+        if self._catalogue is None:
+            raise RuntimeError, 'the catalogue is disabled'
+        spectra,nxt = self._catalogue.region(south,west,north,east,since=since,limit=limit)
+        return {'spectra': spectra, 'next': nxt}
+
+    def querySpectraNearest(self,lat,lon,n=10,maxDistance=None):
+        """find the spectra recorded nearest a position
+
+        :param lat: the latitude of the position
+        :param lon: the longitude of the position
+        :param n: the number of spectra
+        :param maxDistance: only spectra within maxDistance metres
+        :return: list of references to the spectra sorted by distance"""
+        if self._catalogue is None:
+            raise RuntimeError, 'the catalogue is disabled'
+        return self._catalogue.nearest(lat,lon,n=n,maxDistance=maxDistance)
+
+    def querySpectraTrack(self,track,width=50.,limit=None):
+        """find the spectra recorded along a track
+
+        :param track: list of the latitude and longitude of each vertex of
+                      the track
+        :param width: only spectra within width metres of the track
+        :param limit: return at most limit spectra
+        :return: list of references to the spectra sorted by the distance
+                 along the track"""
+        if self._catalogue is None:
+            raise RuntimeError, 'the catalogue is disabled'
+        return self._catalogue.alongTrack(track,width=width,limit=limit)
+
+    def indexSpectra(self,outDir='spectra'):
+        """add the existing spectra files in outDir to the catalogue
+
+        files already in the catalogue are skipped unless they changed
+
+        :param outDir: the directory relative to the data directory
+        :return: dictionary containing the number of files and spectra added"""
+        if self._catalogue is None:
+            raise RuntimeError, 'the catalogue is disabled'
+        nFiles,nSpectra = self._catalogue.bulkIndex(outDir)
+        return {'files': nFiles, 'spectra': nSpectra}
+
+    def getSpectra(self,fname='',chunk=None,simplify=False,offset=0,length=None,maxPoints=None,maxBytes=None,
+                   encoding=None):
+        """get the contents of a spectra file
+
+        compressed files are decompressed, the byte ranges refer to the
+        decompressed contents
+
+        :param fname: the file relative to the data directory
+        :param chunk: return the spectrum with this index only, the spectra
+                      are read from the file one at a time
+        :param simplify: simplify the spectra of the chunk
+        :param offset: the first byte of the file to return when no chunk is
+                       requested
+        :param length: the number of bytes to return when no chunk is
+                       requested, the remainder of the file if None
+        :param maxPoints: simplify the spectra to at most maxPoints points
+                          each
+        :param maxBytes: simplify the spectra so that the pixels and
+                         wavelengths of each spectrum take at most maxBytes
+                         bytes
+        :param encoding: encode the pixels of the chunk, eg delta+deflate,
+                         see PiccoloEncoding"""
+        if encoding is not None:
+            if chunk is None:
+                raise ValueError, 'pixels can only be encoded when a chunk is requested'
+            parseEncoding(encoding)
+        budget = (maxPoints,maxBytes)
+        simplify = simplify or budget != (None,None)
         if chunk == None:
-            return data
+            if simplify:
+                data = self.getSimplifiedData(fname,maxPoints=maxPoints,maxBytes=maxBytes)
+                return data[offset:] if length is None else data[offset:offset+length]
+            return self._datadir.getFileData(fname,offset=offset,length=length)
         else:
-            if fname != self._spectraCache[0]:
-                if simplify: 
-                    self.log.info("SimplifySpectra")
-                    data = self.simplifySpectra(data)
-        
-                self._spectraCache = (fname,PiccoloSpectraList(data=data))
-            return self._spectraCache[1].getChunk(chunk)
-
-    def simplifySpectra(self, data):
-        jdata = json.loads(data)
-
-        piccoloData = {
-            "SequenceNumber": jdata['SequenceNumber'],
-            "Spectra": jdata['Spectra']
-        }
-        
-        for s in piccoloData['Spectra']:
-            meta            = s['Metadata']
-            pixels          = s['Pixels']
-            serialNumber    = meta['SerialNumber']
-            dark            = meta['Dark']
-            direction       = meta["Direction"]
-
-            WavelengthCalibrationCoefficients = meta['WavelengthCalibrationCoefficients']
-            wcc = WavelengthCalibrationCoefficients
-
-            s['Pixels'] = numpy.asarray(s['Pixels'],dtype=numpy.float32)
-            isize = s['Pixels'].size
-            wavelengths = numpy.poly1d(wcc[::-1])(numpy.arange(s['Pixels'].size))
-            threshold = 10
-            if "QEP" in serialNumber:
-                self.log.info("Using lower simplification threshold for {0}".format(serialNumber))
-                threshold=2
-
-            simple_px,simple_wv = PiccoloSimplify.simplify(s['Pixels'],wavelengths,threshold)
-            simple_px = numpy.round(simple_px,2).tolist()
-
-            s['Metadata']['Wavelengths'] = numpy.round(simple_wv,3).tolist()
-            del s['Metadata']['WavelengthCalibrationCoefficients']
-            s['Pixels'] = numpy.round(simple_px,2).tolist()
-            osize = len(s['Pixels'])
-
-            self.log.info("Simplified {0} {1} {2} from {3} pts to {4} pts".format(serialNumber, direction, dark, isize, osize))
-
-        return piccoloData
+            path = self._datadir.join(fname)
+            params = (self._simplifier.key,budget) if simplify else None
+            key = (path,os.path.getmtime(path),simplify,params)
+            entry = self._spectraCache.get(key)
+            if entry is None:
+                # keep the byte ranges of the spectra, and the simplified
+                # spectra which are much smaller than the file
+                if simplify:
+                    data = self.getSimplifiedData(fname,maxPoints=maxPoints,maxBytes=maxBytes)
+                    parser = PiccoloPicoParser(data)
+                    ranges = [(s.start,s.end) for s in parser]
+                    size = len(data)
+                else:
+                    data = None
+                    with self._datadir.mapped(fname) as mapping:
+                        parser = PiccoloPicoParser(mapping)
+                        ranges = [(s.start,s.end) for s in parser]
+                        if splitCompression(path)[1]:
+                            # compressed files are decompressed into memory,
+                            # keep the data rather than decompressing the
+                            # file again for every chunk
+                            data = mapping
+                    size = len(data) if data is not None else 0
+                entry = (data,parser.fields['SequenceNumber'],ranges)
+                self._spectraCache.put(key,entry,size+64*len(ranges))
+            data,seqNr,ranges = entry
+            start,end = ranges[chunk]
+            if data is None:
+                spectrum = self._datadir.getFileData(fname,offset=start,length=end-start)
+            else:
+                spectrum = data[start:end]
+            if encoding is not None:
+                return json.dumps(encodeSpectrum(json.loads(spectrum),encoding))
+            spectra = PiccoloSpectraList(data='{{"SequenceNumber": {0}, "Spectra": [{1}]}}'.format(json.dumps(seqNr),spectrum))
+            return spectra.getChunk(0)
+
+    def getSimplifiedData(self,fname,maxPoints=None,maxBytes=None):
+        """get the simplified spectra of a file from its sidecar file or by
+        simplifying them now
+
+        :param fname: the file relative to the data directory
+        :param maxPoints: the maximum number of points per spectrum
+        :param maxBytes: the maximum size of the pixels and wavelengths of
+                         each spectrum
+        :return: the simplified spectra in JSON format"""
+        if maxPoints is None and maxBytes is None:
+            data = self._simplifier.load(self._datadir.join(fname))
+            if data is not None:
+                return data
+        self.log.info("SimplifySpectra")
+        with self._datadir.mapped(fname) as data:
+            return json.dumps(self.simplifySpectra(data,maxPoints=maxPoints,maxBytes=maxBytes))
+
+    def simplifySpectra(self,data,maxPoints=None,maxBytes=None):
+        """simplify the spectra contained in data
+
+        :param data: the contents of a spectra file as a string or a memory
+                     mapping
+        :param maxPoints: the maximum number of points per spectrum
+        :param maxBytes: the maximum size of the pixels and wavelengths of
+                         each spectrum
+        :return: the simplified spectra"""
+        return self._simplifier.simplify(data,maxPoints=maxPoints,maxBytes=maxBytes)
+
+    def getDerived(self,fname,merged=False):
+        """get the reflectance and radiance of a spectra file
+
+        the derived products are computed now unless they have been
+        precomputed
+
+        :param fname: the spectra file relative to the data directory
+        :param merged: only get the spectra of all spectrometers merged on
+                       the common wavelength grid
+        :return: the derived products in JSON format"""
+        path = self._datadir.join(fname)
+        key = (path,os.path.getmtime(path),'derived',merged)
+        data = self._spectraCache.get(key)
+        if data is None:
+            data = self._processing.load(path)
+            if data is None:
+                self.log.info("getDerived")
+                derived = self._processing.process(path)
+                if derived is None:
+                    raise RuntimeError, 'no derived products, {} only contains dark spectra'.format(fname)
+                data = json.dumps(derived)
+            if merged:
+                derived = json.loads(data)
+                data = json.dumps({'SequenceNumber': derived['SequenceNumber'],
+                                   'Merged': derived.get('Merged')})
+            self._spectraCache.put(key,data,len(data))
+        return data
+
+    def dumpTrace(self,clear=False):
+        """get the acquisition trace
+
+        :param clear: clear the trace buffer
+        :returns: the trace in Chrome trace event format
+        :rtype: dict"""
+        return Trace.chromeTrace(clear=clear)
 
     def getClock(self):
         """get the current date and time
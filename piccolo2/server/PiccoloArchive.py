@@ -0,0 +1,291 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Binary columnar archive of the spectra of a batch.
+
+The archive of a batch is a directory next to the spectra files, eg
+untitled_bat0000.pcol. The spectra of each spectrometer and direction form
+an array with one row per spectrum which is stored in three files:
+
+ * NAME.pixels: the pixels as raw little endian uint32 or float32 values,
+   one row after the other
+ * NAME.table: a table with one record per row, see TABLE
+ * NAME.jsonl: the complete metadata of each row as JSON, one line per row
+
+where NAME is the serial number and the direction, eg QEP00114_Upwelling.
+index.json describes the arrays. The rows are appended as the cycles are
+written, the number of complete rows is given by the shortest of the pixel
+and table files. The pixels and the table can be mapped with numpy.memmap
+without any parsing, PiccoloArchive does this.
+"""
+
+__all__ = ['PiccoloArchive','PiccoloArchiveWriter']
+
+from PiccoloFileSync import tmpName
+import calendar
+import datetime
+import json
+import logging
+import numpy
+import os, os.path
+import re
+import threading
+
+SUFFIX = '.pcol'
+# the batch and the sequence number in the name of a spectra file
+OUTNAME = re.compile(r'^(.*)_(\d+)\.pico$')
+INDEX = 'index.json'
+VERSION = 1
+
+# the record of each row, Time is the Datetime metadata in seconds since the
+# epoch taken as UTC, nan if it is missing
+TABLE = numpy.dtype([('SequenceNumber','<i8'),
+                     ('Batch','<i8'),
+                     ('Dark','u1'),
+                     ('IntegrationTime','<f8'),
+                     ('Time','<f8')])
+
+DTYPES = {'uint32': numpy.dtype('<u4'),
+          'float32': numpy.dtype('<f4')}
+
+def archiveName(outName):
+    """get the archive of a spectra file
+
+    :param outName: the name of the spectra file of a cycle, eg
+                    spectra/untitled_bat0000_0001.pico
+    :return: tuple of the name of the archive, eg
+             spectra/untitled_bat0000.pcol, and the sequence number or None
+             if the name does not contain a sequence number"""
+    m = OUTNAME.match(outName)
+    if m is None:
+        return None
+    return m.group(1)+SUFFIX,int(m.group(2))
+
+def timestamp(value):
+    """convert an ISO time to seconds since the epoch, nan if it cannot be
+    converted"""
+    if value is None:
+        return numpy.nan
+    for fmt in ['%Y-%m-%dT%H:%M:%S.%f','%Y-%m-%dT%H:%M:%S']:
+        try:
+            t = datetime.datetime.strptime(value,fmt)
+        except (TypeError,ValueError):
+            continue
+        return calendar.timegm(t.timetuple())+t.microsecond*1e-6
+    return numpy.nan
+
+class PiccoloArchiveWriter(object):
+    """append the spectra of the cycles of a batch to its archive"""
+
+    def __init__(self,dtype='uint32'):
+        """
+        :param dtype: the type of the pixels, uint32 or float32"""
+        self._log = logging.getLogger('piccolo.archive')
+        self._dtype = DTYPES[dtype]
+        self._lock = threading.Lock()
+        # the archive currently written and its open files
+        self._path = None
+        self._index = None
+        self._files = {}
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    def close(self):
+        """close the files of the current archive"""
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        for files in self._files.values():
+            for f in files:
+                f.close()
+        self._files = {}
+        self._path = None
+        self._index = None
+
+    def _open(self,path):
+        """open archive path, must hold lock"""
+        if path == self._path:
+            return
+        self._close()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        index = os.path.join(path,INDEX)
+        if os.path.exists(index):
+            with open(index,'r') as inf:
+                self._index = json.load(inf)
+        else:
+            self._index = {'Version': VERSION, 'Arrays': {}}
+        self._path = path
+
+    def _writeIndex(self):
+        index = os.path.join(self._path,INDEX)
+        tmp = tmpName(index)
+        with open(tmp,'w') as out:
+            json.dump(self._index,out,indent=1)
+        os.rename(tmp,index)
+
+    def _array(self,name,meta,nPixels):
+        """get the files of array name, must hold lock"""
+        if name not in self._files:
+            info = self._index['Arrays'].get(name)
+            if info is None:
+                info = {'SerialNumber': meta.get('SerialNumber'),
+                        'Direction': meta.get('Direction'),
+                        'NumberOfPixels': nPixels,
+                        'dtype': self._dtype.str}
+                self._index['Arrays'][name] = info
+                self._writeIndex()
+            dtype = numpy.dtype(str(info['dtype']))
+            base = os.path.join(self._path,name)
+            # drop incomplete rows left by a crash before appending, a row is
+            # complete once it is in all three files
+            rows = min(os.path.getsize(base+'.pixels')//(dtype.itemsize*info['NumberOfPixels']) if os.path.exists(base+'.pixels') else 0,
+                       os.path.getsize(base+'.table')//TABLE.itemsize if os.path.exists(base+'.table') else 0)
+            # the end of each complete line of metadata, up to rows lines
+            metaSizes = [0]
+            if os.path.exists(base+'.jsonl'):
+                with open(base+'.jsonl','r') as inf:
+                    for line in inf:
+                        if len(metaSizes) > rows or not line.endswith('\n'):
+                            break
+                        metaSizes.append(metaSizes[-1]+len(line))
+            rows = len(metaSizes)-1
+            files = []
+            for suffix,size in [('.pixels',rows*dtype.itemsize*info['NumberOfPixels']),
+                                ('.table',rows*TABLE.itemsize),
+                                ('.jsonl',metaSizes[rows])]:
+                f = open(base+suffix,'ab')
+                f.truncate(size)
+                files.append(f)
+            self._files[name] = files
+        return self._index['Arrays'][name],self._files[name]
+
+    def append(self,path,seqNr,spectra):
+        """append the spectra of a cycle to archive path
+
+        :param path: the archive directory
+        :param seqNr: the sequence number of the cycle
+        :param spectra: list of tuples of the metadata and the pixels of each
+                        spectrum"""
+        with self._lock:
+            self._open(path)
+            for meta,pixels in spectra:
+                name = '{0}_{1}'.format(meta.get('SerialNumber'),meta.get('Direction'))
+                info,(pf,tf,mf) = self._array(name,meta,len(pixels))
+                if len(pixels) != info['NumberOfPixels']:
+                    self.log.error('{}: expected {} pixels but got {}'.format(name,info['NumberOfPixels'],len(pixels)))
+                    continue
+                dtype = numpy.dtype(str(info['dtype']))
+                pixels = numpy.asarray(pixels)
+                if dtype.kind == 'u':
+                    pixels = numpy.clip(numpy.rint(pixels),0,numpy.iinfo(dtype).max)
+                pixels.astype(dtype).tofile(pf)
+                numpy.array([(seqNr,meta.get('Batch',-1),bool(meta.get('Dark')),
+                              meta.get('IntegrationTime',numpy.nan),timestamp(meta.get('Datetime')))],
+                            dtype=TABLE).tofile(tf)
+                mf.write(json.dumps(dict(meta))+'\n')
+            for files in self._files.values():
+                for f in files:
+                    f.flush()
+
+class PiccoloArchive(object):
+    """read the columnar archive of a batch"""
+
+    def __init__(self,path):
+        """
+        :param path: the archive directory"""
+        self._path = path
+        with open(os.path.join(path,INDEX),'r') as inf:
+            self._index = json.load(inf)
+
+    @property
+    def path(self):
+        """the archive directory"""
+        return self._path
+
+    @property
+    def arrays(self):
+        """the names of the arrays"""
+        return sorted(self._index['Arrays'])
+
+    def info(self,name):
+        """:return: dictionary containing the serial number, direction, number
+                    of pixels and type of array name"""
+        return self._index['Arrays'][name]
+
+    def rows(self,name):
+        """:return: the number of complete rows of array name"""
+        info = self.info(name)
+        base = os.path.join(self._path,name)
+        rowSize = numpy.dtype(str(info['dtype'])).itemsize*info['NumberOfPixels']
+        return min(os.path.getsize(base+'.pixels')//rowSize,
+                   os.path.getsize(base+'.table')//TABLE.itemsize)
+
+    def pixels(self,name):
+        """:return: read-only mapping of the pixels of array name, one row
+                    per spectrum"""
+        info = self.info(name)
+        dtype = numpy.dtype(str(info['dtype']))
+        n = self.rows(name)
+        if n == 0:
+            return numpy.zeros((0,info['NumberOfPixels']),dtype=dtype)
+        return numpy.memmap(os.path.join(self._path,name+'.pixels'),dtype=dtype,mode='r',
+                            shape=(n,info['NumberOfPixels']))
+
+    def table(self,name):
+        """:return: read-only mapping of the table of array name"""
+        n = self.rows(name)
+        if n == 0:
+            return numpy.zeros(0,dtype=TABLE)
+        return numpy.memmap(os.path.join(self._path,name+'.table'),dtype=TABLE,mode='r',shape=(n,))
+
+    def cycles(self,name,start=None,stop=None,dark=None):
+        """get the spectra of a range of cycles
+
+        :param start: the first sequence number
+        :param stop: the sequence number following the last one
+        :param dark: only dark or only light spectra if not None
+        :return: tuple of the table and pixels of the spectra, these are
+                 views of the mappings unless dark is given"""
+        table = self.table(name)
+        pixels = self.pixels(name)
+        seq = table['SequenceNumber']
+        first = 0 if start is None else numpy.searchsorted(seq,start,side='left')
+        last = len(seq) if stop is None else numpy.searchsorted(seq,stop,side='left')
+        table = table[first:last]
+        pixels = pixels[first:last]
+        if dark is not None:
+            select = table['Dark'] == bool(dark)
+            table = table[select]
+            pixels = pixels[select]
+        return table,pixels
+
+    def metadata(self,name):
+        """:return: list of the complete metadata of each row of array name"""
+        n = self.rows(name)
+        metadata = []
+        with open(os.path.join(self._path,name+'.jsonl'),'r') as inf:
+            for line in inf:
+                if len(metadata) == n:
+                    break
+                metadata.append(json.loads(line))
+        return metadata
@@ -0,0 +1,433 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Catalogue of the metadata of all recorded spectra.
+
+The catalogue is an SQLite database in the data directory holding one row
+per spectrum with the file it is stored in, the byte range of the spectrum
+within the file and the metadata used to select spectra. Files are added to
+the catalogue by the post processing thread after they have been written,
+existing directories are added in bulk. Spectra can then be found without
+parsing the spectra files and read individually using the byte range, which
+refers to the decompressed contents of compressed files.
+
+The Datetime column holds the time the spectrum was recorded or, for
+spectra without that metadata, the modification time of the file.
+
+The bounding boxes of the GPS tracks of the spectra are kept in an R*Tree so
+that the spectra of a region, the spectra nearest a point and the spectra
+along a track can be found. When SQLite was built without the R*Tree module
+an ordinary table indexed by latitude is used instead.
+"""
+
+__all__ = ['PiccoloCatalogue','catalogueRows']
+
+from PiccoloFileAccess import PiccoloFileAccess
+from PiccoloPicoParser import PiccoloPicoParser
+from PiccoloQuicklook import spectraStatistics
+from PiccoloSpatial import trackBox, localCoordinates, metresToDegrees, trackPositions
+import datetime
+import fnmatch
+import json
+import logging
+import numpy
+import os, os.path
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+  File TEXT PRIMARY KEY,
+  Mtime REAL,
+  Size INTEGER);
+CREATE TABLE IF NOT EXISTS spectra (
+  Id INTEGER PRIMARY KEY,
+  File TEXT NOT NULL,
+  Chunk INTEGER NOT NULL,
+  Offset INTEGER,
+  Length INTEGER,
+  SequenceNumber INTEGER,
+  Batch INTEGER,
+  Direction TEXT,
+  Dark INTEGER,
+  IntegrationTime REAL,
+  SerialNumber TEXT,
+  Datetime TEXT,
+  Peak REAL,
+  SaturationLevel REAL,
+  AuxStart TEXT,
+  AuxEnd TEXT);
+CREATE INDEX IF NOT EXISTS spectraFile ON spectra (File);
+CREATE INDEX IF NOT EXISTS spectraDatetime ON spectra (Datetime);
+CREATE INDEX IF NOT EXISTS spectraSerial ON spectra (SerialNumber,Direction,Datetime);
+"""
+
+POSITIONS = """
+CREATE VIRTUAL TABLE IF NOT EXISTS positions USING rtree (
+  Id,MinLat,MaxLat,MinLon,MaxLon);
+"""
+
+POSITIONS_PLAIN = """
+CREATE TABLE IF NOT EXISTS positions (
+  Id INTEGER PRIMARY KEY,
+  MinLat REAL,
+  MaxLat REAL,
+  MinLon REAL,
+  MaxLon REAL);
+CREATE INDEX IF NOT EXISTS positionsLat ON positions (MinLat,MaxLat);
+"""
+
+COLUMNS = ['File','Chunk','Offset','Length','SequenceNumber','Batch','Direction','Dark',
+           'IntegrationTime','SerialNumber','Datetime','Peak','SaturationLevel','AuxStart','AuxEnd']
+
+# the columns returned by the spatial queries
+REFERENCES = ['Id','File','Chunk','Offset','Length','SerialNumber','Direction','Dark','Datetime']
+
+def catalogueRows(fname,name,access):
+    """read the catalogue rows of the spectra in file fname
+
+    :param name: the name of the file relative to the data directory
+    :param access: used to read the file
+    :type access: PiccoloFileAccess
+    :return: the rows and the bounding boxes of the GPS tracks of the
+             spectra, None for spectra without positions"""
+    mtime = os.path.getmtime(fname)
+    rows = []
+    boxes = []
+    spectra = []
+    with access.mapped(fname) as data:
+        parser = PiccoloPicoParser(data)
+        for chunk,spectrum in enumerate(parser):
+            meta = spectrum.metadata
+            spectra.append((meta,spectrum.pixels))
+            aux = {}
+            for when in ['start','end']:
+                suffix = ' '+when
+                aux[when] = dict((k[:-len(suffix)],v) for k,v in meta.items() if k.endswith(suffix))
+            rows.append([name,chunk,spectrum.start,spectrum.end-spectrum.start,None,
+                         meta.get('Batch'),meta.get('Direction'),meta.get('Dark'),
+                         meta.get('IntegrationTime'),meta.get('SerialNumber'),
+                         meta.get('Datetime') or datetime.datetime.fromtimestamp(mtime).isoformat(),
+                         None,meta.get('SaturationLevel'),
+                         json.dumps(aux['start']) if aux['start'] else None,
+                         json.dumps(aux['end']) if aux['end'] else None])
+            boxes.append(trackBox(aux['start'].get('GPS',{}),aux['end'].get('GPS',{})))
+        seqNr = parser.fields.get('SequenceNumber')
+    for row,stats in zip(rows,spectraStatistics(spectra)):
+        row[4] = seqNr
+        row[11] = stats['Peak']
+    return rows,boxes
+
+class PiccoloCatalogue(object):
+    """SQLite catalogue of the spectra in the data directory"""
+
+    DATABASE = '.piccolo_catalogue.sqlite'
+
+    def __init__(self,datadir,pattern='*.pico*'):
+        """
+        :param datadir: the data directory
+        :type datadir: PiccoloDataDir
+        :param pattern: glob pattern of the files to be catalogued"""
+        self._log = logging.getLogger('piccolo.catalogue')
+        self._datadir = datadir
+        self._pattern = pattern
+        self._access = PiccoloFileAccess(maxMappings=1)
+        self._lock = threading.Lock()
+        self._db = None
+        self._dbName = None
+        self._dbId = None
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    def _connect(self):
+        """get the connection to the database, must hold lock
+
+        the database is opened again when the data directory changes, eg
+        when a different USB stick was mounted"""
+        dbName = os.path.join(self._datadir.datadir,self.DATABASE)
+        try:
+            st = os.stat(dbName)
+            dbId = (st.st_dev,st.st_ino)
+        except OSError:
+            dbId = None
+        if self._db is None or dbName != self._dbName or dbId != self._dbId:
+            if self._db is not None:
+                self._db.close()
+            self.log.info('opening catalogue {}'.format(dbName))
+            self._db = sqlite3.connect(dbName,check_same_thread=False)
+            self._db.executescript(SCHEMA)
+            try:
+                self._db.executescript(POSITIONS)
+            except sqlite3.OperationalError:
+                self.log.warning('SQLite does not support R*Trees, using a table for the positions')
+                self._db.executescript(POSITIONS_PLAIN)
+            st = os.stat(dbName)
+            self._dbName = dbName
+            self._dbId = (st.st_dev,st.st_ino)
+        return self._db
+
+    def _relpath(self,fname):
+        return os.path.relpath(fname,self._datadir.datadir)
+
+    def _rows(self,fname):
+        """read the catalogue rows of the spectra in file fname"""
+        return catalogueRows(fname,self._relpath(fname),self._access)
+
+    def _replace(self,db,fname,rows,boxes):
+        """replace the rows of file fname, must hold lock"""
+        st = os.stat(fname)
+        name = self._relpath(fname)
+        db.execute('DELETE FROM positions WHERE Id IN (SELECT Id FROM spectra WHERE File=?)',(name,))
+        db.execute('DELETE FROM spectra WHERE File=?',(name,))
+        db.executemany('INSERT INTO spectra ({0}) VALUES ({1})'.format(','.join(COLUMNS),','.join('?'*len(COLUMNS))),rows)
+        if any(box is not None for box in boxes):
+            ids = [i for (i,) in db.execute('SELECT Id FROM spectra WHERE File=? ORDER BY Chunk',(name,))]
+            db.executemany('INSERT INTO positions (Id,MinLat,MaxLat,MinLon,MaxLon) VALUES (?,?,?,?,?)',
+                           [(i,)+box for i,box in zip(ids,boxes) if box is not None])
+        db.execute('INSERT OR REPLACE INTO files (File,Mtime,Size) VALUES (?,?,?)',(name,st.st_mtime,st.st_size))
+
+    def update(self,fname):
+        """add the spectra of file fname to the catalogue
+
+        :param fname: absolute path of the file"""
+        name = os.path.basename(fname)
+        if name.startswith('.') or not fnmatch.fnmatch(name,self._pattern):
+            return
+        rows,boxes = self._rows(fname)
+        with self._lock:
+            db = self._connect()
+            with db:
+                self._replace(db,fname,rows,boxes)
+
+    __call__ = update
+
+    def add(self,entries):
+        """add the rows read from several files in one transaction
+
+        :param entries: list of tuples of the absolute path of each file and
+                        the rows and bounding boxes returned by
+                        catalogueRows"""
+        with self._lock:
+            db = self._connect()
+            with db:
+                for fname,(rows,boxes) in entries:
+                    self._replace(db,fname,rows,boxes)
+
+    def bulkIndex(self,path,batchSize=100):
+        """add the spectra files in directory tree path that are missing
+        from the catalogue or have changed since they were catalogued
+
+        :param path: the directory relative to the data directory
+        :param batchSize: the number of files added per transaction
+        :return: the number of files and spectra added"""
+        top = self._datadir.join(path)
+        with self._lock:
+            known = dict((f,(m,s)) for f,m,s in self._connect().execute('SELECT File,Mtime,Size FROM files'))
+        todo = []
+        for root,dirs,fnames in os.walk(top):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for f in sorted(fnames):
+                if f.startswith('.') or not fnmatch.fnmatch(f,self._pattern):
+                    continue
+                fname = os.path.join(root,f)
+                st = os.stat(fname)
+                if known.get(self._relpath(fname)) != (st.st_mtime,st.st_size):
+                    todo.append(fname)
+        self.log.info('adding {} files in {} to the catalogue'.format(len(todo),top))
+
+        nFiles = 0
+        nSpectra = 0
+        for i in range(0,len(todo),batchSize):
+            batch = []
+            for fname in todo[i:i+batchSize]:
+                try:
+                    batch.append((fname,self._rows(fname)))
+                except (IOError,OSError,ValueError,KeyError), e:
+                    self.log.warning('cannot catalogue {}: {}'.format(fname,e))
+            self.add(batch)
+            nFiles += len(batch)
+            nSpectra += sum(len(rows) for fname,(rows,boxes) in batch)
+        return nFiles,nSpectra
+
+    def query(self,outDir=None,serialNumber=None,direction=None,dark=None,start=None,end=None,
+              minSaturation=None,since=0,limit=100):
+        """find spectra
+
+        :param outDir: only spectra in files in this directory relative to
+                       the data directory
+        :param serialNumber: only spectra of this spectrometer
+        :param direction: only spectra in this direction
+        :param dark: only dark or light spectra
+        :param start: only spectra recorded at or after this ISO time
+        :param end: only spectra recorded before this ISO time
+        :param minSaturation: only spectra whose peak reaches this fraction
+                              of the saturation level
+        :param since: the last Id seen, the spectra are returned in the
+                      order they were catalogued
+        :param limit: return at most limit spectra
+        :return: tuple of the list of spectra and the Id to pass to the next
+                 query"""
+        conditions = ['Id > ?']
+        args = [since]
+        if outDir:
+            prefix = os.path.normpath(outDir)
+            if prefix != os.curdir:
+                # escape the glob characters of the directory name
+                conditions.append('File GLOB ?')
+                args.append(prefix.replace('[','[[]').replace('*','[*]').replace('?','[?]')+os.sep+'*')
+        for column,value in [('SerialNumber',serialNumber),('Direction',direction),('Dark',dark)]:
+            if value is not None:
+                conditions.append('{} = ?'.format(column))
+                args.append(value)
+        if start is not None:
+            conditions.append('Datetime >= ?')
+            args.append(start)
+        if end is not None:
+            conditions.append('Datetime < ?')
+            args.append(end)
+        if minSaturation is not None:
+            conditions.append('Peak >= ? * SaturationLevel')
+            args.append(minSaturation)
+        sql = 'SELECT Id,{0} FROM spectra WHERE {1} ORDER BY Id LIMIT ?'.format(','.join(COLUMNS),' AND '.join(conditions))
+        args.append(limit)
+
+        with self._lock:
+            cursor = self._connect().execute(sql,args)
+            rows = cursor.fetchall()
+        spectra = []
+        for row in rows:
+            spectrum = dict(zip(['Id']+COLUMNS,row))
+            spectrum['Dark'] = bool(spectrum['Dark']) if spectrum['Dark'] is not None else None
+            for k in ['AuxStart','AuxEnd']:
+                if spectrum[k] is not None:
+                    spectrum[k] = json.loads(spectrum[k])
+            spectra.append(spectrum)
+        nxt = spectra[-1]['Id'] if spectra else since
+        return spectra,nxt
+
+    def _located(self,south,west,north,east,since=0,limit=None):
+        """find the spectra whose tracks overlap a bounding box
+
+        :return: list of references to the spectra including the centre of
+                 their tracks"""
+        sql = ('SELECT {0},p.MinLat,p.MaxLat,p.MinLon,p.MaxLon FROM positions p JOIN spectra s ON s.Id = p.Id '
+               'WHERE p.MaxLat >= ? AND p.MinLat <= ? AND p.MaxLon >= ? AND p.MinLon <= ? AND p.Id > ? '
+               'ORDER BY p.Id').format(','.join('s.'+c for c in REFERENCES))
+        args = [south,north,west,east,since]
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        with self._lock:
+            rows = self._connect().execute(sql,args).fetchall()
+        spectra = []
+        n = len(REFERENCES)
+        for row in rows:
+            spectrum = dict(zip(REFERENCES,row[:n]))
+            spectrum['Dark'] = bool(spectrum['Dark']) if spectrum['Dark'] is not None else None
+            minLat,maxLat,minLon,maxLon = row[n:]
+            spectrum['Latitude'] = (minLat+maxLat)/2.
+            spectrum['Longitude'] = (minLon+maxLon)/2.
+            spectra.append(spectrum)
+        return spectra
+
+    def region(self,south,west,north,east,since=0,limit=1000):
+        """find the spectra whose tracks overlap a bounding box
+
+        :param since: the last Id seen
+        :param limit: return at most limit spectra
+        :return: tuple of the list of references to the spectra and the Id to
+                 pass to the next query"""
+        spectra = self._located(south,west,north,east,since=since,limit=limit)
+        nxt = spectra[-1]['Id'] if spectra else since
+        return spectra,nxt
+
+    def nearest(self,lat,lon,n=10,maxDistance=None):
+        """find the spectra nearest a point
+
+        the search box is grown until it contains n spectra within the
+        distance it covers in every direction
+
+        :param n: the number of spectra
+        :param maxDistance: only spectra within maxDistance metres
+        :return: list of references to the spectra sorted by their Distance
+                 in metres"""
+        radius = 100.
+        while True:
+            if maxDistance is not None:
+                radius = min(radius,maxDistance)
+            dlat,dlon = metresToDegrees(radius,lat)
+            spectra = self._located(lat-dlat,lon-dlon,lat+dlat,lon+dlon)
+            if len(spectra) > 0:
+                x,y = localCoordinates([s['Latitude'] for s in spectra],[s['Longitude'] for s in spectra],lat,lon)
+                distances = numpy.hypot(x,y)
+            else:
+                distances = numpy.zeros(0)
+            found = (distances <= radius).sum()
+            if found >= n or radius == maxDistance or (dlat >= 180. and dlon >= 360.):
+                break
+            radius *= 4.
+        result = []
+        for i in numpy.argsort(distances,kind='mergesort')[:n]:
+            if distances[i] > radius:
+                break
+            spectra[i]['Distance'] = float(distances[i])
+            result.append(spectra[i])
+        return result
+
+    def alongTrack(self,track,width=50.,limit=None):
+        """find the spectra along a track
+
+        :param track: list of the latitude and longitude of each vertex
+        :param width: only spectra within width metres of the track
+        :param limit: return at most limit spectra
+        :return: list of references to the spectra sorted by the distance
+                 along the track, the Along and Across distances are in
+                 metres"""
+        if len(track) == 0:
+            return []
+        lats,lons = zip(*track)
+        lat0 = (min(lats)+max(lats))/2.
+        dlat,dlon = metresToDegrees(width,max(abs(min(lats)),abs(max(lats))))
+        spectra = self._located(min(lats)-dlat,min(lons)-dlon,max(lats)+dlat,max(lons)+dlon)
+        if len(spectra) == 0:
+            return []
+        xs,ys = localCoordinates([s['Latitude'] for s in spectra],[s['Longitude'] for s in spectra],lat0,lons[0])
+        tx,ty = localCoordinates(lats,lons,lat0,lons[0])
+        along,across = trackPositions(xs,ys,tx,ty)
+        result = []
+        for i in numpy.argsort(along,kind='mergesort'):
+            if across[i] > width:
+                continue
+            spectra[i]['Along'] = float(along[i])
+            spectra[i]['Across'] = float(across[i])
+            result.append(spectra[i])
+            if limit is not None and len(result) >= limit:
+                break
+        return result
+
+    def status(self):
+        """:return: dictionary containing the number of files and spectra in
+                    the catalogue"""
+        with self._lock:
+            db = self._connect()
+            nFiles = db.execute('SELECT count(*) FROM files').fetchone()[0]
+            nSpectra = db.execute('SELECT count(*) FROM spectra').fetchone()[0]
+        return {'files': nFiles, 'spectra': nSpectra}
@@ -0,0 +1,182 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Change feed of the files in the output directories.
+
+Every file written to an output directory gets a sequence number which is
+appended to a hidden log file in that directory. Clients pass the last
+sequence number they have seen and only get the files written since. Files
+that appear in the directory by other means are added to the log in order of
+their modification time when the directory is rescanned.
+"""
+
+__all__ = ['PiccoloChangeFeed']
+
+import bisect
+import fnmatch
+import logging
+import os, os.path
+import threading
+
+class PiccoloDirectoryChanges(object):
+    """the sequence log of a single directory"""
+
+    LOG = '.piccolo_changes'
+
+    def __init__(self,path):
+        """
+        :param path: the directory"""
+        self._log = logging.getLogger('piccolo.changes')
+        self.path = path
+        self.logName = os.path.join(path,self.LOG)
+        self.seqs = []
+        self.names = []
+        # the most recent sequence number of each file
+        self.latest = {}
+        # the file index the log was last reconciled with
+        self.reconciled = None
+
+        if os.path.exists(self.logName):
+            with open(self.logName,'r') as changes:
+                for line in changes:
+                    try:
+                        seq,name = line.rstrip('\n').split('\t',1)
+                        seq = int(seq)
+                    except ValueError:
+                        # incomplete line written during a crash
+                        self.log.warning('ignoring corrupt record in {}'.format(self.logName))
+                        continue
+                    if len(self.seqs)>0 and seq <= self.seqs[-1]:
+                        continue
+                    self._record(seq,name)
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    @property
+    def last(self):
+        """the last sequence number"""
+        if len(self.seqs)>0:
+            return self.seqs[-1]
+        return 0
+
+    def _record(self,seq,name):
+        self.seqs.append(seq)
+        self.names.append(name)
+        self.latest[name] = seq
+
+    def add(self,names):
+        """append files to the log
+
+        :param names: list of file names"""
+        if len(names) == 0:
+            return
+        lines = []
+        for name in names:
+            seq = self.last+1
+            self._record(seq,name)
+            lines.append('{0}\t{1}\n'.format(seq,name))
+        try:
+            with open(self.logName,'a') as changes:
+                changes.write(''.join(lines))
+        except (IOError,OSError), e:
+            self.log.warning('cannot append to {}: {}'.format(self.logName,e))
+
+    def reconcile(self,names):
+        """add files found in the directory but missing from the log
+
+        :param names: the names of the files sorted by modification time"""
+        missing = [name for name in names if name not in self.latest]
+        if len(missing)>0:
+            self.log.info('adding {} files to change log of {}'.format(len(missing),self.path))
+            self.add(missing)
+
+    def changes(self,files,since,limit):
+        """get files changed after sequence number since
+
+        :param files: the names of the files currently in the directory
+        :param since: the last sequence number seen by the client
+        :param limit: return at most limit files
+        :return: tuple of list of file names and the next sequence number"""
+        if since > self.last:
+            # the log was reset, eg a different USB stick was mounted
+            since = 0
+        result = []
+        nxt = since
+        for i in range(bisect.bisect_right(self.seqs,since),len(self.seqs)):
+            if limit is not None and len(result) >= limit:
+                break
+            seq = self.seqs[i]
+            name = self.names[i]
+            nxt = seq
+            # skip files that were overwritten later or were removed
+            if self.latest[name] != seq or name not in files:
+                continue
+            result.append(name)
+        return result,nxt
+
+class PiccoloChangeFeed(object):
+    """sequence numbered changes of the files in the output directories"""
+
+    def __init__(self,index,pattern='*.pico*'):
+        """
+        :param index: the file index of the data directory
+        :type index: PiccoloFileIndex
+        :param pattern: glob pattern of the files to be included"""
+        self._index = index
+        self._pattern = pattern
+        self._lock = threading.Lock()
+        self._dirs = {}
+
+    def _getDirectory(self,path):
+        """get the sequence log of directory path, must hold lock"""
+        if path not in self._dirs:
+            self._dirs[path] = PiccoloDirectoryChanges(path)
+        return self._dirs[path]
+
+    def addFiles(self,path,names):
+        """record that files names were written to directory path"""
+        names = [n for n in names if not n.startswith('.') and fnmatch.fnmatch(n,self._pattern)]
+        with self._lock:
+            if path in self._dirs:
+                self._dirs[path].add(names)
+
+    def changes(self,path,since=0,limit=None):
+        """get the files written to directory path after sequence number
+        since
+
+        :param path: absolute path of the directory
+        :param since: the last sequence number seen by the client
+        :param limit: return at most limit files
+        :return: tuple of list of file names and the next sequence number"""
+        dirIndex = self._index.directory(path)
+        if dirIndex is None:
+            return [],since
+        with self._lock:
+            d = self._getDirectory(path)
+            if d.reconciled is not dirIndex:
+                d.reconcile(self._index.listing(path,self._pattern))
+                d.reconciled = dirIndex
+            return d.changes(dirIndex.files,since,limit)
+
+    def clear(self):
+        """forget all directories, eg when the data directory is unmounted"""
+        with self._lock:
+            self._dirs = {}
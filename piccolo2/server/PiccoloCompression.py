@@ -0,0 +1,131 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compressed spectra files.
+
+Spectra files can be stored compressed with gzip or, when the zstandard
+module is installed, with zstd. The suffix of the compression is appended to
+the name of the file, eg untitled_bat0000_0001.light.pico.gz. Files are
+compressed and decompressed in a streaming fashion and the data directory
+decompresses them transparently when they are read.
+"""
+
+__all__ = ['COMPRESSIONS','compressionAvailable','splitCompression','isCompressed',
+           'contentEncoding','compressFile','decompressChunks','decompress']
+
+import gzip
+import shutil
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the suffix of each compression
+COMPRESSIONS = {'gzip': '.gz',
+                'zstd': '.zst'}
+# the HTTP content encoding of each suffix
+ENCODINGS = {'.gz': 'gzip',
+             '.zst': 'zstd'}
+
+CHUNKSIZE = 1024*1024
+
+def compressionAvailable(method):
+    """check whether compression method can be used"""
+    if method == 'zstd':
+        return zstandard is not None
+    return method in COMPRESSIONS
+
+def splitCompression(fname):
+    """split the compression suffix off file name fname
+
+    :return: tuple of the name without the suffix and the suffix, the suffix
+             is empty for uncompressed files"""
+    for suffix in ENCODINGS:
+        if fname.endswith(suffix):
+            return fname[:-len(suffix)],suffix
+    return fname,''
+
+def isCompressed(fname):
+    """check whether file fname is compressed"""
+    return splitCompression(fname)[1] != ''
+
+def contentEncoding(fname):
+    """:return: the HTTP content encoding of file fname or None"""
+    return ENCODINGS.get(splitCompression(fname)[1])
+
+def compressFile(src,dst,method='gzip',level=6):
+    """compress file src into file dst
+
+    :param method: gzip or zstd
+    :param level: the compression level"""
+    with open(src,'rb') as inf:
+        if method == 'gzip':
+            with open(dst,'wb') as raw:
+                # do not store the name and time so that the compressed
+                # files only depend on their contents
+                out = gzip.GzipFile(filename='',mode='wb',compresslevel=level,fileobj=raw,mtime=0)
+                try:
+                    shutil.copyfileobj(inf,out,CHUNKSIZE)
+                finally:
+                    out.close()
+        elif method == 'zstd':
+            if zstandard is None:
+                raise RuntimeError, 'zstd compression needs the zstandard module'
+            with open(dst,'wb') as out:
+                zstandard.ZstdCompressor(level=level,write_content_size=True).copy_stream(inf,out,read_size=CHUNKSIZE)
+        else:
+            raise ValueError, 'unknown compression method {}'.format(method)
+
+def readChunks(inf,f):
+    """read file f chunk by chunk and close the underlying file inf when done"""
+    try:
+        while True:
+            chunk = f.read(CHUNKSIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        inf.close()
+
+def decompressChunks(fname):
+    """decompress file fname chunk by chunk
+
+    the file is opened straight away so that errors are raised before the
+    first chunk is requested
+
+    :return: iterator over the decompressed contents of file fname"""
+    suffix = splitCompression(fname)[1]
+    inf = open(fname,'rb')
+    try:
+        if suffix == '.gz':
+            f = gzip.GzipFile(fileobj=inf,mode='rb')
+        elif suffix == '.zst':
+            if zstandard is None:
+                raise IOError, 'reading {} needs the zstandard module'.format(fname)
+            f = zstandard.ZstdDecompressor().stream_reader(inf,read_size=CHUNKSIZE)
+        else:
+            f = inf
+    except:
+        inf.close()
+        raise
+    return readChunks(inf,f)
+
+def decompress(fname):
+    """:return: the decompressed contents of file fname"""
+    return ''.join(decompressChunks(fname))
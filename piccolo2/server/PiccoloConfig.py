@@ -48,10 +48,67 @@ defaultCfgStr = """
   # write separate files containing only dark and light spectra when split is
   # set to True
   split = boolean(default=True)
+  # the maximum number of batches waiting to be written
+  queueSize = integer(min=1,default=10)
+  # what to do when the output queue is full: block the acquisition, spill
+  # batches to the spool directory or drop them
+  queuePolicy = option('block','spill','drop',default='block')
+  # when files are flushed to disk before they are moved into place: after
+  # each file, after each batch or together with all files written during the
+  # group commit interval (in milliseconds)
+  fsync = option('file','batch','group',default='batch')
+  groupCommitInterval = integer(min=1,default=100)
+  # compress the spectra files, zstd needs the zstandard module
+  compression = option('none','gzip','zstd',default='none')
+  # the compression level, 1-9 for gzip and 1-22 for zstd
+  compressionLevel = integer(min=1,max=22,default=6)
+  # also append the spectra of each batch to a binary columnar archive in
+  # the output directory which can be memory mapped, eg
+  # spectra/untitled_bat0000.pcol, not written when spooling
+  archive = boolean(default=False)
+  # the type of the pixels in the archive
+  archiveDtype = option('uint32','float32',default='uint32')
+
+[SimplifySpectra]
+  # write simplified copies of the spectra files in the background so that
+  # simplified spectra can be served without delay
+  precompute = boolean(default=False)
+  # the simplification threshold
+  threshold = float(default=10)
+  # the threshold used for QE Pro spectrometers, ie when the serial number
+  # contains QEP
+  thresholdQEP = float(default=2)
+  # skip the radial distance prefilter, the prefilter speeds up the
+  # simplification of densely sampled spectra but the simplified spectra may
+  # deviate by up to twice the threshold
+  highestQuality = boolean(default=True)
+  # thresholds of individual spectrometers by serial number, eg QEP00114 = 1.5
+  [[thresholds]]
+    __many__ = float
+
+[Processing]
+  # compute reflectance and radiance in the background and write them to
+  # derived product files next to the spectra files
+  precompute = boolean(default=False)
+  # directory containing the calibration files of the spectrometers,
+  # relative to the data directory
+  calibration = string(default='')
+  # resample the spectra of all spectrometers onto a common wavelength grid
+  # from wavelengthStart to wavelengthStop nm and merge them
+  resample = boolean(default=True)
+  wavelengthStart = float(default=350)
+  wavelengthStop = float(default=1000)
+  wavelengthStep = float(min=0.01,default=1)
+
+[Catalogue]
+  # keep a catalogue of the metadata of all spectra in the data directory
+  # which can be queried without reading the spectra files, this writes to
+  # a database in the data directory after every file
+  enabled = boolean(default=False)
 """
 
 # populate the default  config object which is used as a validator
-piccoloDefaults = ConfigObj(defaultCfgStr.split('\n'))
+piccoloDefaults = ConfigObj(defaultCfgStr.split('\n'),_inspec=True)
 validator = Validator()
 
 class PiccoloConfig(object):
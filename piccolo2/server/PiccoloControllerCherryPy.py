@@ -22,19 +22,26 @@
 
 __all__ = ['PiccoloControllerCherryPy']
 
+from PiccoloCompression import COMPRESSIONS, isCompressed, contentEncoding, decompressChunks
 import cherrypy
+import cherrypy.lib.static
 from pyjsonrpc.cp import CherryPyJsonRpc, rpcmethod
 import Queue
+import os.path
 
 class PiccoloControllerCherryPy(CherryPyJsonRpc):
     """piccolo controller using JSON RPC and CherryPy
 
     .. note:: this re-implements some methods of the base controller as I could
               not get multiple inheritance to work"""
-    def __init__(self):
+    def __init__(self,datadir=None):
+        """
+        :param datadir: serve files from the data directory if not None
+        :type datadir: PiccoloDataDir"""
         CherryPyJsonRpc.__init__(self)
         self._taskQ = Queue.Queue()
         self._doneQ = Queue.Queue()
+        self._datadir = datadir
 
     @property
     def taskQ(self):
@@ -63,5 +70,50 @@ class PiccoloControllerCherryPy(CherryPyJsonRpc):
         self._taskQ.put((command,component,keywords))
         return self._doneQ.get()
 
+    @cherrypy.expose
+    def files(self,*path):
+        """serve a file of the data directory
+
+        the file is streamed from disk in chunks by cherrypy's serve_file,
+        which takes the place of sendfile: python 2 has no os.sendfile and
+        the WSGI server does not hand the socket to the application. HTTP
+        range requests are supported. Compressed files are also served when the uncompressed file is
+        requested. They are sent as they are to clients accepting their
+        encoding. Other clients are sent the decompressed contents chunk by
+        chunk as the file is decompressed."""
+        if self._datadir is None:
+            raise cherrypy.NotFound()
+        try:
+            root = os.path.realpath(self._datadir.datadir)
+        except RuntimeError, e:
+            raise cherrypy.HTTPError(503,str(e))
+        fname = os.path.realpath(os.path.join(root,*path))
+        if not fname.startswith(root+os.sep):
+            raise cherrypy.NotFound()
+        # hidden files and anything below hidden directories, such as the
+        # staging area, are not served
+        for p in list(path)+os.path.relpath(fname,root).split(os.sep):
+            if p.startswith('.'):
+                raise cherrypy.NotFound()
+        if not os.path.isfile(fname):
+            for suffix in COMPRESSIONS.values():
+                if os.path.isfile(fname+suffix):
+                    fname = fname+suffix
+                    break
+            else:
+                raise cherrypy.NotFound()
+        if isCompressed(fname):
+            encoding = contentEncoding(fname)
+            cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+            accepted = [e.value for e in cherrypy.request.headers.elements('Accept-Encoding') if e.qvalue > 0]
+            if encoding in accepted:
+                cherrypy.response.headers['Content-Encoding'] = encoding
+            else:
+                cherrypy.response.headers['Content-Type'] = 'application/json'
+                # send the decompressed contents as they are decompressed
+                cherrypy.response.stream = True
+                return decompressChunks(fname)
+        return cherrypy.lib.static.serve_file(fname,content_type='application/json')
+
     index = CherryPyJsonRpc.request_handler
     
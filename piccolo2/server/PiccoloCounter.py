@@ -0,0 +1,134 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Allocation of batch counters.
+
+The next counter of each output directory is kept in a small hidden state
+file. When a directory is first used the stored counter is checked against
+the most recent files in the file index. Only when the state file is missing
+or out of date are all file names in the index parsed.
+"""
+
+__all__ = ['PiccoloCounter','fileCounter']
+
+import json
+import logging
+import os, os.path
+import re
+import threading
+
+COUNTER = re.compile(r'^(\d+)_|_bat(\d+)_')
+
+def fileCounter(fname):
+    """extract the batch counter from a file name
+
+    file names either start with the counter, eg 0012_, or contain it, eg
+    untitled_bat0012_0000.pico
+
+    :return: the counter or None"""
+    m = COUNTER.search(os.path.basename(fname))
+    if m is None:
+        return None
+    return int(m.group(1) or m.group(2))
+
+class PiccoloCounter(object):
+    """allocate batch counters of output directories"""
+
+    STATE = '.piccolo_counter'
+    # the number of most recent files checked against the stored counter
+    VALIDATE = 16
+
+    def __init__(self,index):
+        """
+        :param index: the file index of the data directory
+        :type index: PiccoloFileIndex"""
+        self._log = logging.getLogger('piccolo.counter')
+        self._index = index
+        self._lock = threading.Lock()
+        self._next = {}
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    def _scan(self,files):
+        """:return: the counter following the largest one in files"""
+        counters = [c for c in (fileCounter(f) for f in files) if c is not None]
+        if len(counters) == 0:
+            return 0
+        return max(counters)+1
+
+    def _read(self,path):
+        """:return: the counter stored in the state file of path or None"""
+        try:
+            with open(os.path.join(path,self.STATE),'r') as state:
+                return int(json.load(state)['next'])
+        except (IOError,OSError,ValueError,KeyError,TypeError):
+            return None
+
+    def _write(self,path,n):
+        """store the next counter n in the state file of path"""
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            # overwrite the file in place rather than renaming a new one so
+            # that the directory does not change and the file index remains
+            # valid
+            with open(os.path.join(path,self.STATE),'w') as state:
+                json.dump({'next':n},state)
+        except (IOError,OSError), e:
+            self.log.warning('cannot store counter of {}: {}'.format(path,e))
+
+    def _load(self,path,pattern):
+        """determine the next counter of directory path"""
+        stored = self._read(path)
+        files = self._index.listing(path,pattern)
+        if stored is not None:
+            if self._scan(files[-self.VALIDATE:]) <= stored:
+                return stored
+            self.log.warning('counter of {} is out of date'.format(path))
+        return self._scan(files)
+
+    def peek(self,path,pattern='*.pico*'):
+        """get the next counter of directory path without allocating it
+
+        :param path: absolute path of the directory
+        :param pattern: glob pattern of the files containing counters"""
+        with self._lock:
+            if path not in self._next:
+                self._next[path] = self._load(path,pattern)
+            return self._next[path]
+
+    def allocate(self,path,pattern='*.pico*'):
+        """allocate the next counter of directory path
+
+        :param path: absolute path of the directory
+        :param pattern: glob pattern of the files containing counters"""
+        with self._lock:
+            if path not in self._next:
+                self._next[path] = self._load(path,pattern)
+            n = self._next[path]
+            self._next[path] = n+1
+            self._write(path,n+1)
+        return n
+
+    def clear(self):
+        """forget all counters, eg when the data directory is unmounted"""
+        with self._lock:
+            self._next = {}
@@ -22,17 +22,16 @@
 
 __all__ = ['PiccoloDataDir']
 
+from PiccoloFileIndex import PiccoloFileIndex
+from PiccoloCounter import PiccoloCounter
+from PiccoloChangeFeed import PiccoloChangeFeed
+from PiccoloQuicklook import PiccoloQuicklook
+from PiccoloMountWatcher import PiccoloMountWatcher, readMounts
+from PiccoloFileAccess import PiccoloFileAccess
 import subprocess
-import os, os.path, glob
+import os, os.path
 import logging
-
-def cmpMtimes(f1,f2):
-    if os.path.getmtime(f1) < os.path.getmtime(f2):
-        return -1
-    elif os.path.getmtime(f1) > os.path.getmtime(f2):
-        return 1
-    else:
-        return 0
+import threading
 
 class PiccoloDataDir(object):
     """manage piccolo output data directory"""
@@ -56,6 +55,24 @@ class PiccoloDataDir(object):
         else:
             self._mntpnt = mntpnt
 
+        self._index = PiccoloFileIndex()
+        self._counter = PiccoloCounter(self._index)
+        self._changes = PiccoloChangeFeed(self._index)
+        self._access = PiccoloFileAccess()
+        self._quicklook = PiccoloQuicklook(self._index,self._access)
+        self._writeListeners = []
+
+        # the mount state and the result of the directory checks are cached
+        # until the mount table changes or writing fails
+        self._lock = threading.Lock()
+        self._mounted = None
+        self._checked = False
+        self._lost = 0
+        self._watcher = PiccoloMountWatcher()
+        self._watcher.addListener(self._mountsChanged)
+        self._mountsChanged(self._watcher.mounts)
+        self._watcher.start()
+
         if self._mount:
             self.mount()
             self._datadir = os.path.join(self._mntpnt,datadir)
@@ -70,11 +87,50 @@ class PiccoloDataDir(object):
         """get the log"""
         return self._log
 
+    def _mountState(self,mounts):
+        """:return: True if the device is mounted at the mount point, False
+                    if it is not mounted or an error message if it is
+                    mounted elsewhere"""
+        for device,mntpnt in mounts:
+            if device == self._device:
+                if mntpnt == self._mntpnt:
+                    return True
+                return "device {} mounted in wrong directory {}".format(self._device,mntpnt)
+        return False
+
+    def _mountsChanged(self,mounts):
+        """called when the mount table changes"""
+        state = self._mountState(mounts)
+        with self._lock:
+            if state != self._mounted and self._mounted is not None:
+                if self._mount and self._mounted is True:
+                    self.log.error('{} is no longer mounted at {}'.format(self._device,self._mntpnt))
+                    self._lost += 1
+                # a different file system might be mounted now
+                self._index.clear()
+                self._counter.clear()
+                self._changes.clear()
+                self._quicklook.clear()
+            self._mounted = state
+            self._checked = False
+
+    def invalidate(self):
+        """check the data directory and the mount state again on next use,
+        eg after writing failed"""
+        self._mountsChanged(readMounts())
+
+    @property
+    def mountLost(self):
+        """the number of times the device disappeared"""
+        return self._lost
+
     @property
     def datadir(self):
         """perform checks and create data directory if necessary
 
         :return: data directory"""
+        if self._checked:
+            return self._datadir
         if self._mount and not self.isMounted:
             raise RuntimeError, '{} not mounted at {}'.format(self._device,self._mntpnt)
         if not os.path.exists(self._datadir):
@@ -84,6 +140,7 @@ class PiccoloDataDir(object):
             raise RuntimeError, '{} is not a directory'.format(self._datadir)
         if not os.access(self._datadir,os.W_OK):
             raise RuntimeError, 'cannot write to {}'.format(self._datadir)
+        self._checked = True
         return self._datadir
         
     @property
@@ -92,16 +149,10 @@ class PiccoloDataDir(object):
                     False if the device is not mounted
                     raises a RuntimeError if the device is mounted at the wrong
                     mount point"""
-        with open('/proc/mounts', 'r') as mnt:
-            for line in mnt.readlines():
-                fields = line.split()
-                if fields[0] == self._device:
-                    if fields[1] == self._mntpnt:
-                        return True
-                    raise RuntimeError, "device {} mounted in wrong directory {}".format(self._device,fields[1])
-            return False
-        raise OSError, "Cannot read /proc/mounts"
-
+        state = self._mounted
+        if state is True or state is False:
+            return state
+        raise RuntimeError, state
 
     def mount(self):
         """attempt to mount device at mount point"""
@@ -114,6 +165,7 @@ class PiccoloDataDir(object):
                                         self._device,self._mntpnt],stderr=subprocess.PIPE)
             if cmdPipe.wait()!=0:
                 raise OSError, 'mounting {} at {}: {}'.format(self._device,self._mntpnt, cmdPipe.stderr.read())
+            self._mountsChanged(readMounts())
             
     def umount(self):
         """attempt to umount device at mount point"""
@@ -125,31 +177,104 @@ class PiccoloDataDir(object):
             cmdPipe = subprocess.Popen(['sudo','umount',self._device],stderr=subprocess.PIPE)
             if cmdPipe.wait()!=0:
                 raise OSError, 'unmounting {}: {}'.format(self._device, cmdPipe.stderr.read())
+            self._mountsChanged(readMounts())
 
     def getFileList(self,path,pattern='*.pico*',haveNFiles=0):
+        """get the files in directory path sorted by modification time
+
+        :param path: the directory relative to the data directory
+        :param pattern: glob pattern the file names have to match
+        :param haveNFiles: skip the first haveNFiles files
+        :return: list of file names relative to the data directory"""
+        p = self.join(path)
+        prefix = os.path.relpath(p,self.datadir)
+        if prefix == os.curdir:
+            prefix = ''
+        return [os.path.join(prefix,f) for f in self._index.listing(p,pattern,start=haveNFiles)]
+
+    def getChanges(self,path,since=0,limit=None):
+        """get the files written to directory path after sequence number since
+
+        :param path: the directory relative to the data directory
+        :param since: the last sequence number seen
+        :param limit: return at most limit files
+        :return: tuple of list of file names relative to the data directory
+                 and the next sequence number"""
         p = self.join(path)
-        fullList = glob.glob(os.path.join(p,pattern))
-        fullList.sort(cmpMtimes)
-        fileList = []
-        for f in fullList:
-            fileList.append(os.path.relpath(f,self.datadir))
-        return fileList[haveNFiles:]
+        prefix = os.path.relpath(p,self.datadir)
+        if prefix == os.curdir:
+            prefix = ''
+        files,nxt = self._changes.changes(p,since=since,limit=limit)
+        return [os.path.join(prefix,f) for f in files],nxt
+
+    def getQuicklook(self,path,since=0,limit=None):
+        """get the quicklook statistics of the files written to directory
+        path after sequence number since
+
+        :param path: the directory relative to the data directory
+        :param since: the last sequence number seen
+        :param limit: return at most limit files
+        :return: tuple of list of dictionaries containing the file name
+                 relative to the data directory and the statistics of its
+                 spectra and the next sequence number"""
+        p = self.join(path)
+        prefix = os.path.relpath(p,self.datadir)
+        if prefix == os.curdir:
+            prefix = ''
+        files,nxt = self._changes.changes(p,since=since,limit=limit)
+        stats = self._quicklook.statistics(p,files)
+        return [{'File': os.path.join(prefix,f), 'Spectra': s} for f,s in zip(files,stats)],nxt
+
+    def addQuicklook(self,fname,stats):
+        """record the quicklook statistics of file fname, call before
+        fileWritten
+
+        :param fname: absolute path of the file
+        :param stats: list of the statistics of the spectra in the file"""
+        self._quicklook.add(fname,stats)
+
+    def fileWritten(self,fname):
+        """update the file index and change feed and notify the write
+        listeners after fname was written
+
+        :param fname: absolute path of the file"""
+        self._index.addFile(fname)
+        path,name = os.path.split(fname)
+        self._changes.addFiles(path,[name])
+        for listener in self._writeListeners:
+            listener(fname)
+
+    def addWriteListener(self,listener):
+        """call listener with the absolute path of every file written"""
+        self._writeListeners.append(listener)
 
     def getNextCounter(self,path,pattern='*.pico*'):
-        nextCounter = 0
-        for f in self.getFileList(path,pattern):
-            f = os.path.basename(f).split('_')[0]
-            try:
-                m = int(f)
-            except:
-                continue
-            nextCounter = max(nextCounter,m)
-        if nextCounter>0:
-            nextCounter = nextCounter + 1
-        return nextCounter
+        """get the next batch counter of directory path without allocating it"""
+        return self._counter.peek(self.join(path),pattern)
+
+    def allocateCounter(self,path,pattern='*.pico*'):
+        """allocate the next batch counter of directory path"""
+        return self._counter.allocate(self.join(path),pattern)
     
-    def getFileData(self,fname):
-        return open(self.join(fname),'r').read()
+    def getFileData(self,fname,offset=0,length=None):
+        """read the contents of file fname
+
+        :param fname: the file relative to the data directory
+        :param offset: the first byte to read
+        :param length: the number of bytes to read, the remainder of the file
+                       if None"""
+        return self._access.read(self.join(fname),offset=offset,length=length)
+
+    def mapped(self,fname):
+        """context manager mapping file fname read-only
+
+        :param fname: the file relative to the data directory"""
+        return self._access.mapped(self.join(fname))
+
+    def fileAccessStatus(self):
+        """:return: dictionary containing the number of files currently
+                    mapped and the maximum number"""
+        return self._access.status()
 
     def join(self,p):
         """join path to datadir if path is not absolute
@@ -29,6 +29,7 @@ import sys
 from PiccoloInstrument import PiccoloInstrument
 from PiccoloController import PiccoloController
 from PiccoloScheduler import PiccoloScheduler
+from PiccoloTrace import Trace
 
 class PiccoloDispatcher(threading.Thread):
     """piccolo dispatcher class
@@ -106,11 +107,14 @@ class PiccoloDispatcher(threading.Thread):
         :param task: task tuple (command,component,kwds)
         :return: (status,result) where status is 'ok' or 'nok'
         """
+        name = '{0}.{1}'.format(task[1],task[0])
+        Trace.begin(name,cat='dispatcher')
         try:
             result = 'ok',self.invoke(task[1],task[0],task[2])
         except:
             self.log.error('{0} {1}: {2}'.format(task[1],task[0],sys.exc_info()[1].message))
             result = 'nok',sys.exc_info()[1].message
+        Trace.end(name,cat='dispatcher')
         return result        
 
     def run(self):
@@ -0,0 +1,181 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compact lossless encoding of integer pixel arrays.
+
+Neighbouring pixels of a spectrum have similar counts. The encoding replaces
+each pixel by its difference from a prediction based on the preceding
+pixels, maps the signed residuals onto unsigned integers (zigzag encoding)
+and packs them into as few bytes as possible, 7 bits per byte (varint
+encoding). The result can be compressed further with deflate. The encodings
+are named after the predictor, optionally followed by +deflate:
+
+ * none: the pixels themselves
+ * delta: the difference to the previous pixel
+ * linear: the difference to the linear extrapolation of the previous two
+   pixels
+
+The encoded data starts with a byte holding the predictor and whether it
+is deflated, followed by the number of pixels and the residuals, all as
+varints. Encoded spectra carry the base64 encoded data in place of the
+pixels and the name of the encoding in PixelEncoding.
+"""
+
+__all__ = ['ENCODINGS','parseEncoding','encodePixels','decodePixels','encodeSpectrum','decodeSpectrum']
+
+import base64
+import numpy
+import zlib
+
+PREDICTORS = ['none','delta','linear']
+DEFLATED = 0x80
+
+ENCODINGS = PREDICTORS+[p+'+deflate' for p in PREDICTORS]
+
+def parseEncoding(encoding):
+    """split the name of an encoding
+
+    :return: tuple of the predictor and whether the data are deflated"""
+    predictor,sep,deflate = encoding.partition('+')
+    if predictor not in PREDICTORS or deflate not in ('','deflate') or (sep and not deflate):
+        raise ValueError, 'unknown pixel encoding {}'.format(encoding)
+    return predictor,deflate == 'deflate'
+
+def zigzag(values):
+    """map signed integers onto unsigned ones, small magnitudes onto small
+    values"""
+    values = numpy.asarray(values,dtype=numpy.int64)
+    return ((values << 1) ^ (values >> 63)).view(numpy.uint64)
+
+def unzigzag(values):
+    """inverse of zigzag"""
+    values = numpy.asarray(values,dtype=numpy.uint64)
+    return ((values >> numpy.uint64(1)).view(numpy.int64)) ^ -((values & numpy.uint64(1)).view(numpy.int64))
+
+def packVarints(values):
+    """pack unsigned integers into varints
+
+    all values are split into 7 bit groups at once, the groups needed by
+    each value are selected with a mask"""
+    values = numpy.asarray(values,dtype=numpy.uint64)
+    if values.size == 0:
+        return ''
+    shifts = numpy.arange(10,dtype=numpy.uint64)*numpy.uint64(7)
+    groups = (values[:,numpy.newaxis] >> shifts) & numpy.uint64(0x7f)
+    # number of groups of each value, at least one
+    nGroups = numpy.ones(values.size,dtype=numpy.int64)
+    for i in range(1,10):
+        nGroups[values >> shifts[i] != 0] = i+1
+    width = nGroups.max()
+    groups = groups[:,:width].astype(numpy.uint8)
+    used = numpy.arange(width) < nGroups[:,numpy.newaxis]
+    # set the continuation bit of all but the last group of each value
+    groups[numpy.arange(width) < (nGroups-1)[:,numpy.newaxis]] |= 0x80
+    return groups[used].tostring()
+
+def unpackVarints(data,count):
+    """unpack count varints from the start of data
+
+    :return: tuple of the array of values and the number of bytes used"""
+    if count == 0:
+        return numpy.zeros(0,dtype=numpy.uint64),0
+    b = numpy.frombuffer(data,dtype=numpy.uint8)
+    last = numpy.flatnonzero(b < 0x80)
+    if last.size < count:
+        raise ValueError, 'truncated pixel data'
+    end = last[count-1]+1
+    b = b[:end]
+    starts = numpy.concatenate(([0],last[:count-1]+1))
+    # position of each byte within its value
+    position = numpy.arange(end)-numpy.repeat(starts,numpy.diff(numpy.append(starts,end)))
+    if position.max() > 9:
+        raise ValueError, 'corrupt pixel data'
+    parts = (b & 0x7f).astype(numpy.uint64) << (position.astype(numpy.uint64)*numpy.uint64(7))
+    return numpy.bitwise_or.reduceat(parts,starts),end
+
+def encodePixels(pixels,encoding='delta'):
+    """encode integer pixels
+
+    :param pixels: the pixels, must be integers
+    :param encoding: the name of the encoding
+    :return: the encoded data"""
+    predictor,deflate = parseEncoding(encoding)
+    values = numpy.asarray(pixels)
+    if values.ndim != 1:
+        raise ValueError, 'pixels must be a one dimensional array'
+    if values.dtype.kind == 'f':
+        if not numpy.all(numpy.isfinite(values)) or not numpy.array_equal(values,numpy.rint(values)):
+            raise ValueError, 'only integer pixels can be encoded'
+    elif values.dtype.kind not in 'iub':
+        raise ValueError, 'only integer pixels can be encoded'
+    residuals = values.astype(numpy.int64)
+    # each predictor order takes the differences once more, the first value
+    # is kept so that the pixels are recovered by cumulative sums
+    for i in range(PREDICTORS.index(predictor)):
+        residuals = numpy.concatenate((residuals[:1],numpy.diff(residuals)))
+    header = chr(PREDICTORS.index(predictor) | (DEFLATED if deflate else 0))
+    header += packVarints([len(residuals)])
+    body = packVarints(zigzag(residuals))
+    if deflate:
+        body = zlib.compress(body,9)
+    return header+body
+
+def decodePixels(data):
+    """decode pixels encoded by encodePixels
+
+    :return: the pixels as an array of 64 bit integers"""
+    if len(data) == 0:
+        raise ValueError, 'empty pixel data'
+    flags = ord(data[0])
+    predictor = flags & ~DEFLATED
+    if predictor >= len(PREDICTORS):
+        raise ValueError, 'unknown pixel predictor {}'.format(predictor)
+    count,n = unpackVarints(data[1:11],1)
+    count = int(count[0])
+    body = data[1+n:]
+    if flags & DEFLATED:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error, e:
+            raise ValueError, 'corrupt pixel data: {}'.format(e)
+    values = unzigzag(unpackVarints(body,count)[0])
+    for i in range(predictor):
+        values = numpy.cumsum(values)
+    return values
+
+def encodeSpectrum(spectrum,encoding='delta'):
+    """replace the pixels of a serialised spectrum by their encoding
+
+    :param spectrum: dictionary containing the Metadata and Pixels of a
+                     spectrum
+    :return: a copy of spectrum containing the base64 encoded pixels and the
+             name of the encoding in PixelEncoding"""
+    encoded = dict(spectrum)
+    encoded['Pixels'] = base64.b64encode(encodePixels(spectrum['Pixels'],encoding))
+    encoded['PixelEncoding'] = encoding
+    return encoded
+
+def decodeSpectrum(spectrum):
+    """inverse of encodeSpectrum, spectra without PixelEncoding are returned
+    unchanged"""
+    if 'PixelEncoding' not in spectrum:
+        return spectrum
+    decoded = dict(spectrum)
+    del decoded['PixelEncoding']
+    decoded['Pixels'] = decodePixels(base64.b64decode(spectrum['Pixels'])).tolist()
+    return decoded
@@ -0,0 +1,114 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Read access to the data files through memory mappings.
+
+Byte ranges are copied straight out of the mapping so that only the
+requested part of a file is read. The number of files mapped at the same time
+is bounded and mappings are closed as soon as the data has been copied.
+Compressed files cannot be mapped, they are decompressed chunk by chunk into
+a temporary file which is mapped instead and byte ranges refer to the
+decompressed data.
+"""
+
+__all__ = ['PiccoloFileAccess']
+
+from PiccoloCompression import isCompressed, decompressChunks
+from contextlib import contextmanager
+import mmap
+import os
+import tempfile
+import threading
+
+class PiccoloFileAccess(object):
+    """bounded number of read-only memory mappings of files"""
+
+    def __init__(self,maxMappings=8,tmpdir=None):
+        """
+        :param maxMappings: the maximum number of files mapped at the same
+                            time, further requests wait
+        :param tmpdir: directory of the temporary files holding decompressed
+                       files, the default temporary directory if None"""
+        self._maxMappings = maxMappings
+        self._tmpdir = tmpdir
+        self._slots = threading.BoundedSemaphore(maxMappings)
+        self._lock = threading.Lock()
+        self._active = 0
+
+    @contextmanager
+    def mapped(self,fname):
+        """context manager mapping file fname read-only
+
+        the mapping and the file are closed when the context is left
+
+        :return: the mapping, of the decompressed contents for compressed
+                 files, or an empty string for empty files"""
+        self._slots.acquire()
+        with self._lock:
+            self._active += 1
+        try:
+            if isCompressed(fname):
+                with tempfile.TemporaryFile(dir=self._tmpdir) as f:
+                    for chunk in decompressChunks(fname):
+                        f.write(chunk)
+                    f.flush()
+                    with self._map(f) as m:
+                        yield m
+                return
+            with open(fname,'rb') as f:
+                with self._map(f) as m:
+                    yield m
+        finally:
+            with self._lock:
+                self._active -= 1
+            self._slots.release()
+
+    @contextmanager
+    def _map(self,f):
+        """context manager mapping the open file f read-only"""
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files cannot be mapped
+            yield ''
+            return
+        m = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        try:
+            yield m
+        finally:
+            m.close()
+
+    def read(self,fname,offset=0,length=None):
+        """read a byte range of file fname
+
+        :param offset: the first byte to read
+        :param length: the number of bytes to read, all remaining bytes if
+                       None
+        :return: the data as a string"""
+        with self.mapped(fname) as m:
+            size = len(m)
+            offset = min(max(offset,0),size)
+            if length is None:
+                end = size
+            else:
+                end = min(offset+max(length,0),size)
+            return m[offset:end]
+
+    def status(self):
+        """:return: dictionary containing the number of active mappings and
+                    the maximum number"""
+        return {'mappings': self._active,
+                'max': self._maxMappings}
@@ -0,0 +1,180 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory index of the files in the output directories.
+
+Each directory is scanned once and then kept up to date by the output threads
+reporting the files they write. A directory is scanned again when its
+modification time changes for any other reason, eg when files were copied to
+the USB stick by hand. The modification time of directories on FAT file
+systems has a resolution of two seconds, external changes within that window
+of a write by the server may go unnoticed until the next change.
+"""
+
+__all__ = ['PiccoloFileIndex']
+
+import bisect
+import fnmatch
+import logging
+import os, os.path
+import stat
+import threading
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def scanDirectory(path):
+    """:return: dictionary mapping the names of the files in directory path
+                to tuples of their mtime and size"""
+    files = {}
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_file():
+                st = entry.stat()
+                files[entry.name] = (st.st_mtime,st.st_size)
+    else:
+        for name in os.listdir(path):
+            try:
+                st = os.stat(os.path.join(path,name))
+            except OSError:
+                # file was removed in the meantime
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files[name] = (st.st_mtime,st.st_size)
+    return files
+
+class PiccoloDirectoryIndex(object):
+    """the files of a single directory"""
+
+    def __init__(self,path):
+        """
+        :param path: the directory"""
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.files = scanDirectory(path)
+        # sorted lists of (mtime,name) tuples for each pattern
+        self._listings = {}
+
+    def listing(self,pattern):
+        """:return: sorted list of (mtime,name) tuples of files matching
+                    pattern"""
+        if pattern not in self._listings:
+            # like glob, ignore hidden files
+            self._listings[pattern] = sorted((self.files[name][0],name) for name in self.files
+                                             if not name.startswith('.') and fnmatch.fnmatch(name,pattern))
+        return self._listings[pattern]
+
+    def add(self,name,mtime,size):
+        """add or update file name"""
+        old = self.files.get(name)
+        self.files[name] = (mtime,size)
+        if name.startswith('.'):
+            return
+        for pattern in self._listings:
+            if not fnmatch.fnmatch(name,pattern):
+                continue
+            l = self._listings[pattern]
+            if old is not None:
+                i = bisect.bisect_left(l,(old[0],name))
+                if i<len(l) and l[i] == (old[0],name):
+                    del l[i]
+            key = (mtime,name)
+            if len(l) == 0 or key > l[-1]:
+                # the common case, the new file is the most recent one
+                l.append(key)
+            else:
+                bisect.insort(l,key)
+
+class PiccoloFileIndex(object):
+    """index of files in directories sorted by modification time"""
+
+    def __init__(self):
+        self._log = logging.getLogger('piccolo.fileindex')
+        self._lock = threading.Lock()
+        self._dirs = {}
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    def _getDirectory(self,path):
+        """get the up-to-date index of directory path, must hold lock
+
+        :return: the directory index or None if the directory does not exist"""
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self._dirs.pop(path,None)
+            return None
+        d = self._dirs.get(path)
+        if d is None or d.mtime != mtime:
+            if d is not None:
+                self.log.info('directory {} changed, rescanning'.format(path))
+            d = PiccoloDirectoryIndex(path)
+            self._dirs[path] = d
+        return d
+
+    def directory(self,path):
+        """get the up-to-date index of directory path
+
+        :return: the directory index or None if the directory does not exist"""
+        with self._lock:
+            return self._getDirectory(path)
+
+    def listing(self,path,pattern='*',start=0):
+        """get the files in directory path matching pattern
+
+        :param path: the directory
+        :param pattern: glob pattern the file names have to match
+        :param start: skip the first start files
+        :return: list of file names sorted by modification time"""
+        with self._lock:
+            d = self._getDirectory(path)
+            if d is None:
+                return []
+            return [name for mtime,name in d.listing(pattern)[start:]]
+
+    def addFile(self,fname):
+        """record that file fname was written
+
+        :param fname: absolute path of the file"""
+        path,name = os.path.split(fname)
+        with self._lock:
+            d = self._dirs.get(path)
+            if d is None:
+                # not listed yet, will be scanned when needed
+                return
+            try:
+                st = os.stat(fname)
+                d.add(name,st.st_mtime,st.st_size)
+                # the directory mtime changed because of our own write
+                d.mtime = os.stat(path).st_mtime
+            except OSError:
+                # rescan the directory next time it is listed
+                del self._dirs[path]
+
+    def clear(self):
+        """forget all directories, eg when the data directory is unmounted"""
+        with self._lock:
+            self._dirs = {}
@@ -0,0 +1,189 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Crash-safe publishing of files.
+
+Files are written to temporary names and atomically renamed once they have
+been flushed to disk. When the flush happens is controlled by the fsync
+policy:
+
+file
+  each file is flushed and renamed on its own
+batch
+  all files handed over together are flushed, then renamed
+group
+  files are collected and flushed and renamed together every interval
+  milliseconds by a background thread
+"""
+
+__all__ = ['PiccoloFileSync','fsyncDirectory','tmpName']
+
+from PiccoloTrace import Trace
+import logging
+import os, os.path
+import threading
+
+def fsyncDirectory(path):
+    """flush directory entries of path to disk"""
+    fd = os.open(path,os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def fsyncFile(fname):
+    """flush contents of file fname to disk"""
+    with Trace.span('fsync',args={'file':fname}):
+        fd = os.open(fname,os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def tmpName(fname):
+    """hidden temporary name for file fname which is not picked up by
+    listings of the directory"""
+    return os.path.join(os.path.dirname(fname),'.'+os.path.basename(fname)+'.tmp')
+
+class PiccoloFileSync(threading.Thread):
+    """flush files to disk and rename them according to the fsync policy"""
+
+    POLICIES = ['file','batch','group']
+
+    def __init__(self,policy='batch',interval=100.):
+        """
+        :param policy: the fsync policy, one of file, batch or group
+        :param interval: the group commit interval in milliseconds"""
+
+        if policy not in self.POLICIES:
+            raise ValueError, 'unknown fsync policy {}'.format(policy)
+
+        threading.Thread.__init__(self,name='PiccoloFileSync')
+        self.daemon = True
+
+        self._log = logging.getLogger('piccolo.filesync')
+        self._policy = policy
+        self._interval = interval/1000.
+
+        self._lock = threading.Condition()
+        self._pending = []
+        self._callbacks = []
+        # number of group commits started and finished
+        self._nStarted = 0
+        self._nCommits = 0
+        self._stopping = False
+
+        if self._policy == 'group':
+            self.start()
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    @property
+    def policy(self):
+        """the fsync policy"""
+        return self._policy
+
+    def _commit(self,files):
+        """flush and rename files"""
+        dirs = set()
+        if self._policy == 'file':
+            for tmp,final in files:
+                fsyncFile(tmp)
+                os.rename(tmp,final)
+                fsyncDirectory(os.path.dirname(final))
+        else:
+            for tmp,final in files:
+                fsyncFile(tmp)
+            for tmp,final in files:
+                os.rename(tmp,final)
+                dirs.add(os.path.dirname(final))
+            for d in dirs:
+                fsyncDirectory(d)
+
+    def publish(self,files,callback=None):
+        """make files durable and move them to their final names
+
+        With the file and batch policies the files are published before this
+        method returns and errors are raised. With the group policy the files
+        are published by the background thread and errors are passed to the
+        callback until the thread is stopped.
+
+        :param files: list of (temporary name, final name) tuples
+        :param callback: called with None or the error once the files have
+                         been published"""
+        if self._policy == 'group':
+            with self._lock:
+                if not self._stopping:
+                    self._pending += files
+                    self._callbacks.append(callback)
+                    return
+        # the files are published straight away once the group commit thread
+        # has been stopped
+        self._commit(files)
+        if callback is not None:
+            callback(None)
+
+    def flush(self):
+        """publish all pending files now and wait until they are published"""
+        if self._policy != 'group':
+            return
+        with self._lock:
+            self._lock.notifyAll()
+            # wait for the pending files to be taken and for the commit that
+            # took them to finish
+            while len(self._pending)>0 or len(self._callbacks)>0 or self._nCommits < self._nStarted:
+                self._lock.wait()
+
+    def stop(self):
+        """stop the group commit thread once the pending files have been
+        published, join the thread to wait for it"""
+        with self._lock:
+            self._stopping = True
+            self._lock.notifyAll()
+
+    def run(self):
+        while True:
+            with self._lock:
+                if not self._stopping:
+                    self._lock.wait(self._interval)
+                stopping = self._stopping
+                files = self._pending
+                callbacks = self._callbacks
+                self._pending = []
+                self._callbacks = []
+                self._nStarted += 1
+            if len(files)>0 or len(callbacks)>0:
+                error = None
+                with Trace.span('group commit',args={'files':len(files)}):
+                    try:
+                        self._commit(files)
+                    except (IOError,OSError), e:
+                        self.log.error('group commit of {} files failed: {}'.format(len(files),e))
+                        error = e
+                for cb in callbacks:
+                    if cb is not None:
+                        cb(error)
+            with self._lock:
+                self._nCommits += 1
+                self._lock.notifyAll()
+            if stopping:
+                self.log.info('shutting down')
+                return
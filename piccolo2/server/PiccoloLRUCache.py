@@ -0,0 +1,98 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Least recently used cache bounded by the size of its entries.
+"""
+
+__all__ = ['PiccoloLRUCache']
+
+from collections import OrderedDict
+import threading
+
+class PiccoloLRUCache(object):
+    """thread safe LRU cache holding at most maxBytes worth of entries
+
+    keys are tuples whose first element is the file the entry was derived
+    from so that all entries of a file can be invalidated together"""
+
+    def __init__(self,maxBytes=32*1024*1024):
+        """
+        :param maxBytes: the maximum total size of the entries"""
+        self._maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self,key):
+        """get the value stored under key
+
+        :return: the value or None if key is not in the cache"""
+        with self._lock:
+            entry = self._entries.pop(key,None)
+            if entry is None:
+                self._misses += 1
+                return None
+            # move to the most recently used end
+            self._entries[key] = entry
+            self._hits += 1
+            return entry[0]
+
+    def put(self,key,value,size):
+        """store value under key
+
+        :param size: the size of value in bytes, values larger than the
+                     cache are not stored"""
+        with self._lock:
+            old = self._entries.pop(key,None)
+            if old is not None:
+                self._bytes -= old[1]
+            if size > self._maxBytes:
+                return
+            self._entries[key] = (value,size)
+            self._bytes += size
+            while self._bytes > self._maxBytes:
+                k,(v,s) = self._entries.popitem(last=False)
+                self._bytes -= s
+                self._evictions += 1
+
+    def invalidate(self,fname):
+        """remove all entries derived from file fname"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == fname]:
+                self._bytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        """remove all entries"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def status(self):
+        """:return: dictionary containing the number of entries, their size,
+                    the maximum size and the number of hits, misses and
+                    evictions"""
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'maxBytes': self._maxBytes,
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions}
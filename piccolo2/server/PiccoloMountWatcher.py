@@ -0,0 +1,102 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Watch the mount table for changes.
+
+The kernel signals POLLPRI on /proc/self/mounts whenever a file system is
+mounted or unmounted. The mount table is only read again when that happens
+or, as a fallback, after a timeout.
+"""
+
+__all__ = ['PiccoloMountWatcher','readMounts']
+
+import logging
+import select
+import threading
+
+def parseMounts(data):
+    """:return: list of (device, mount point) tuples"""
+    mounts = []
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields)>1:
+            mounts.append((fields[0],fields[1]))
+    return mounts
+
+def readMounts(fname='/proc/self/mounts'):
+    """:return: the mount table as a list of (device, mount point) tuples"""
+    with open(fname,'r') as mnt:
+        return parseMounts(mnt.read())
+
+class PiccoloMountWatcher(threading.Thread):
+    """thread notifying listeners about changes of the mount table"""
+
+    MOUNTS = '/proc/self/mounts'
+
+    def __init__(self,interval=60.):
+        """
+        :param interval: read the mount table at least every interval
+                         seconds"""
+        threading.Thread.__init__(self,name='PiccoloMountWatcher')
+        self.daemon = True
+
+        self._log = logging.getLogger('piccolo.mountwatcher')
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._mounts = readMounts(self.MOUNTS)
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    @property
+    def mounts(self):
+        """the current mount table as a list of (device, mount point)
+        tuples"""
+        return self._mounts
+
+    def addListener(self,listener):
+        """call listener with the new mount table whenever it changes"""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def _update(self,data):
+        mounts = parseMounts(data)
+        if mounts == self._mounts:
+            return
+        self.log.debug('mount table changed')
+        self._mounts = mounts
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(mounts)
+
+    def run(self):
+        with open(self.MOUNTS,'r') as mnt:
+            p = select.poll()
+            p.register(mnt.fileno(),select.POLLPRI|select.POLLERR)
+            while True:
+                p.poll(self._interval*1000.)
+                # reading the file rearms the notification
+                mnt.seek(0)
+                try:
+                    self._update(mnt.read())
+                except Exception, e:
+                    self.log.error('handling mount table change: {}'.format(e))
@@ -0,0 +1,193 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Bounded hand-off of recorded spectra from the acquisition thread to the
+output thread.
+
+When the queue is full the acquisition either blocks, the batch is spilled to
+a local spool directory or it is dropped.
+"""
+
+__all__ = ['PiccoloOutputQueue']
+
+from Queue import Queue, Full
+from collections import deque
+from PiccoloTrace import Trace
+import cPickle
+import glob
+import logging
+import os, os.path
+import threading
+import time
+
+class PiccoloOutputQueue(Queue):
+    """bounded queue of spectra waiting to be written"""
+
+    POLICIES = ['block','spill','drop']
+    SPILL_PATTERN = 'spill_*.pickle'
+
+    def __init__(self,maxsize=10,policy='block',spooldir=None):
+        """
+        :param maxsize: the maximum number of batches held in memory
+        :param policy: what to do when the queue is full, one of block, spill
+                       or drop
+        :param spooldir: directory to spill batches to when policy is spill"""
+
+        if policy not in self.POLICIES:
+            raise ValueError, 'unknown output queue policy {}'.format(policy)
+        if policy == 'spill' and spooldir is None:
+            raise RuntimeError, 'spill policy requires a spool directory'
+
+        Queue.__init__(self,maxsize)
+
+        self._log = logging.getLogger('piccolo.outputqueue')
+        self._policy = policy
+        self._spooldir = spooldir
+
+        self._spillLock = threading.Lock()
+        self._spilled = deque()
+        self._nSpilled = 0
+        self._inflight = deque()
+        self._dropped = 0
+
+        if self._policy == 'spill':
+            if not os.path.isdir(self._spooldir):
+                self.log.info("creating spool directory {}".format(self._spooldir))
+                os.makedirs(self._spooldir)
+            # pick up batches spilled before a restart
+            for f in sorted(glob.glob(os.path.join(self._spooldir,self.SPILL_PATTERN))):
+                self.log.warning('found spilled batch {}'.format(f))
+                self._spilled.append((os.path.getmtime(f),f))
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    @property
+    def policy(self):
+        """the policy applied when the queue is full"""
+        return self._policy
+
+    @property
+    def dropped(self):
+        """the number of batches dropped so far"""
+        return self._dropped
+
+    # the items on the underlying deque are (timestamp,item) tuples
+    def _put(self,item):
+        self.queue.append((time.time(),item))
+
+    def _get(self):
+        ts,item = self.queue.popleft()
+        self._inflight.append(ts)
+        return item
+
+    def task_done(self):
+        with self.mutex:
+            if len(self._inflight)>0:
+                self._inflight.popleft()
+        Queue.task_done(self)
+
+    def _spill(self,item):
+        """write item to the spool directory, must hold spill lock"""
+        with Trace.span('spill'):
+            ts = time.time()
+            fname = os.path.join(self._spooldir,'spill_{0:017.6f}_{1:06d}.pickle'.format(ts,self._nSpilled))
+            self._nSpilled += 1
+            self.log.warning('output queue full, spilling {} to {}'.format(item.outName,fname))
+            with open(fname+'.tmp','wb') as out:
+                cPickle.dump(item,out,cPickle.HIGHEST_PROTOCOL)
+            os.rename(fname+'.tmp',fname)
+            self._spilled.append((ts,fname))
+
+    def _refill(self):
+        """move spilled batches back into memory while there is space"""
+        with self._spillLock:
+            while len(self._spilled)>0 and not self.full():
+                ts,fname = self._spilled[0]
+                try:
+                    with open(fname,'rb') as inf:
+                        item = cPickle.load(inf)
+                except Exception, e:
+                    self.log.error('cannot read spilled batch {}: {}'.format(fname,e))
+                    item = None
+                self._spilled.popleft()
+                os.unlink(fname)
+                if item is None:
+                    continue
+                with self.mutex:
+                    self.queue.append((ts,item))
+                    self.unfinished_tasks += 1
+                    self.not_empty.notify()
+
+    def put(self,item,block=True,timeout=None):
+        """put a batch on the queue applying the queue policy if it is full
+
+        None (the poison pill of the output thread) is always queued"""
+
+        if item is None or self._policy == 'block':
+            if self.full():
+                with Trace.span('output queue wait'):
+                    Queue.put(self,item,block,timeout)
+            else:
+                Queue.put(self,item,block,timeout)
+            return
+
+        with self._spillLock:
+            # keep the order if batches have already been spilled
+            if len(self._spilled) == 0:
+                try:
+                    Queue.put(self,item,block=False)
+                    return
+                except Full:
+                    pass
+            if self._policy == 'drop':
+                self._dropped += 1
+                self.log.error('output queue full, dropping {}'.format(item.outName))
+            else:
+                self._spill(item)
+
+    def get(self,block=True,timeout=None):
+        if self._policy == 'spill':
+            self._refill()
+        return Queue.get(self,block,timeout)
+
+    def status(self):
+        """:return: dictionary containing the queue depth, the number of
+                    spilled and dropped batches and the age in seconds of the
+                    oldest batch that has not been written yet"""
+        with self._spillLock:
+            nSpilled = len(self._spilled)
+            oldestSpilled = self._spilled[0][0] if nSpilled>0 else None
+        with self.mutex:
+            inMemory = self._qsize()
+            if len(self._inflight)>0:
+                oldest = self._inflight[0]
+            elif inMemory>0:
+                oldest = self.queue[0][0]
+            else:
+                oldest = oldestSpilled
+        if oldest is not None:
+            oldest = time.time()-oldest
+        return {'policy': self._policy,
+                'maxsize': self.maxsize,
+                'depth': inMemory+nSpilled,
+                'spilled': nSpilled,
+                'dropped': self._dropped,
+                'oldest': oldest}
@@ -0,0 +1,120 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Incremental parser of pico files.
+
+A pico file is a JSON object holding the sequence number and the list of
+spectra of a batch. The parser walks the top level object and decodes one
+spectrum at a time so that only a single spectrum is held in memory. It
+works on strings as well as on memory mappings of the files, from which it
+copies a window around the spectrum being decoded.
+"""
+
+__all__ = ['PiccoloPicoParser','PicoSpectrum']
+
+from collections import namedtuple
+import json
+import numpy
+
+class PicoSpectrum(namedtuple('PicoSpectrum',['metadata','pixels','start','end'])):
+    """a spectrum of a pico file
+
+    the metadata dictionary, the pixels as an array and the byte range of the
+    JSON object of the spectrum in the file"""
+    __slots__ = ()
+
+WHITESPACE = ' \t\n\r'
+
+class PiccoloPicoParser(object):
+    """iterate over the spectra of a pico file"""
+
+    def __init__(self,data,window=65536):
+        """
+        :param data: the contents of the file as a string or a memory mapping
+        :param window: the initial number of bytes copied from a mapping to
+                       decode a value, the window grows for larger values"""
+        self._data = data
+        self._window = window
+        self._decoder = json.JSONDecoder()
+        self._fields = {}
+
+    @property
+    def fields(self):
+        """the top level fields other than the spectra, eg SequenceNumber,
+        complete once all spectra have been read"""
+        return self._fields
+
+    def _skip(self,pos):
+        """skip whitespace
+
+        :return: the next character and its position"""
+        while pos < len(self._data) and self._data[pos] in WHITESPACE:
+            pos += 1
+        if pos == len(self._data):
+            raise ValueError, 'unexpected end of pico file'
+        return self._data[pos],pos
+
+    def _expect(self,pos,chars):
+        c,pos = self._skip(pos)
+        if c not in chars:
+            raise ValueError, 'expected one of {0} at byte {1} of pico file but found {2}'.format(chars,pos,c)
+        return c,pos+1
+
+    def _decode(self,pos):
+        """decode the JSON value starting at pos
+
+        :return: the value and the position following it"""
+        if isinstance(self._data,basestring):
+            return self._decoder.raw_decode(self._data,pos)
+        size = self._window
+        while True:
+            chunk = self._data[pos:pos+size]
+            more = pos+size < len(self._data)
+            try:
+                value,end = self._decoder.raw_decode(chunk)
+            except ValueError:
+                if not more:
+                    raise
+            else:
+                # a number cut off by the end of the window is still a number
+                if end < len(chunk) or not more:
+                    return value,pos+end
+            size *= 4
+
+    def __iter__(self):
+        """:return: generator yielding a PicoSpectrum for each spectrum"""
+        c,pos = self._expect(0,'{')
+        c,p = self._skip(pos)
+        if c == '}':
+            return
+        while c != '}':
+            key,pos = self._decode(self._skip(pos)[1])
+            c,pos = self._expect(pos,':')
+            if key == 'Spectra':
+                c,pos = self._expect(pos,'[')
+                c,p = self._skip(pos)
+                if c == ']':
+                    pos = p+1
+                while c != ']':
+                    start = self._skip(pos)[1]
+                    spectrum,pos = self._decode(start)
+                    yield PicoSpectrum(spectrum['Metadata'],numpy.asarray(spectrum['Pixels']),start,pos)
+                    c,pos = self._expect(pos,',]')
+            else:
+                self._fields[key],pos = self._decode(self._skip(pos)[1])
+            c,pos = self._expect(pos,',}')
@@ -0,0 +1,245 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Post processing of spectra files after they have been written.
+
+A low priority thread runs a list of stages on every file written to the data
+directory. The simplification stage writes simplified copies of the spectra
+to hidden sidecar files which are served instead of simplifying the spectra
+on demand.
+"""
+
+__all__ = ['PiccoloPostProcess','PiccoloSimplifyStage']
+
+from PiccoloTrace import Trace
+from PiccoloFileAccess import PiccoloFileAccess
+from PiccoloPicoParser import PiccoloPicoParser
+from PiccoloWavelengths import WavelengthGrids
+from PiccoloCompression import splitCompression
+import PiccoloSimplify
+from Queue import Queue
+import fnmatch
+import json
+import logging
+import numpy
+import os, os.path
+import threading
+import zlib
+
+class PiccoloSimplifyStage(object):
+    """simplify spectra and store them in sidecar files"""
+
+    SIDECARS = '.simple'
+
+    def __init__(self,cfg={}):
+        """
+        :param cfg: the SimplifySpectra section of the piccolo configuration"""
+        self._log = logging.getLogger('piccolo.simplify')
+        self._threshold = cfg.get('threshold',10.)
+        self._thresholdQEP = cfg.get('thresholdQEP',2.)
+        self._thresholds = dict(cfg.get('thresholds',{}))
+        self._highestQuality = cfg.get('highestQuality',True)
+        # the post processing thread maps one file at a time
+        self._access = PiccoloFileAccess(maxMappings=1)
+        # sidecars written with different settings are kept apart
+        settings = repr((self._threshold,self._thresholdQEP,sorted(self._thresholds.items()),self._highestQuality))
+        self._key = '{0:08x}'.format(zlib.crc32(settings) & 0xffffffff)
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    @property
+    def key(self):
+        """identifies the simplification settings"""
+        return self._key
+
+    def threshold(self,serialNumber):
+        """the simplification threshold of spectrometer serialNumber"""
+        if serialNumber in self._thresholds:
+            return self._thresholds[serialNumber]
+        if "QEP" in serialNumber:
+            return self._thresholdQEP
+        return self._threshold
+
+    def simplify(self,data,maxPoints=None,maxBytes=None):
+        """simplify spectra
+
+        the spectra are simplified using the threshold of their spectrometer.
+        When a budget is given at most that many points are kept and the
+        maximum distance of the dropped points from the simplified spectrum
+        is stored in the SimplificationError metadata.
+
+        :param data: the contents of a spectra file as a string or a memory
+                     mapping
+        :param maxPoints: the maximum number of points per spectrum
+        :param maxBytes: the maximum size of the JSON encoded Pixels and
+                         Wavelengths lists of each spectrum, at least two
+                         points are kept
+        :return: the simplified spectra"""
+        parsed = []
+        parser = PiccoloPicoParser(data)
+        for spectrum in parser:
+            meta = spectrum.metadata
+            pixels = spectrum.pixels.astype(numpy.float32)
+            wavelengths = WavelengthGrids.grid(meta['WavelengthCalibrationCoefficients'],pixels.size)
+            parsed.append((meta,pixels,wavelengths))
+
+        if maxPoints is None and maxBytes is None:
+            # all spectra of the file go through one Douglas-Peucker pass
+            simplified = PiccoloSimplify.simplifyMany([(pixels,wavelengths) for meta,pixels,wavelengths in parsed],
+                                                      [self.threshold(meta['SerialNumber']) for meta,pixels,wavelengths in parsed],
+                                                      highestQuality=self._highestQuality)
+        else:
+            simplified = []
+            for meta,pixels,wavelengths in parsed:
+                simple_px,simple_wv,error = self.budget(pixels,wavelengths,self.threshold(meta['SerialNumber']),
+                                                        maxPoints=maxPoints,maxBytes=maxBytes)
+                meta['SimplificationError'] = error
+                simplified.append((simple_px,simple_wv))
+
+        spectra = []
+        for (meta,pixels,wavelengths),(simple_px,simple_wv) in zip(parsed,simplified):
+            meta['Wavelengths'] = numpy.round(simple_wv,3).tolist()
+            del meta['WavelengthCalibrationCoefficients']
+            spectra.append({'Metadata': meta,
+                            'Pixels': numpy.round(simple_px,2).tolist()})
+
+            self.log.debug("Simplified {0} {1} {2} from {3} pts to {4} pts".format(meta['SerialNumber'], meta["Direction"], meta['Dark'],
+                                                                                  pixels.size, simple_px.size))
+
+        return {"SequenceNumber": parser.fields['SequenceNumber'],
+                "Spectra": spectra}
+
+    def budget(self,pixels,wavelengths,threshold,maxPoints=None,maxBytes=None):
+        """simplify a spectrum within a budget
+
+        points are not kept once the spectrum is within threshold
+
+        :return: the pixels and wavelengths of the kept points and the
+                 maximum distance of the dropped points from the simplified
+                 spectrum"""
+        order,errors = PiccoloSimplify.rank(pixels,wavelengths,maxPoints=maxPoints,tolerance=threshold)
+        n = len(order)
+        if maxBytes is not None:
+            # the size of each point in the encoded lists including the
+            # separators, the surrounding brackets take the place of the
+            # separators of the last point
+            sizes = [len(json.dumps(p))+len(json.dumps(w))+4
+                     for p,w in zip(numpy.round(pixels[order],2).tolist(),
+                                    numpy.round(wavelengths[order],3).tolist())]
+            n = max(numpy.searchsorted(numpy.cumsum(sizes),maxBytes,side='right'),min(n,2))
+        keep = numpy.sort(order[:n])
+        return pixels[keep],wavelengths[keep],errors[n-1]
+
+    def sidecar(self,fname):
+        """the name of the sidecar file of spectra file fname, the sidecars
+        of compressed files are not compressed"""
+        d,name = os.path.split(splitCompression(fname)[0])
+        return os.path.join(d,self.SIDECARS,self._key,name)
+
+    def load(self,fname):
+        """get the simplified spectra of file fname from its sidecar
+
+        :return: the contents of the sidecar or None if there is no up to date
+                 sidecar"""
+        sidecar = self.sidecar(fname)
+        try:
+            if os.path.getmtime(sidecar) < os.path.getmtime(fname):
+                return None
+            with open(sidecar,'r') as inf:
+                return inf.read()
+        except (IOError,OSError):
+            return None
+
+    def __call__(self,fname):
+        """write the sidecar of spectra file fname"""
+        with self._access.mapped(fname) as data:
+            simple = self.simplify(data)
+        sidecar = self.sidecar(fname)
+        d = os.path.dirname(sidecar)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        tmp = os.path.join(d,'.'+os.path.basename(sidecar)+'.tmp')
+        with open(tmp,'w') as out:
+            json.dump(simple,out)
+        os.rename(tmp,sidecar)
+
+class PiccoloPostProcess(threading.Thread):
+    """run post processing stages on files after they have been written"""
+
+    def __init__(self,name,stages,pattern='*.pico*',nice=10,daemon=True):
+        """
+        :param name: name of the thread
+        :param stages: list of callables run on the absolute path of each file
+        :param pattern: glob pattern of the files to be processed
+        :param nice: increment of the niceness of the thread"""
+        threading.Thread.__init__(self)
+        self.name = name
+        self.daemon = daemon
+
+        self._log = logging.getLogger('piccolo.worker.postprocess.{0}'.format(name))
+        self.log.info('initialising worker')
+
+        self._stages = stages
+        self._pattern = pattern
+        self._nice = nice
+        self._files = Queue()
+        self._processed = 0
+        self._errors = 0
+
+    @property
+    def log(self):
+        return self._log
+
+    def add(self,fname):
+        """queue file fname for post processing"""
+        if fnmatch.fnmatch(os.path.basename(fname),self._pattern):
+            self._files.put(fname)
+
+    def stop(self):
+        """stop the thread once the queued files have been processed"""
+        self._files.put(None)
+
+    def status(self):
+        """:return: dictionary containing the number of files waiting, the
+                    number of files processed and the number of errors"""
+        return {'pending': self._files.qsize(),
+                'processed': self._processed,
+                'errors': self._errors}
+
+    def run(self):
+        # on Linux this only changes the priority of the calling thread
+        try:
+            os.nice(self._nice)
+        except OSError, e:
+            self.log.warning('cannot lower priority: {}'.format(e))
+        while True:
+            fname = self._files.get()
+            if fname is None:
+                self.log.info('shutting down')
+                return
+            with Trace.span('post process',args={'file':fname}):
+                for stage in self._stages:
+                    try:
+                        stage(fname)
+                    except Exception, e:
+                        self.log.error('post processing {}: {}'.format(fname,e))
+                        self._errors += 1
+            self._processed += 1
@@ -0,0 +1,332 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Radiance and reflectance processing of the recorded spectra.
+
+The light spectra of a cycle are paired by spectrometer and direction with
+the dark spectra recorded with the same integration time, normally at the
+start of the batch. The dark spectra are subtracted and the result divided by
+the integration time. When a calibration file is available for a
+spectrometer the counts are converted to radiance. The reflectance is the
+ratio of the upwelling to the downwelling signal. The spectra of all
+spectrometers with the same number of pixels are processed as one array,
+one row per spectrum. The spectra of all spectrometers are also resampled
+onto a common wavelength grid and merged into a single spectrum per
+direction. The results are written to a derived
+product file next to the raw file, eg untitled_bat0000_0001.pico gives
+untitled_bat0000_0001.derived.json.
+
+Calibration files are named after the serial number of the spectrometer,
+eg QEP00114.json, and contain the Upwelling and Downwelling lists of the
+calibration coefficient of each pixel.
+"""
+
+__all__ = ['PiccoloProcessingStage','normalise','reflectance']
+
+from PiccoloCompression import splitCompression
+from PiccoloFileAccess import PiccoloFileAccess
+from PiccoloFileSync import tmpName
+from PiccoloPicoParser import PiccoloPicoParser
+from PiccoloResample import PiccoloResampler
+from PiccoloWavelengths import WavelengthGrids
+import json
+import logging
+import numpy
+import os.path
+import re
+import threading
+
+DIRECTIONS = ['Upwelling','Downwelling']
+BATCHFILE = re.compile(r'^(.*_bat\d+_)(\d+)(\.light|\.dark)?\.pico$')
+
+def normalise(pixels,darks,integrationTimes):
+    """subtract dark spectra and divide by the integration times
+
+    :param pixels: array of light spectra, one spectrum per row
+    :param darks: array of the matching dark spectra
+    :param integrationTimes: the integration time of each row in
+                             milliseconds
+    :return: the signal in counts per millisecond"""
+    signal = numpy.subtract(pixels,darks,dtype=numpy.float64)
+    signal /= numpy.asarray(integrationTimes,dtype=numpy.float64)[:,numpy.newaxis]
+    return signal
+
+def reflectance(upwelling,downwelling):
+    """ratio of upwelling to downwelling signal, nan where there is no
+    downwelling signal"""
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        r = numpy.true_divide(upwelling,downwelling)
+    r[~(downwelling > 0)] = numpy.nan
+    return r
+
+def encode(values,decimals):
+    """round values and replace values that are not finite by None"""
+    values = numpy.round(values,decimals)
+    finite = numpy.isfinite(values)
+    if finite.all():
+        return values.tolist()
+    return [v if f else None for v,f in zip(values.tolist(),finite.tolist())]
+
+class PiccoloProcessingStage(object):
+    """compute radiance and reflectance of spectra files and store them in
+    derived product files"""
+
+    SUFFIX = '.derived.json'
+
+    def __init__(self,cfg={},calibration=None,resolve=None,written=None):
+        """
+        :param cfg: the Processing section of the piccolo configuration
+        :param calibration: the directory containing the calibration files,
+                            overrides the configuration
+        :param resolve: called with the calibration directory each time it is
+                        used to get its absolute path
+        :param written: called with the name of each derived product file
+                        written"""
+        self._log = logging.getLogger('piccolo.processing')
+        if calibration is None:
+            calibration = cfg.get('calibration','')
+        self._calibrationDir = calibration if calibration else None
+        self._resolve = resolve
+        self._calibrations = {}
+        self._written = written
+        if cfg.get('resample',True):
+            self._resampler = PiccoloResampler(start=cfg.get('wavelengthStart',350.),
+                                               stop=cfg.get('wavelengthStop',1000.),
+                                               step=cfg.get('wavelengthStep',1.))
+        else:
+            self._resampler = None
+        self._access = PiccoloFileAccess(maxMappings=1)
+        # the dark spectra of the last batch seen in each directory
+        self._lock = threading.Lock()
+        self._darks = {}
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    @property
+    def resampler(self):
+        """the resampler used to merge the spectra or None"""
+        return self._resampler
+
+    def derived(self,fname):
+        """the name of the derived product file of spectra file fname"""
+        d,name = os.path.split(splitCompression(fname)[0])
+        for suffix in ['.light.pico','.dark.pico','.pico']:
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+                break
+        return os.path.join(d,name+self.SUFFIX)
+
+    def calibration(self,serialNumber):
+        """the calibration coefficients of spectrometer serialNumber
+
+        :return: dictionary of coefficient arrays by direction or None if
+                 there is no calibration file"""
+        if self._calibrationDir is None:
+            return None
+        calibrationDir = self._calibrationDir
+        if self._resolve is not None:
+            calibrationDir = self._resolve(calibrationDir)
+        fname = os.path.join(calibrationDir,serialNumber+'.json')
+        try:
+            mtime = os.path.getmtime(fname)
+        except OSError:
+            return None
+        cached = self._calibrations.get(serialNumber)
+        if cached is None or cached[0] != mtime:
+            with open(fname,'r') as inf:
+                coefficients = json.load(inf)
+            cached = (mtime,dict((d,numpy.asarray(coefficients[d],dtype=numpy.float64))
+                                 for d in DIRECTIONS))
+            self._calibrations[serialNumber] = cached
+        return cached[1]
+
+    def _read(self,fname):
+        """read the spectra of file fname
+
+        :return: the sequence number, the light spectra keyed by serial
+                 number and direction and the dark spectra keyed by serial
+                 number, direction and integration time"""
+        lights = {}
+        darks = {}
+        with self._access.mapped(fname) as data:
+            parser = PiccoloPicoParser(data)
+            for spectrum in parser:
+                meta = spectrum.metadata
+                if meta['Dark']:
+                    darks[(meta['SerialNumber'],meta['Direction'],meta['IntegrationTime'])] = spectrum.pixels
+                else:
+                    lights[(meta['SerialNumber'],meta['Direction'])] = (meta,spectrum.pixels)
+        return parser.fields.get('SequenceNumber'),lights,darks
+
+    def _batchDarks(self,fname,darks):
+        """remember the dark spectra of the batch of file fname or look them up
+
+        the dark spectra are recorded at the start and end of a batch. When a
+        cycle has no dark spectra those of the last cycle that had some are
+        used, or those of the first cycle of the batch.
+
+        :param darks: the dark spectra of file fname
+        :return: the dark spectra to use"""
+        base,ext = splitCompression(fname)
+        d,name = os.path.split(base)
+        m = BATCHFILE.match(name)
+        if m is None:
+            return darks
+        prefix = m.group(1)
+        with self._lock:
+            if darks:
+                self._darks[d] = (prefix,darks)
+                return darks
+            if d in self._darks and self._darks[d][0] == prefix:
+                return self._darks[d][1]
+        if m.group(3) is not None:
+            first = os.path.join(d,prefix+'0000.dark.pico')
+        else:
+            first = os.path.join(d,prefix+'0000.pico')
+        # the first file is compressed like the others unless the compression
+        # was changed during the batch
+        first = first+ext if os.path.exists(first+ext) else first
+        if first != fname and os.path.exists(first):
+            darks = self._read(first)[2]
+            with self._lock:
+                self._darks[d] = (prefix,darks)
+        return darks
+
+    def process(self,fname):
+        """compute the derived products of spectra file fname
+
+        :return: the derived products or None if fname only contains dark
+                 spectra"""
+        base,ext = splitCompression(fname)
+        if base.endswith('.dark.pico'):
+            # remember the dark spectra for the following cycles
+            self._batchDarks(fname,self._read(fname)[2])
+            return None
+        seqNr,lights,darks = self._read(fname)
+        if not darks and base.endswith('.light.pico'):
+            dark = base[:-len('.light.pico')]+'.dark.pico'+ext
+            if os.path.exists(dark):
+                darks = self._read(dark)[2]
+        darks = self._batchDarks(fname,darks)
+
+        complete = []
+        for serialNumber in sorted(set(s for s,d in lights)):
+            if not all((serialNumber,d) in lights for d in DIRECTIONS):
+                self.log.warning('{0}: {1} does not have spectra in both directions'.format(fname,serialNumber))
+                continue
+            metas = [lights[(serialNumber,d)][0] for d in DIRECTIONS]
+            times = [m['IntegrationTime'] for m in metas]
+            keys = [(serialNumber,d,t) for d,t in zip(DIRECTIONS,times)]
+            if not all(k in darks for k in keys):
+                self.log.warning('{0}: no matching dark spectra for {1}'.format(fname,serialNumber))
+                continue
+            complete.append((serialNumber,metas,times,keys))
+
+        # the spectrometers with the same number of pixels are processed
+        # together, the rows are the upwelling and downwelling spectra of
+        # each spectrometer in turn
+        groups = {}
+        for c in complete:
+            groups.setdefault(len(lights[(c[0],DIRECTIONS[0])][1]),[]).append(c)
+        results = {}
+        for nPixels,group in groups.items():
+            signal = normalise(numpy.vstack([lights[(serialNumber,d)][1] for serialNumber,metas,times,keys in group for d in DIRECTIONS]),
+                               numpy.vstack([darks[k] for serialNumber,metas,times,keys in group for k in keys]),
+                               [t for serialNumber,metas,times,keys in group for t in times])
+            calibrations = [self.calibration(serialNumber) for serialNumber,metas,times,keys in group]
+            if any(c is not None for c in calibrations):
+                ones = numpy.ones(nPixels)
+                signal *= numpy.vstack([c[d] if c is not None else ones for c in calibrations for d in DIRECTIONS])
+            r = reflectance(signal[0::2],signal[1::2])
+            for i,(serialNumber,metas,times,keys) in enumerate(group):
+                results[serialNumber] = (signal[2*i:2*i+2],r[i],calibrations[i])
+
+        products = []
+        resampled = []
+        for serialNumber,metas,times,keys in complete:
+            signal,r,calibration = results[serialNumber]
+            wcc = metas[0]['WavelengthCalibrationCoefficients']
+            product = {'SerialNumber': serialNumber,
+                       'Batch': metas[0].get('Batch'),
+                       'IntegrationTime': dict(zip(DIRECTIONS,times)),
+                       'Wavelengths': encode(WavelengthGrids.grid(wcc,signal.shape[1]),3),
+                       'Units': 'radiance' if calibration is not None else 'counts per millisecond',
+                       'Reflectance': encode(r,5)}
+            for d,s in zip(DIRECTIONS,signal):
+                product[d] = encode(s,5)
+            products.append(product)
+
+            if self._resampler is not None:
+                try:
+                    # rows are the upwelling, downwelling and reflectance
+                    resampled.append((product['Units'],self._resampler.resample(numpy.vstack((signal,r)),wcc)))
+                except ValueError, e:
+                    self.log.warning('{0}: cannot resample {1}: {2}'.format(fname,serialNumber,e))
+
+        derived = {'SequenceNumber': seqNr,
+                   'Products': products}
+        if len(resampled) > 0:
+            derived['Merged'] = self.merge(resampled)
+        return derived
+
+    def merge(self,resampled):
+        """merge the resampled spectra of all spectrometers
+
+        :param resampled: list of the units and the resampled upwelling,
+                          downwelling and reflectance of each spectrometer
+        :return: the merged spectra, the upwelling and downwelling spectra are
+                 only merged if all spectrometers have the same units"""
+        units = set(u for u,spectra in resampled)
+        merged = self._resampler.merge([spectra for u,spectra in resampled])
+        product = {'Wavelengths': encode(self._resampler.grid,3),
+                   'Reflectance': encode(merged[2],5)}
+        if len(units) == 1:
+            product['Units'] = units.pop()
+            for d,s in zip(DIRECTIONS,merged):
+                product[d] = encode(s,5)
+        return product
+
+    def load(self,fname):
+        """get the derived products of file fname
+
+        :return: the contents of the derived product file or None if there is
+                 no up to date file"""
+        derived = self.derived(fname)
+        try:
+            if os.path.getmtime(derived) < os.path.getmtime(fname):
+                return None
+            with open(derived,'r') as inf:
+                return inf.read()
+        except (IOError,OSError):
+            return None
+
+    def __call__(self,fname):
+        """write the derived products of spectra file fname"""
+        products = self.process(fname)
+        if products is None:
+            return
+        derived = self.derived(fname)
+        tmp = tmpName(derived)
+        with open(tmp,'w') as out:
+            json.dump(products,out)
+        os.rename(tmp,derived)
+        if self._written is not None:
+            self._written(derived)
@@ -0,0 +1,257 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Quicklook statistics of the files in the output directories.
+
+The peak and mean counts and the number of saturated pixels of every
+spectrum are computed by the output thread while the batch is still in
+memory and appended to a hidden log file in the output directory together
+with the metadata needed to pick files, ie the integration time, the
+direction, whether the spectrum is dark and the time it was recorded. Files
+for which there are no statistics, eg files flushed from the spool or copied
+to the directory by hand, are read once when their statistics are first
+requested. The log is compacted when it is loaded and once it holds many
+superseded records.
+"""
+
+__all__ = ['PiccoloQuicklook','spectraStatistics','fileStatistics']
+
+from PiccoloPicoParser import PiccoloPicoParser
+from PiccoloCompression import splitCompression
+import fnmatch
+import json
+import logging
+import numpy
+import os, os.path
+import threading
+
+def spectraStatistics(spectra):
+    """compute the quicklook statistics of spectra
+
+    the spectra are grouped by number of pixels and the statistics of each
+    group are computed in one go
+
+    :param spectra: list of tuples of the metadata and pixels of each
+                    spectrum
+    :return: list of dictionaries containing the statistics of each
+             spectrum"""
+    stats = []
+    groups = {}
+    for i,(meta,pixels) in enumerate(spectra):
+        stats.append({'SerialNumber': meta.get('SerialNumber'),
+                      'Direction': meta.get('Direction'),
+                      'Dark': meta.get('Dark'),
+                      'IntegrationTime': meta.get('IntegrationTime'),
+                      'Batch': meta.get('Batch'),
+                      'Datetime': meta.get('Datetime'),
+                      'Peak': None,
+                      'Mean': None,
+                      'Saturated': None})
+        groups.setdefault(len(pixels),[]).append(i)
+
+    for n,indices in groups.items():
+        if n == 0:
+            continue
+        # rows are the spectra of the group
+        pixels = numpy.array([spectra[i][1] for i in indices],dtype=numpy.float64)
+        saturation = numpy.array([spectra[i][0].get('SaturationLevel') for i in indices],dtype=numpy.float64)
+        peak = pixels.max(axis=1)
+        mean = pixels.mean(axis=1)
+        saturated = (pixels >= saturation[:,numpy.newaxis]).sum(axis=1)
+        known = numpy.isfinite(saturation)
+        for j,i in enumerate(indices):
+            stats[i]['Peak'] = float(peak[j])
+            stats[i]['Mean'] = round(float(mean[j]),2)
+            if known[j]:
+                stats[i]['Saturated'] = int(saturated[j])
+    return stats
+
+def fileStatistics(fname,stats):
+    """select the statistics of the spectra stored in file fname
+
+    :param fname: name of a file written by a spectra list, the dark and
+                  light spectra are split into .dark.pico and .light.pico
+                  files
+    :param stats: the statistics of all spectra of the list
+    :return: the statistics of the spectra in the file"""
+    fname = splitCompression(fname)[0]
+    if fname.endswith('.dark.pico'):
+        return [s for s in stats if s['Dark']]
+    if fname.endswith('.light.pico'):
+        return [s for s in stats if not s['Dark']]
+    return stats
+
+class PiccoloDirectoryQuicklook(object):
+    """the quicklook log of a single directory"""
+
+    LOG = '.piccolo_quicklook'
+    # rewrite the log once it holds this many superseded records
+    COMPACT = 1000
+
+    def __init__(self,path):
+        """
+        :param path: the directory"""
+        self._log = logging.getLogger('piccolo.quicklook')
+        self.path = path
+        self.logName = os.path.join(path,self.LOG)
+        # tuples of the modification time and statistics of each file
+        self.files = {}
+        # the number of records in the log that are superseded or corrupt
+        self.superseded = 0
+
+        if os.path.exists(self.logName):
+            with open(self.logName,'r') as records:
+                for line in records:
+                    try:
+                        record = json.loads(line)
+                        if record['File'] in self.files:
+                            self.superseded += 1
+                        self.files[record['File']] = (record['Mtime'],record['Spectra'])
+                    except (ValueError,KeyError,TypeError):
+                        # incomplete line written during a crash
+                        self.log.warning('ignoring corrupt record in {}'.format(self.logName))
+                        self.superseded += 1
+            if self.superseded > 0:
+                self.compact()
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    def compact(self):
+        """rewrite the log so that it only contains the latest record of
+        each file"""
+        logTmp = self.logName+'.tmp'
+        try:
+            with open(logTmp,'w') as records:
+                for name in sorted(self.files):
+                    mtime,stats = self.files[name]
+                    records.write(json.dumps({'File': name, 'Mtime': mtime, 'Spectra': stats})+'\n')
+            os.rename(logTmp,self.logName)
+        except (IOError,OSError), e:
+            self.log.warning('cannot compact {}: {}'.format(self.logName,e))
+            return
+        self.superseded = 0
+
+    def add(self,name,mtime,stats):
+        """append the statistics of file name to the log"""
+        if name in self.files:
+            self.superseded += 1
+        self.files[name] = (mtime,stats)
+        if self.superseded >= self.COMPACT:
+            self.compact()
+            return
+        try:
+            with open(self.logName,'a') as records:
+                records.write(json.dumps({'File': name, 'Mtime': mtime, 'Spectra': stats})+'\n')
+        except (IOError,OSError), e:
+            self.log.warning('cannot append to {}: {}'.format(self.logName,e))
+
+    def get(self,name,mtime):
+        """:return: the statistics of file name or None if there are no
+                    statistics of the current version of the file"""
+        record = self.files.get(name)
+        if record is None or record[0] != mtime:
+            return None
+        return record[1]
+
+class PiccoloQuicklook(object):
+    """quicklook statistics of the spectra files in the output directories"""
+
+    def __init__(self,index,access,pattern='*.pico*'):
+        """
+        :param index: the file index of the data directory
+        :type index: PiccoloFileIndex
+        :param access: used to read files without statistics
+        :type access: PiccoloFileAccess
+        :param pattern: glob pattern of the files to be included"""
+        self._log = logging.getLogger('piccolo.quicklook')
+        self._index = index
+        self._access = access
+        self._pattern = pattern
+        self._lock = threading.Lock()
+        self._dirs = {}
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    def _getDirectory(self,path):
+        """get the quicklook log of directory path, must hold lock"""
+        if path not in self._dirs:
+            self._dirs[path] = PiccoloDirectoryQuicklook(path)
+        return self._dirs[path]
+
+    def add(self,fname,stats):
+        """record the statistics of file fname
+
+        :param fname: absolute path of the file
+        :param stats: the statistics of the spectra in the file"""
+        path,name = os.path.split(fname)
+        if name.startswith('.') or not fnmatch.fnmatch(name,self._pattern):
+            return
+        try:
+            mtime = os.stat(fname).st_mtime
+        except OSError:
+            return
+        with self._lock:
+            self._getDirectory(path).add(name,mtime,stats)
+
+    def read(self,fname):
+        """compute the statistics of the spectra stored in file fname"""
+        self.log.info('computing quicklook statistics of {}'.format(fname))
+        spectra = []
+        with self._access.mapped(fname) as data:
+            for spectrum in PiccoloPicoParser(data):
+                spectra.append((spectrum.metadata,spectrum.pixels))
+        return spectraStatistics(spectra)
+
+    def statistics(self,path,names):
+        """get the statistics of files in directory path
+
+        :param path: absolute path of the directory
+        :param names: the names of the files
+        :return: list of the statistics of each file, None for files that
+                 cannot be read"""
+        dirIndex = self._index.directory(path)
+        if dirIndex is None:
+            return [None]*len(names)
+        with self._lock:
+            d = self._getDirectory(path)
+        result = []
+        for name in names:
+            mtime = dirIndex.files.get(name,(None,))[0]
+            with self._lock:
+                stats = d.get(name,mtime)
+            if stats is None and mtime is not None:
+                try:
+                    stats = self.read(os.path.join(path,name))
+                except (IOError,OSError,ValueError,KeyError), e:
+                    self.log.warning('cannot read {}: {}'.format(name,e))
+                else:
+                    with self._lock:
+                        d.add(name,mtime,stats)
+            result.append(stats)
+        return result
+
+    def clear(self):
+        """forget all directories, eg when the data directory is unmounted"""
+        with self._lock:
+            self._dirs = {}
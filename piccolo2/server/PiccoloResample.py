@@ -0,0 +1,106 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Resampling of spectra onto a common wavelength grid.
+
+Each spectrometer has its own non-linear wavelength grid. The spectra are
+linearly interpolated onto a regular target grid so that the spectra of
+different spectrometers can be merged. The interpolation weights only depend
+on the wavelength calibration and are cached; all spectra of a spectrometer
+are resampled in one go.
+"""
+
+__all__ = ['PiccoloResampler']
+
+from PiccoloLRUCache import PiccoloLRUCache
+from PiccoloWavelengths import WavelengthGrids
+import numpy
+
+class PiccoloResampler(object):
+    """resample spectra onto a regular wavelength grid"""
+
+    def __init__(self,start=350.,stop=1000.,step=1.,maxBytes=4*1024*1024):
+        """
+        :param start: the first wavelength of the target grid in nm
+        :param stop: the last wavelength of the target grid in nm
+        :param step: the spacing of the target grid in nm
+        :param maxBytes: the maximum total size of the cached weights"""
+        self._grid = numpy.arange(start,stop+step/2.,step)
+        self._grid.flags.writeable = False
+        self._weights = PiccoloLRUCache(maxBytes=maxBytes)
+
+    @property
+    def grid(self):
+        """the target wavelengths"""
+        return self._grid
+
+    def weights(self,coefficients,nPixels):
+        """the interpolation weights of a spectrometer
+
+        :param coefficients: the wavelength calibration coefficients
+        :param nPixels: the number of pixels of the spectrometer
+        :return: the index of the pixel below each target wavelength, the
+                 weight of the pixel above and a mask of the target
+                 wavelengths covered by the spectrometer"""
+        key = (tuple(float(c) for c in coefficients),int(nPixels))
+        weights = self._weights.get(key)
+        if weights is None:
+            wavelengths = WavelengthGrids.grid(coefficients,nPixels)
+            if nPixels < 2 or not (numpy.diff(wavelengths) > 0).all():
+                raise ValueError, 'wavelengths do not increase monotonically'
+            covered = (self._grid >= wavelengths[0]) & (self._grid <= wavelengths[-1])
+            below = numpy.clip(numpy.searchsorted(wavelengths,self._grid)-1,0,nPixels-2)
+            above = (self._grid-wavelengths[below])/(wavelengths[below+1]-wavelengths[below])
+            weights = (below,above,covered)
+            for w in weights:
+                w.flags.writeable = False
+            self._weights.put(key,weights,sum(w.nbytes for w in weights))
+        return weights
+
+    def resample(self,spectra,coefficients):
+        """resample the spectra of a spectrometer
+
+        :param spectra: array of spectra, one spectrum per row
+        :param coefficients: the wavelength calibration coefficients
+        :return: array of the resampled spectra, nan outside the range of the
+                 spectrometer"""
+        spectra = numpy.atleast_2d(spectra)
+        below,above,covered = self.weights(coefficients,spectra.shape[1])
+        resampled = spectra[:,below]*(1.-above)
+        resampled += spectra[:,below+1]*above
+        resampled[:,~covered] = numpy.nan
+        return resampled
+
+    def merge(self,spectra):
+        """merge resampled spectra of several spectrometers
+
+        :param spectra: list of arrays of resampled spectra
+        :return: the mean of the spectra, nan where no spectrometer covers the
+                 wavelength"""
+        spectra = numpy.asarray(spectra)
+        valid = numpy.isfinite(spectra)
+        counts = valid.sum(axis=0)
+        total = numpy.where(valid,spectra,0.).sum(axis=0)
+        with numpy.errstate(divide='ignore',invalid='ignore'):
+            merged = total/counts
+        merged[counts == 0] = numpy.nan
+        return merged
+
+    def status(self):
+        """:return: the statistics of the weights cache"""
+        return self._weights.status()
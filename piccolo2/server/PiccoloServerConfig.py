@@ -65,6 +65,10 @@ mount = boolean(default=False)
 device = string(default=/dev/sda1)
 # the mount point
 mntpnt = string(default=/mnt)
+# local directory, eg on the SD card or tmpfs, used to spool batches. When
+# set, batches are written to the spool first and copied to the data directory
+# in the background
+spool = string(default=None)
 
 [jsonrpc]
 # The URL on which the piccolo JSON-RPC server is listening. By default listen
@@ -73,10 +77,12 @@ url = string(default="http://localhost:8080")
 # file based logging is only used when daemonized
 access_log = string(default="/var/log/piccolo.access")
 error_log = string(default="/var/log/piccolo.error")
+# the maximum size in MiB of the cache of parsed spectra files served in chunks
+cacheSize = integer(min=0,default=32)
 """
 
 # populate the default server config object which is used as a validator
-piccoloServerDefaults = ConfigObj(defaultCfgStr.split('\n'))
+piccoloServerDefaults = ConfigObj(defaultCfgStr.split('\n'),_inspec=True)
 validator = Validator()
 
 class PiccoloServerConfig(object):
@@ -23,6 +23,7 @@
 __all__ = ['PiccoloShutter']
 
 from PiccoloInstrument import PiccoloInstrument
+from PiccoloTrace import Trace
 import threading
 import time
 
@@ -55,6 +56,7 @@ class PiccoloShutter(PiccoloInstrument):
 
         PiccoloInstrument.__init__(self,name)
         self._lock = threading.Lock()
+        self._opened = None
         
         self._fibre = float(fibreDiameter)
         self._reverse = reverse
@@ -82,6 +84,9 @@ class PiccoloShutter(PiccoloInstrument):
             self.log.warn('shutter already open')
             return 'shutter already open'
         self._lock.acquire()
+        # the shutter may be closed by another thread, the open interval is
+        # recorded as one event when it is closed
+        self._opened = time.time()
         self.log.info('open shutter')
         if self._shutter!=None:
             self._shutter.open()
@@ -95,6 +100,7 @@ class PiccoloShutter(PiccoloInstrument):
             return 'shutter already closed'
         if self._shutter!=None:
             self._shutter.close()
+        Trace.complete('shutter open',self._opened,cat='shutter',args={'shutter':self.name})
         self._lock.release()
         self.log.info('closed shutter')
         return 'ok'
@@ -110,6 +116,11 @@ class PiccoloShutter(PiccoloInstrument):
         t.daemon=True
         t.start()
                              
+    def stop(self):
+        """close the shutter"""
+        self.closeShutter()
+        return PiccoloInstrument.stop(self)
+
     def status(self):
         """return status of shutter
 
@@ -1,103 +1,317 @@
 # numpy implementation of https://github.com/omarestrella/simplify.py
 # It uses a combination of Douglas-Peucker and Radial Distance algorithms
+#
+# The Douglas-Peucker pass is vectorised over all segments of a level: the
+# points that end up being kept do not depend on the order in which segments
+# are split, so instead of processing one segment at a time from a stack each
+# iteration finds the furthest point of every segment that still needs
+# splitting at once. The number of iterations is the depth of the recursion
+# rather than the number of segments. simplifyMany runs the pass over all
+# spectra of a file together so that short spectra share the iterations. The
+# benchmark verifies the vectorised version against a straight port of
+# simplify.py.
+#
+# simplifyBudget keeps a given number of points instead. It splits the
+# segment with the furthest point first, using a heap of segments, and
+# reports the maximum distance of the dropped points from the simplified line.
 
+import heapq
 import numpy as np
 
-class DouglasPeuckerSimplifier(object):
+def radialDistance(xs,ys,sqtolerance):
+    """indices of the points kept by the radial distance prefilter
 
-    def __init__(self,xs,ys,tolerance):
-        self.xs = xs
-        self.ys = ys
-        self.tolerance = tolerance
+    the polyline is cut into pieces of length sqrt(sqtolerance) and the first
+    point in each piece is kept together with the last point. Consecutive
+    kept points therefore are at least one tolerance apart along the line and
+    every dropped point lies within the tolerance of the previous kept point."""
+    n = xs.size
+    if n < 3 or sqtolerance <= 0:
+        return np.arange(n)
+    steps = np.hypot(np.diff(xs),np.diff(ys))
+    buckets = np.floor(np.cumsum(steps)/np.sqrt(sqtolerance))
+    keep = np.empty(n,dtype=bool)
+    keep[0] = True
+    keep[1] = buckets[0] > 0
+    keep[2:] = buckets[1:] != buckets[:-1]
+    keep[-1] = True
+    return np.flatnonzero(keep)
 
-        self.length = xs.size
-        self.markers = np.zeros(self.length,dtype='bool')
-        self.markers[[0,-1]] = 1
+def squareSegmentDistances(px,py,xs,ys,first,last,work,mask):
+    """square distances between points and segments
 
-        #pre-allocate the temporary arrays used in getSquareSegmentDistances
-        self.ts = np.empty(self.length)
-        self.final_xs = np.empty(self.length)
-        self.final_ys = np.empty(self.length)
+    :param px: x coordinates of the points
+    :param py: y coordinates of the points
+    :param first: indices into xs,ys of the start of the segment of each point
+    :param last: indices into xs,ys of the end of the segment of each point
+    :param work: 9xN float array used for the results, N is the number of
+                 points
+    :param mask: boolean array of size N used for intermediate results
+    :return: the distances, stored in work[0]"""
+    sqdists,x,y,dx,dy,t,lx,ly,d = work
+    xs.take(first,out=x,mode='clip')
+    ys.take(first,out=y,mode='clip')
+    xs.take(last,out=lx,mode='clip')
+    ys.take(last,out=ly,mode='clip')
+    np.subtract(lx,x,out=dx)
+    np.subtract(ly,y,out=dy)
 
-        
-    def getSquareSegmentDistances(self, first, last):
-        """
-        Square distance between point and a segment
-        """
-        inner = slice(first,last)
-        x = self.xs[first]
-        y = self.ys[first]
+    # the position of the projection of the point along the segment, nan for
+    # segments of zero length
+    np.subtract(px,x,out=t)
+    t *= dx
+    np.subtract(py,y,out=sqdists)
+    sqdists *= dy
+    t += sqdists
+    np.multiply(dx,dx,out=sqdists)
+    np.multiply(dy,dy,out=d)
+    sqdists += d
+    t /= sqdists
 
-        dx = self.xs[last] - x
-        dy = self.ys[last] - y
+    # move the start to the nearest point on the segment, the arithmetic is
+    # the same as in the reference implementation so that the results match
+    np.greater(t,0,out=mask)
+    dx *= t
+    np.add(x,dx,out=x,where=mask)
+    dy *= t
+    np.add(y,dy,out=y,where=mask)
+    np.greater(t,1,out=mask)
+    np.copyto(x,lx,where=mask)
+    np.copyto(y,ly,where=mask)
 
-        if dx != 0 or dy != 0:
-            inner_ts = self.ts[inner]
+    np.subtract(px,x,out=x)
+    np.subtract(py,y,out=y)
+    np.multiply(x,x,out=sqdists)
+    y *= y
+    sqdists += y
+    return sqdists
 
-            final_xs = self.final_xs[inner]
-            final_ys = self.final_ys[inner]
-            final_xs[:] = x
-            final_ys[:] = y
+def douglasPeucker(xs,ys,sqtolerance,bounds=None):
+    """markers of the points kept by the Douglas-Peucker algorithm
 
-            inner_ts = (((self.xs[inner] - x) * dx 
-                + (self.ys[inner] -y) * dy) / (dx*dx + dy*dy))
+    :param sqtolerance: the square tolerance, or one square tolerance per
+                        polyline
+    :param bounds: when xs,ys hold several polylines one after the other the
+                   index of the first point of each polyline followed by the
+                   total number of points"""
+    n = xs.size
+    if bounds is None:
+        bounds = [0,n]
+    bounds = np.asarray(bounds,dtype=np.intp)
+    lengths = np.diff(bounds)
+    markers = np.zeros(n,dtype=bool)
+    markers[bounds[:-1][lengths>0]] = True
+    markers[bounds[1:][lengths>0]-1] = True
 
-            large_ts = inner_ts>1
-            small_ts = inner_ts>0 & ~large_ts
+    # the points that lie in a segment which may still have to be split
+    # together with the ends of that segment. The points stay sorted so the
+    # points of a segment are contiguous.
+    points = np.flatnonzero(~markers)
+    px = xs[points]
+    py = ys[points]
+    polyline = np.repeat(np.arange(lengths.size),np.maximum(lengths-2,0))
+    first = bounds[:-1].take(polyline)
+    last = bounds[1:].take(polyline) - 1
+    sqtolerance = np.asarray(sqtolerance,dtype=np.float64)
+    if sqtolerance.ndim > 0:
+        sqtolerance = sqtolerance.take(polyline)
 
-            final_xs[small_ts] += dx*inner_ts[small_ts]
-            final_ys[small_ts] += dy*inner_ts[small_ts]
+    # work arrays, as points drop out only the leading part is used
+    index = np.arange(points.size)
+    fwork = np.empty((9,points.size))
+    iwork = np.empty((2,points.size),dtype=points.dtype)
+    bwork = np.empty((2,points.size),dtype=bool)
 
-            final_xs[large_ts] = self.xs[last]
-            final_ys[large_ts] = self.ys[last]
+    # segments of zero length give distances of nan which are never larger
+    # than the tolerance, these points are handled by the neighbouring segments
+    with np.errstate(divide='ignore',invalid='ignore'):
+        while points.size > 0:
+            m = points.size
+            sqdists = squareSegmentDistances(px,py,xs,ys,first,last,fwork[:,:m],bwork[0,:m])
 
+            starting = bwork[0,:m]
+            starting[0] = True
+            np.not_equal(first[1:],first[:-1],out=starting[1:])
+            starts = np.flatnonzero(starting)
+            owner = np.cumsum(starting,out=iwork[0,:m])
+            owner -= 1
 
-        dx = self.xs[inner] - final_xs
-        dy = self.ys[inner] - final_ys
+            maxima = np.maximum.reduceat(sqdists,starts)
+            if sqtolerance.ndim > 0:
+                split = maxima > sqtolerance.take(starts)
+            else:
+                split = maxima > sqtolerance
 
-        return dx * dx + dy * dy
+            # the first point at the maximum distance splits the segment
+            atMaximum = bwork[1,:m]
+            np.equal(sqdists,maxima.take(owner,out=fwork[1,:m],mode='clip'),out=atMaximum)
+            position = iwork[1,:m]
+            position.fill(m)
+            np.copyto(position,index[:m],where=atMaximum)
+            furthest = points.take(np.minimum.reduceat(position,starts))
+            markers[furthest[split]] = True
 
-    def simplifyDouglasPeucker(self):
+            # the points of split segments now belong to one of the two halves,
+            # the points of the other segments are done
+            furthest = furthest.take(owner,out=iwork[1,:m],mode='clip')
+            active = split.take(owner,out=bwork[0,:m],mode='clip')
+            np.greater(points,furthest,out=atMaximum)
+            np.copyto(first,furthest,where=atMaximum)
+            np.less(points,furthest,out=atMaximum)
+            np.copyto(last,furthest,where=atMaximum)
+            np.not_equal(points,furthest,out=atMaximum)
+            active &= atMaximum
 
-        first = 0
-        last = self.length - 1
+            points = points[active]
+            px = px[active]
+            py = py[active]
+            first = first[active]
+            last = last[active]
+            if sqtolerance.ndim > 0:
+                sqtolerance = sqtolerance[active]
 
-        first_stack = np.empty(self.length,dtype='uint32')
-        first_i = -1
-        last_stack = np.empty(self.length,dtype='uint32')
-        last_i = -1
+    return markers
 
-        while last is not None:
-            max_sqdist = 0
-            sqdists = self.getSquareSegmentDistances(first,last)
-            max_idx = np.argmax(sqdists)
-            max_sqdist = sqdists[max_idx]
-            max_idx += first
+def simplify(xs,ys, tolerance=0.1, highestQuality=True):
+    """simplify the polyline xs,ys
 
-            if max_sqdist > self.tolerance:
-                self.markers[max_idx] = 1
+    :param tolerance: the maximum distance of the dropped points from the
+                      simplified line
+    :param highestQuality: skip the radial distance prefilter, when False the
+                           prefilter may move the simplified line by up to
+                           another tolerance but the simplification is faster
+    :return: the coordinates of the kept points"""
+    sqtolerance = tolerance * tolerance
+    # do the arithmetic in double precision whatever the input type
+    fxs = np.asarray(xs,dtype=np.float64)
+    fys = np.asarray(ys,dtype=np.float64)
 
-                first_stack[first_i+1:first_i+3] = first,max_idx
-                last_stack[last_i+1:last_i+3] = max_idx,last
-                first_i +=2
-                last_i += 2
+    if fxs.size < 3:
+        return xs[:],ys[:]
 
-            if first_i < 0:
-                first = None
-            else:
-                first = first_stack[first_i]
-                first_i -=1 
+    if highestQuality:
+        keep = np.flatnonzero(douglasPeucker(fxs,fys,sqtolerance))
+    else:
+        keep = radialDistance(fxs,fys,sqtolerance)
+        keep = keep[douglasPeucker(fxs[keep],fys[keep],sqtolerance)]
 
-            if last_i < 0:
-                last = None
-            else:
-                last = last_stack[last_i]
-                last_i -=1 
+    return xs[keep],ys[keep]
 
-        return self.xs[self.markers],self.ys[self.markers]
+def simplifyMany(polylines, tolerances, highestQuality=True):
+    """simplify several polylines at once
 
+    the result is the same as simplifying each polyline on its own but the
+    iterations of the Douglas-Peucker pass are shared by all polylines
 
-def simplify(xs,ys, tolerance=0.1, highestQuality=True):
+    :param polylines: a list of xs,ys pairs
+    :param tolerances: the tolerance, or one tolerance per polyline
+    :param highestQuality: skip the radial distance prefilter
+    :return: the coordinates of the kept points of each polyline"""
+    if len(polylines) == 0:
+        return []
+    sqtolerances = np.square(np.asarray(tolerances,dtype=np.float64))
+    sqtolerances = np.broadcast_to(sqtolerances,(len(polylines),))
+
+    keeps = []
+    fxs = []
+    fys = []
+    for (xs,ys),sqtolerance in zip(polylines,sqtolerances):
+        fx = np.asarray(xs,dtype=np.float64)
+        fy = np.asarray(ys,dtype=np.float64)
+        if highestQuality:
+            keep = np.arange(fx.size)
+        else:
+            keep = radialDistance(fx,fy,sqtolerance)
+            fx = fx[keep]
+            fy = fy[keep]
+        keeps.append(keep)
+        fxs.append(fx)
+        fys.append(fy)
+
+    bounds = np.cumsum([0]+[keep.size for keep in keeps])
+    markers = douglasPeucker(np.concatenate(fxs),np.concatenate(fys),sqtolerances,bounds)
+
+    simplified = []
+    for (xs,ys),keep,start,end in zip(polylines,keeps,bounds[:-1],bounds[1:]):
+        keep = keep[markers[start:end]]
+        simplified.append((xs[keep],ys[keep]))
+    return simplified
+
+def furthestPoint(xs,ys,first,last):
+    """the point between first and last furthest from the segment first-last
+
+    :return: the index of the point and its square distance or None if there
+             are no points between first and last"""
+    if last - first < 2:
+        return None
+    px = xs[first+1:last]
+    py = ys[first+1:last]
+    x = xs[first]
+    y = ys[first]
+    dx = xs[last] - x
+    dy = ys[last] - y
+    norm = dx*dx + dy*dy
+    if norm > 0:
+        ts = ((px - x)*dx + (py - y)*dy)/norm
+        x = np.where(ts > 1, xs[last], np.where(ts > 0, x + dx*ts, x))
+        y = np.where(ts > 1, ys[last], np.where(ts > 0, y + dy*ts, y))
+    sqdists = (px - x)**2 + (py - y)**2
+    i = sqdists.argmax()
+    return first+1+i,sqdists[i]
+
+def rank(xs,ys,maxPoints=None,tolerance=0.):
+    """rank the points of the polyline xs,ys by their importance
+
+    the segment with the furthest point is split first. The first n points
+    of the ranking are the best simplification using n points, without
+    tolerance and maxPoints all points are ranked.
+
+    :param maxPoints: stop once maxPoints points are ranked
+    :param tolerance: stop once all remaining points are within tolerance of
+                      the simplified line
+    :return: the indices of the ranked points, the first and last point come
+             first, and the maximum distance of the remaining points from the
+             simplified line using the first n+1 ranked points, at least two"""
+    fxs = np.asarray(xs,dtype=np.float64)
+    fys = np.asarray(ys,dtype=np.float64)
+    n = fxs.size
+    if n < 3:
+        return np.arange(n),np.zeros(n)
+    if maxPoints is None:
+        maxPoints = n
     sqtolerance = tolerance * tolerance
 
-    return DouglasPeuckerSimplifier(xs,ys,sqtolerance).simplifyDouglasPeucker()
+    segments = []
+    def push(first,last):
+        furthest = furthestPoint(fxs,fys,first,last)
+        if furthest is not None:
+            heapq.heappush(segments,(-furthest[1],furthest[0],first,last))
+
+    order = [0,n-1]
+    sqerrors = []
+    push(0,n-1)
+    while True:
+        sqerror = -segments[0][0] if segments else 0.
+        sqerrors.append(sqerror)
+        if len(order) >= maxPoints or sqerror <= sqtolerance:
+            break
+        sqdist,i,first,last = heapq.heappop(segments)
+        order.append(i)
+        push(first,i)
+        push(i,last)
+
+    return np.array(order),np.sqrt([sqerrors[0]]+sqerrors)
+
+def simplifyBudget(xs,ys,maxPoints,tolerance=0.):
+    """simplify the polyline xs,ys using at most maxPoints points
+
+    :param maxPoints: the maximum number of points, the first and last point
+                      are always kept
+    :param tolerance: do not keep more points than needed to get within the
+                      tolerance, the result is the same as the one of
+                      simplify when maxPoints is not reached
+    :return: the coordinates of the kept points and the maximum distance of
+             the dropped points from the simplified line"""
+    order,errors = rank(xs,ys,maxPoints,tolerance)
+    keep = np.sort(order)
+    return xs[keep],ys[keep],errors[-1]
@@ -0,0 +1,114 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Geometry of GPS tagged spectra.
+
+Each spectrum covers the track from the GPS position at the start to the one
+at the end of the measurement, the catalogue indexes the bounding box of
+that track. Distances are computed in metres using an equirectangular
+projection around a reference point which is accurate over the extent of a
+deployment. Tracks crossing the antimeridian are not supported.
+"""
+
+__all__ = ['position','trackBox','localCoordinates','metresToDegrees','trackPositions']
+
+import numpy
+
+EARTH_RADIUS = 6371000.
+
+def position(record):
+    """get the position of a GPS record
+
+    :param record: dictionary containing lat and lon entries
+    :return: tuple of latitude and longitude or None if the record does not
+             contain a valid position, eg before the GPS has a fix"""
+    try:
+        lat = float(record['lat'])
+        lon = float(record['lon'])
+    except (KeyError,TypeError,ValueError):
+        return None
+    if not (-90. <= lat <= 90. and -180. <= lon <= 180.):
+        return None
+    return lat,lon
+
+def trackBox(start,end):
+    """bounding box of the track between GPS records start and end
+
+    :return: tuple of the minimum and maximum latitude and the minimum and
+             maximum longitude or None if neither record has a position"""
+    positions = [p for p in (position(start),position(end)) if p is not None]
+    if len(positions) == 0:
+        return None
+    lats,lons = zip(*positions)
+    return min(lats),max(lats),min(lons),max(lons)
+
+def localCoordinates(lats,lons,lat0,lon0):
+    """east and north offsets in metres from lat0,lon0
+
+    :return: tuple of arrays of the east and north offsets"""
+    x = numpy.radians(numpy.asarray(lons,dtype=numpy.float64)-lon0)
+    x *= EARTH_RADIUS*numpy.cos(numpy.radians(lat0))
+    y = numpy.radians(numpy.asarray(lats,dtype=numpy.float64)-lat0)
+    y *= EARTH_RADIUS
+    return x,y
+
+def metresToDegrees(metres,lat):
+    """convert a distance at latitude lat to degrees
+
+    :return: tuple of the distance in degrees latitude and longitude"""
+    dlat = numpy.degrees(metres/EARTH_RADIUS)
+    coslat = numpy.cos(numpy.radians(lat))
+    if coslat < 1e-6:
+        return dlat,360.
+    return dlat,min(dlat/coslat,360.)
+
+def trackPositions(xs,ys,tx,ty):
+    """project points onto a track
+
+    the distances of all points to all segments of the track are computed at
+    once, each point is assigned to the nearest segment
+
+    :param xs: east coordinates of the points in metres
+    :param ys: north coordinates of the points in metres
+    :param tx: east coordinates of the track vertices in metres
+    :param ty: north coordinates of the track vertices in metres
+    :return: tuple of arrays of the distance along the track and the
+             distance from the track of each point"""
+    xs = numpy.asarray(xs,dtype=numpy.float64)[:,numpy.newaxis]
+    ys = numpy.asarray(ys,dtype=numpy.float64)[:,numpy.newaxis]
+    tx = numpy.asarray(tx,dtype=numpy.float64)
+    ty = numpy.asarray(ty,dtype=numpy.float64)
+    if tx.size == 1:
+        across = numpy.hypot(xs[:,0]-tx[0],ys[:,0]-ty[0])
+        return numpy.zeros_like(across),across
+
+    # rows are points, columns are segments
+    dx = numpy.diff(tx)
+    dy = numpy.diff(ty)
+    lengths = numpy.hypot(dx,dy)
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        t = ((xs-tx[:-1])*dx+(ys-ty[:-1])*dy)/(lengths*lengths)
+    t[~numpy.isfinite(t)] = 0.
+    numpy.clip(t,0.,1.,out=t)
+    distances = numpy.hypot(xs-(tx[:-1]+t*dx),ys-(ty[:-1]+t*dy))
+
+    nearest = distances.argmin(axis=1)
+    points = numpy.arange(nearest.size)
+    offsets = numpy.concatenate(([0.],numpy.cumsum(lengths)[:-1]))
+    along = offsets[nearest]+t[points,nearest]*lengths[nearest]
+    return along,distances[points,nearest]
@@ -29,6 +29,7 @@ __all__ = ['PiccoloSpectrometer']
 from piccolo2.PiccoloSpectra import *
 from PiccoloInstrument import PiccoloInstrument
 from PiccoloWorkerThread import PiccoloWorkerThread
+from PiccoloTrace import Trace
 import time
 import threading
 from Queue import Queue
@@ -422,14 +423,18 @@ class SpectrometerThread(PiccoloWorkerThread):
         if self._spec==None:
             # If spectrometer is None, thenm simulate a spectrometer, for
             # testing purposes.
-            time.sleep(task.integrationTime/1000.)
+            with Trace.span('simulate spectrum',cat='spectrometer'):
+                time.sleep(task.integrationTime/1000.)
             pixels = [1]*100
         else:
             # Have a real spectrometer, so acquire a real spectrum.
-            self._spec.setIntegrationTime(task.integrationTime)
-            spectrum.update(self._spec.getMetadata())
-            self._spec.requestSpectrum()
-            pixels = self._spec.readSpectrum()
+            with Trace.span('set integration time',cat='spectrometer'):
+                self._spec.setIntegrationTime(task.integrationTime)
+                spectrum.update(self._spec.getMetadata())
+            with Trace.span('request spectrum',cat='spectrometer'):
+                self._spec.requestSpectrum()
+            with Trace.span('read spectrum',cat='spectrometer'):
+                pixels = self._spec.readSpectrum()
 
         spectrum.pixels = pixels
 
@@ -473,6 +478,12 @@ class PiccoloSpectrometer(PiccoloInstrument):
         # send poison pill to worker
         self._tQ.put(None)
 
+    def stop(self):
+        """stop the worker thread and wait for it to finish"""
+        self._tQ.put(None)
+        self._spectrometer.join()
+        return PiccoloInstrument.stop(self)
+
     def status(self):
         """return status of shutter
 
@@ -0,0 +1,374 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Two-tier output path.
+
+Batches are first written to a local spool directory and recorded in a
+journal. A flusher thread copies committed batches to the data directory,
+verifies the copies and removes them from the spool. Batches that were
+committed but not flushed are picked up again after a restart.
+"""
+
+__all__ = ['PiccoloSpool','PiccoloFlusher']
+
+from PiccoloTrace import Trace
+from PiccoloFileSync import PiccoloFileSync, fsyncDirectory, tmpName
+from collections import deque
+import json
+import logging
+import os, os.path
+import shutil
+import threading
+import time
+import zlib
+
+BLOCKSIZE = 1024*1024
+
+def checksum(fname):
+    """:return: tuple of size and crc32 of file fname"""
+    size = 0
+    crc = 0
+    with open(fname,'rb') as inf:
+        while True:
+            block = inf.read(BLOCKSIZE)
+            if not block:
+                break
+            size += len(block)
+            crc = zlib.crc32(block,crc)
+    return size,crc & 0xffffffff
+
+class PiccoloSpool(object):
+    """local write-ahead spool of batches waiting to be copied to the data
+    directory"""
+
+    JOURNAL = 'journal'
+    BATCHES = 'batches'
+
+    def __init__(self,spooldir):
+        """
+        :param spooldir: the spool directory, should be on fast local storage"""
+
+        self._log = logging.getLogger('piccolo.spool')
+        self._spooldir = spooldir
+        self._batchdir = os.path.join(spooldir,self.BATCHES)
+        self._journalName = os.path.join(spooldir,self.JOURNAL)
+        if not os.path.isdir(self._batchdir):
+            self.log.info("creating spool directory {}".format(self._batchdir))
+            os.makedirs(self._batchdir)
+
+        self._lock = threading.Condition()
+        self._pending = deque()
+        self._flushing = set()
+        self._nBatches = 0
+        self._recover()
+
+    @property
+    def log(self):
+        """get the log"""
+        return self._log
+
+    def batchDir(self,bid):
+        """the directory holding the files of batch bid"""
+        return os.path.join(self._batchdir,bid)
+
+    def _recover(self):
+        """replay the journal and tidy up after an unclean shutdown"""
+        committed = {}
+        order = []
+        if os.path.exists(self._journalName):
+            with open(self._journalName,'r') as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # incomplete record written during a crash
+                        self.log.warning('ignoring corrupt journal record')
+                        continue
+                    if record['op'] == 'commit':
+                        committed[record['batch']] = record['files']
+                        order.append(record['batch'])
+                    elif record['op'] == 'done':
+                        committed.pop(record['batch'],None)
+
+        for bid in order:
+            if bid not in committed:
+                continue
+            if not os.path.isdir(self.batchDir(bid)):
+                self.log.error('committed batch {} is missing from spool'.format(bid))
+                continue
+            self.log.warning('batch {} has not been flushed yet'.format(bid))
+            self._pending.append((bid,committed[bid]))
+
+        # remove batches that were never committed
+        pending = set(bid for bid,files in self._pending)
+        for bid in os.listdir(self._batchdir):
+            if bid not in pending:
+                self.log.warning('removing incomplete batch {}'.format(bid))
+                shutil.rmtree(self.batchDir(bid),ignore_errors=True)
+
+        self._compact()
+
+    def _compact(self):
+        """rewrite journal so that it only contains pending batches"""
+        journalTmp = self._journalName+'.tmp'
+        with open(journalTmp,'w') as journal:
+            for bid,files in self._pending:
+                journal.write(json.dumps({'op':'commit','batch':bid,'files':files})+'\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.rename(journalTmp,self._journalName)
+        fsyncDirectory(self._spooldir)
+        self._journal = open(self._journalName,'a')
+
+    def _append(self,record):
+        """append a record to the journal, must hold lock"""
+        with Trace.span('fsync',args={'file':self._journalName}):
+            self._journal.write(json.dumps(record)+'\n')
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def newBatch(self):
+        """create a new batch
+
+        :return: tuple of the batch ID and the directory to write files to"""
+        with self._lock:
+            bid = '{0:017.6f}_{1:06d}'.format(time.time(),self._nBatches)
+            self._nBatches += 1
+        bdir = self.batchDir(bid)
+        os.makedirs(bdir)
+        return bid,bdir
+
+    def commit(self,bid):
+        """make the files of batch bid durable and record them in the journal
+
+        :param bid: the batch ID
+        :return: list of (file name, size, crc32) of the batch files"""
+        bdir = self.batchDir(bid)
+        files = []
+        for root,dirs,fnames in os.walk(bdir):
+            for f in fnames:
+                fname = os.path.join(root,f)
+                with Trace.span('fsync',args={'file':fname}):
+                    with open(fname,'rb') as inf:
+                        os.fsync(inf.fileno())
+                size,crc = checksum(fname)
+                files.append((os.path.relpath(fname,bdir),size,crc))
+        files.sort()
+        with self._lock:
+            self._append({'op':'commit','batch':bid,'files':files})
+            self._pending.append((bid,files))
+            self._lock.notify()
+        return files
+
+    def abandon(self,bid):
+        """remove a batch that has not been committed"""
+        shutil.rmtree(self.batchDir(bid),ignore_errors=True)
+
+    def _nextBatch(self):
+        """the oldest pending batch that is not being flushed, must hold lock"""
+        for batch in self._pending:
+            if batch[0] not in self._flushing:
+                return batch
+        return None
+
+    def next(self,timeout=None):
+        """get the oldest pending batch that is not being flushed and mark it
+        as being flushed
+
+        :param timeout: wait at most timeout seconds for a batch
+        :return: tuple of batch ID and file list or None"""
+        with self._lock:
+            batch = self._nextBatch()
+            if batch is None:
+                self._lock.wait(timeout)
+                batch = self._nextBatch()
+            if batch is not None:
+                self._flushing.add(batch[0])
+            return batch
+
+    def wakeup(self):
+        """wake up the threads waiting for a batch"""
+        with self._lock:
+            self._lock.notifyAll()
+
+    def release(self,bid):
+        """batch bid could not be flushed, hand it out again"""
+        with self._lock:
+            self._flushing.discard(bid)
+            self._lock.notify()
+
+    def done(self,bid):
+        """mark batch bid as flushed and remove it from the spool"""
+        with self._lock:
+            self._append({'op':'done','batch':bid})
+            self._flushing.discard(bid)
+            if len(self._pending)>0 and self._pending[0][0] == bid:
+                self._pending.popleft()
+            else:
+                self._pending = deque(p for p in self._pending if p[0]!=bid)
+            shutil.rmtree(self.batchDir(bid),ignore_errors=True)
+            if len(self._pending) == 0:
+                self._journal.close()
+                self._compact()
+
+    def status(self):
+        """:return: dictionary containing the number of pending batches and
+                    the age in seconds of the oldest one"""
+        with self._lock:
+            n = len(self._pending)
+            if n>0:
+                oldest = time.time()-float(self._pending[0][0].split('_')[0])
+            else:
+                oldest = None
+        return {'pending': n,
+                'oldest': oldest}
+
+class PiccoloFlusher(threading.Thread):
+    """copy spooled batches to the data directory"""
+
+    RETRY = 5.
+
+    def __init__(self,name,datadir,spool,clobber=True,daemon=True,sync=None):
+        """
+        :param name: name of the thread
+        :param datadir: the data directory
+        :type datadir: PiccoloDataDir
+        :param spool: the spool holding the batches
+        :type spool: PiccoloSpool
+        :param clobber: overwrite existing files when set to True
+        :param sync: publishes the copied files, defaults to the batch fsync
+                     policy
+        :type sync: PiccoloFileSync"""
+        threading.Thread.__init__(self)
+        self.name = name
+        self.daemon = daemon
+
+        self._log = logging.getLogger('piccolo.worker.flusher.{0}'.format(name))
+        self.log.info('initialising worker')
+
+        self._datadir = datadir
+        self._spool = spool
+        self._clobber = clobber
+        self._error = None
+        self._stopping = False
+        if sync is None:
+            sync = PiccoloFileSync()
+        self._sync = sync
+
+    @property
+    def log(self):
+        return self._log
+
+    @property
+    def error(self):
+        """the last error encountered or None"""
+        return self._error
+
+    def copy(self,src,dst):
+        """copy file src to the temporary file dst
+
+        :return: tuple of size and crc32 of the copy"""
+        with open(src,'rb') as inf:
+            with open(dst,'wb') as out:
+                while True:
+                    block = inf.read(BLOCKSIZE)
+                    if not block:
+                        break
+                    out.write(block)
+        return checksum(dst)
+
+    def flush(self,bid,files):
+        """copy the files of batch bid to temporary files in the data
+        directory, verify them and hand them over to be published"""
+        datadir = self._datadir.datadir
+        bdir = self._spool.batchDir(bid)
+        with Trace.span('flush',args={'batch':bid}):
+            published = []
+            try:
+                for fname,size,crc in files:
+                    dst = os.path.join(datadir,fname)
+                    if os.path.exists(dst) and not self._clobber:
+                        self.log.error('not overwriting {}'.format(dst))
+                        continue
+                    d = os.path.dirname(dst)
+                    if not os.path.isdir(d):
+                        os.makedirs(d)
+                    tmp = tmpName(dst)
+                    published.append((tmp,dst))
+                    if self.copy(os.path.join(bdir,fname),tmp) != (size,crc):
+                        raise IOError, 'verifying {} failed'.format(dst)
+                self._sync.publish(published,
+                                   callback=lambda error: self._published(bid,published,error))
+            except:
+                self._removeTemporary(published)
+                raise
+
+    def _removeTemporary(self,published):
+        """remove the temporary copies that have not been published"""
+        for tmp,final in published:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def _published(self,bid,published,error):
+        """called once the files of batch bid have been published"""
+        if error is not None:
+            self.log.error('publishing batch {}: {}'.format(bid,error))
+            self._error = str(error)
+            self._removeTemporary(published)
+            self._spool.release(bid)
+            self._datadir.invalidate()
+            return
+        for tmp,final in published:
+            self._datadir.fileWritten(final)
+        self.log.info('flushed batch {}'.format(bid))
+        self._spool.done(bid)
+        if self._error is not None:
+            self.log.info('flushing batches resumed')
+            self._error = None
+
+    def stop(self):
+        """stop the thread once the pending batches have been flushed,
+        batches that cannot be flushed stay in the spool"""
+        self._stopping = True
+        self._spool.wakeup()
+
+    def run(self):
+        while True:
+            # time out in case stop is called just before waiting
+            batch = self._spool.next(self.RETRY)
+            if batch is None:
+                if self._stopping:
+                    break
+                continue
+            bid,files = batch
+            try:
+                self.flush(bid,files)
+            except (IOError,OSError,RuntimeError), e:
+                if self._error is None:
+                    self.log.error('flushing batch {}: {}'.format(bid,e))
+                self._error = str(e)
+                self._spool.release(bid)
+                self._datadir.invalidate()
+                if self._stopping:
+                    break
+                time.sleep(self.RETRY)
+        self.log.info('shutting down')
+        # wait for the last batches to be published
+        self._sync.flush()
@@ -1,7 +1,11 @@
 import threading
 import time
 import signal
-import RPi.GPIO as GPIO
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    # not running on a Raspberry Pi, eg the offline tools
+    GPIO = None
 
 class DummyLED(object):
     def turnOn(self):
@@ -70,7 +74,8 @@ class PiccoloStatusLED(object):
     def stop(self):
         self.stopped = True
         self._status_thread.running = False
-        self._status_thread.join()
+        if self._status_thread.is_alive():
+            self._status_thread.join()
 
         #If called by __del__, GPIO might already be unloaded
         if GPIO:
@@ -0,0 +1,168 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Lightweight tracing of the acquisition phases.
+
+Begin and end events are appended to a fixed size in-memory ring buffer.
+Phases which start and finish on different threads are recorded as a single
+complete event with a duration once they are over. The buffer can be exported in the Chrome trace event format which can be loaded
+into chrome://tracing or Perfetto.
+"""
+
+__all__ = ['PiccoloTrace','Trace']
+
+from collections import deque
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+class PiccoloTrace(object):
+    """in-memory buffer of begin/end and complete events"""
+
+    def __init__(self,maxEvents=20000,enabled=True):
+        """
+        :param maxEvents: the number of events kept, older events are dropped
+        :param enabled: record events when set to True"""
+        self._events = deque(maxlen=maxEvents)
+        self.enabled = enabled
+
+    @property
+    def maxEvents(self):
+        """the maximum number of events kept in the buffer"""
+        return self._events.maxlen
+
+    @maxEvents.setter
+    def maxEvents(self,n):
+        self._events = deque(self.events(),maxlen=n)
+
+    def _add(self,ph,name,cat,args,ts=None,dur=None):
+        t = threading.current_thread()
+        if ts is None:
+            ts = time.time()
+        # appending to a deque is atomic, no need for a lock
+        self._events.append((ph,name,cat,ts,dur,t.ident,t.name,args))
+
+    def begin(self,name,cat='piccolo',args=None):
+        """record the beginning of a phase
+
+        :param name: the name of the phase
+        :param cat: the category of the phase
+        :param args: dictionary of additional information"""
+        if self.enabled:
+            self._add('B',name,cat,args)
+
+    def end(self,name,cat='piccolo',args=None):
+        """record the end of a phase
+
+        :param name: the name of the phase
+        :param cat: the category of the phase
+        :param args: dictionary of additional information"""
+        if self.enabled:
+            self._add('E',name,cat,args)
+
+    def complete(self,name,start,cat='piccolo',args=None):
+        """record a phase that is over
+
+        the phase is recorded as a single event of the current thread, use
+        it for phases which start and finish on different threads
+
+        :param name: the name of the phase
+        :param start: the time the phase started as returned by time.time()
+        :param cat: the category of the phase
+        :param args: dictionary of additional information"""
+        if self.enabled:
+            self._add('X',name,cat,args,ts=start,dur=time.time()-start)
+
+    @contextmanager
+    def span(self,name,cat='piccolo',args=None):
+        """context manager recording the beginning and end of a phase"""
+        self.begin(name,cat=cat,args=args)
+        try:
+            yield
+        finally:
+            self.end(name,cat=cat)
+
+    def clear(self):
+        """remove all events"""
+        self._events.clear()
+
+    def events(self):
+        """:return: a copy of the list of events"""
+        while True:
+            try:
+                return list(self._events)
+            except RuntimeError:
+                # the deque was modified while copying it
+                continue
+
+    def chromeTrace(self,clear=False):
+        """get the events in Chrome trace event format
+
+        :param clear: remove the events from the buffer
+        :return: dictionary which can be serialised to JSON"""
+        events = self.events()
+        if clear:
+            self.clear()
+
+        pid = os.getpid()
+        threads = {}
+        trace = []
+        for ph,name,cat,ts,dur,tid,tname,args in events:
+            threads[tid] = tname
+            e = {'name':name,'cat':cat,'ph':ph,'ts':int(ts*1e6),'pid':pid,'tid':tid}
+            if dur is not None:
+                e['dur'] = int(dur*1e6)
+            if args is not None:
+                e['args'] = args
+            trace.append(e)
+        for tid in threads:
+            trace.append({'name':'thread_name','ph':'M','pid':pid,'tid':tid,
+                          'args':{'name':threads[tid]}})
+        return {'traceEvents':trace,'displayTimeUnit':'ms'}
+
+    def summary(self):
+        """pair begin and end events and accumulate time spent in each phase
+        together with the complete events
+
+        :return: dictionary of count, total, mean and max time per phase"""
+        stacks = {}
+        durations = {}
+        for ph,name,cat,ts,dur,tid,tname,args in self.events():
+            stack = stacks.setdefault(tid,[])
+            if ph == 'X':
+                durations.setdefault(name,[]).append(dur)
+            elif ph == 'B':
+                stack.append((name,ts))
+            else:
+                for i in range(len(stack)-1,-1,-1):
+                    if stack[i][0] == name:
+                        durations.setdefault(name,[]).append(ts-stack[i][1])
+                        del stack[i:]
+                        break
+        result = {}
+        for name in durations:
+            d = durations[name]
+            result[name] = {'count': len(d),
+                            'total': sum(d),
+                            'mean': sum(d)/len(d),
+                            'max': max(d)}
+        return result
+
+# the trace buffer shared by all piccolo threads
+Trace = PiccoloTrace()
@@ -0,0 +1,64 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-server.
+#
+# piccolo2-server is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-server is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Wavelength grids of the spectrometers.
+
+The wavelengths of the pixels of a spectrum are given by a polynomial in the
+pixel index whose coefficients are stored with every spectrum. A spectrometer
+keeps its calibration so the same grids are evaluated over and over again.
+They are kept in a shared cache and handed out as read-only arrays.
+"""
+
+__all__ = ['PiccoloWavelengthGrids','WavelengthGrids']
+
+from PiccoloLRUCache import PiccoloLRUCache
+import numpy
+
+class PiccoloWavelengthGrids(object):
+    """cache of wavelength grids keyed by the calibration coefficients and
+    the number of pixels"""
+
+    def __init__(self,maxBytes=4*1024*1024):
+        """
+        :param maxBytes: the maximum total size of the cached grids"""
+        self._cache = PiccoloLRUCache(maxBytes=maxBytes)
+
+    def grid(self,coefficients,nPixels):
+        """get the wavelengths of the pixels of a spectrum
+
+        :param coefficients: the wavelength calibration coefficients, lowest
+                             order first
+        :param nPixels: the number of pixels of the spectrum
+        :return: read-only array of the wavelengths"""
+        key = (tuple(float(c) for c in coefficients),int(nPixels))
+        wavelengths = self._cache.get(key)
+        if wavelengths is None:
+            wavelengths = numpy.poly1d(key[0][::-1])(numpy.arange(nPixels))
+            wavelengths.flags.writeable = False
+            self._cache.put(key,wavelengths,wavelengths.nbytes)
+        return wavelengths
+
+    def clear(self):
+        """remove all grids"""
+        self._cache.clear()
+
+    def status(self):
+        """:return: the statistics of the cache"""
+        return self._cache.status()
+
+WavelengthGrids = PiccoloWavelengthGrids()
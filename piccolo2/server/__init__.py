@@ -16,6 +16,11 @@
 # along with piccolo2-server.  If not, see <http://www.gnu.org/licenses/>.
 
 from piccoloLogging import *
+from PiccoloTrace import *
+from PiccoloFileSync import *
+from PiccoloWavelengths import *
+from PiccoloArchive import *
+from PiccoloEncoding import *
 from PiccoloServerConfig import *
 from PiccoloConfig import *
 from PiccoloDataDir import *
@@ -34,6 +34,8 @@ setup(
     entry_points={
         'console_scripts': [
             'piccolo2-server = piccolo2.pserver:main',
+            'piccolo2-benchmark = piccolo2.pbenchmark:main',
+            'piccolo2-reprocess = piccolo2.reprocess:main',
         ],
     },
 